@@ -73,6 +73,9 @@ app.config['SESSION_COOKIE_PATH'] = '/'
 # Set default timezone
 app.config['TIMEZONE'] = pytz.timezone('UTC')
 
+# Log the ticket dashboard's SQL, status distribution and every ticket it returns (slow; for debugging only)
+app.config['TICKET_DASHBOARD_PROFILING'] = os.environ.get('TICKET_DASHBOARD_PROFILING', '').lower() in ('1', 'true', 'yes')
+
 # Initialize extensions
 db.init_app(app)
 login_manager.init_app(app)
@@ -180,8 +183,14 @@ from routes import *
 from ticket_routes import tickets, get_active_sidebar_tickets
 # Register health check for container healthchecks
 from health import health_bp
+# Server-Sent Events stream for the sidebar panels
+from live_updates import live_bp
+# Status and downloads for background jobs
+from jobs import jobs_bp
 app.register_blueprint(tickets)
 app.register_blueprint(health_bp)
+app.register_blueprint(live_bp)
+app.register_blueprint(jobs_bp)
 
 # Register the get_active_sidebar_tickets function with the app context
 @app.context_processor
@@ -0,0 +1,1153 @@
+"""
+Streaming database backup and bulk restore.
+
+Each table is read in batches over a server-side cursor (yield_per). The rows
+a batch refers to (technicians, locations, categories) are joined in, and
+ticket comments and history are loaded with one query per batch instead of
+one per ticket. JSON is written as rows arrive and sent in chunks, optionally
+gzipped on the fly, so a backup never sits in memory as a whole.
+
+The document has the same shape as the original json.dumps() backup, so
+restore_backup() reads either, plus a "backup" header with its type and
+watermark. An incremental backup only holds rows written since an earlier
+backup's watermark (by updated_at, or created_at for rows that are never
+edited) and a "deleted" section of tombstones for rows deleted since then.
+
+Restores go the other way: the upload is parsed incrementally, one row at a
+time, into temporary staging tables, and each entity is then merged into the
+real tables with a single INSERT ... SELECT (ON CONFLICT DO NOTHING where
+there is a unique key), resolving usernames, location and category names to
+ids in SQL instead of with a query per row. A full backup and a chain of
+incrementals are staged together, and only the latest version of each row
+that was not deleted later in the chain is merged.
+"""
+import codecs
+import gzip
+import hashlib
+import json
+import logging
+import random
+import shutil
+import string
+import tempfile
+import zipfile
+import zlib
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import pytz
+from sqlalchemy import (Boolean, Column, Date, DateTime, Integer, MetaData, String, Table, Text, Time, event, or_,
+                        select)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, aliased, joinedload
+
+from app import db
+from models import (User, Location, Schedule, ScheduleRule, QuickLink, TicketCategory, Ticket, TicketComment,
+                    TicketHistory, TicketStatus, EmailSettings, DeletedRecord, BackupRecord, MAX_SHIFT_LENGTH)
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched per round trip (and per child-row query for tickets)
+BACKUP_BATCH_SIZE = 500
+# Bytes of JSON collected before a chunk is sent (or compressed)
+BACKUP_CHUNK_SIZE = 64 * 1024
+# Bytes read from an uploaded backup at a time
+RESTORE_CHUNK_SIZE = 64 * 1024
+# Staged rows sent to the database per executemany
+RESTORE_BATCH_SIZE = 1000
+# Rows per row group in a columnar backup section
+COLUMNAR_GROUP_SIZE = 1000
+COLUMNAR_COMPRESS_LEVEL = 9
+COLUMNAR_FORMAT = 'techsched-columnar'
+COLUMNAR_VERSION = 1
+COLUMNAR_MANIFEST = 'manifest.json'
+# Stored as delta-encoded microseconds since the epoch instead of ISO strings
+COLUMNAR_DATETIME_FIELDS = {'start_time', 'end_time', 'due_date', 'created_at', 'updated_at', 'deleted_at'}
+# Nested rows written as sections of their own (field -> section)
+COLUMNAR_CHILD_SECTIONS = {'tickets': {'comments': 'ticket_comments', 'history': 'ticket_history'}}
+# Derived fields a restore never reads
+COLUMNAR_DROPPED_FIELDS = {'users': ('created_schedules',)}
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.UTC)
+# A backup's watermark is set this far before it starts, so rows written by
+# transactions still open at the time are picked up by the next incremental
+BACKUP_WATERMARK_MARGIN = timedelta(minutes=5)
+
+# Models whose deletions are logged for incremental backups
+TOMBSTONED_MODELS = (User, Location, Schedule, ScheduleRule, QuickLink, TicketCategory, Ticket, TicketComment,
+                     TicketHistory)
+
+
+@event.listens_for(Session, 'after_flush')
+def _log_deleted_objects(session, flush_context):
+    now = datetime.now(pytz.UTC)
+    rows = [{'table_name': obj.__tablename__, 'record_id': obj.id, 'deleted_at': now}
+            for obj in session.deleted if isinstance(obj, TOMBSTONED_MODELS)]
+    if rows:
+        session.connection().execute(DeletedRecord.__table__.insert(), rows)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _log_bulk_deletes(orm_execute_state):
+    # Query.delete() bypasses the flush, so log the rows it is about to remove
+    if not orm_execute_state.is_delete or orm_execute_state.bind_mapper is None:
+        return
+    model = orm_execute_state.bind_mapper.class_
+    if not issubclass(model, TOMBSTONED_MODELS):
+        return
+    deleted = select(db.literal(model.__tablename__), model.id,
+                     db.literal(datetime.now(pytz.UTC), DateTime(timezone=True)))
+    whereclause = orm_execute_state.statement.whereclause
+    if whereclause is not None:
+        deleted = deleted.where(whereclause)
+    orm_execute_state.session.connection().execute(
+        DeletedRecord.__table__.insert().from_select(['table_name', 'record_id', 'deleted_at'], deleted))
+
+
+def _batches(statement) -> Iterator[list]:
+    """Run an ORM select over a server-side cursor and yield lists of objects"""
+    result = db.session.execute(statement.execution_options(yield_per=BACKUP_BATCH_SIZE))
+    return result.scalars().partitions()
+
+
+def _group_by_ticket(model, ticket_ids: List[int]) -> Dict[int, list]:
+    grouped = defaultdict(list)
+    rows = db.session.execute(
+        select(model)
+        .options(joinedload(model.user))
+        .filter(model.ticket_id.in_(ticket_ids))
+        .order_by(model.id)
+    ).scalars()
+    for row in rows:
+        grouped[row.ticket_id].append(row)
+    return grouped
+
+
+def _changed_since(model, since: datetime):
+    """Rows written at or after since; rows never updated fall back to when they were created"""
+    updated = getattr(model, 'updated_at', None)
+    created = getattr(model, 'created_at', None)
+    if updated is not None and created is not None:
+        return db.func.coalesce(updated, created) >= since
+    return (updated if updated is not None else created) >= since
+
+
+def _rows_to_back_up(model, since: Optional[datetime]):
+    statement = select(model).order_by(model.id)
+    return statement.where(_changed_since(model, since)) if since else statement
+
+
+def _user_rows(since: Optional[datetime] = None) -> Iterator[dict]:
+    for users in _batches(_rows_to_back_up(User, since)):
+        schedule_ids = defaultdict(list)
+        rows = db.session.execute(
+            select(Schedule.technician_id, Schedule.id)
+            .filter(Schedule.technician_id.in_([user.id for user in users]))
+            .order_by(Schedule.id)
+        )
+        for technician_id, schedule_id in rows:
+            schedule_ids[technician_id].append(schedule_id)
+        for user in users:
+            yield user.to_dict(schedule_ids=schedule_ids[user.id])
+
+
+def _schedule_rows(since: Optional[datetime] = None) -> Iterator[dict]:
+    statement = _rows_to_back_up(Schedule, since).options(
+        joinedload(Schedule.technician), joinedload(Schedule.location))
+    for schedules in _batches(statement):
+        for schedule in schedules:
+            yield schedule.to_dict()
+
+
+def _schedule_rule_rows(since: Optional[datetime] = None) -> Iterator[dict]:
+    statement = _rows_to_back_up(ScheduleRule, since).options(
+        joinedload(ScheduleRule.technician), joinedload(ScheduleRule.location))
+    for rules in _batches(statement):
+        for rule in rules:
+            yield rule.to_dict()
+
+
+def _ticket_rows(since: Optional[datetime] = None) -> Iterator[dict]:
+    # All tickets, archived and non-archived
+    statement = (select(Ticket)
+                 .options(joinedload(Ticket.category),
+                          joinedload(Ticket.creator),
+                          joinedload(Ticket.assigned_technician))
+                 .order_by(Ticket.id))
+    if since:
+        # A ticket is written out again, with all its entries, when any of them changed
+        statement = statement.where(or_(
+            _changed_since(Ticket, since),
+            Ticket.id.in_(select(TicketComment.ticket_id).where(_changed_since(TicketComment, since))),
+            Ticket.id.in_(select(TicketHistory.ticket_id).where(_changed_since(TicketHistory, since)))
+        ))
+    for tickets in _batches(statement):
+        ticket_ids = [ticket.id for ticket in tickets]
+        comments = _group_by_ticket(TicketComment, ticket_ids)
+        history = _group_by_ticket(TicketHistory, ticket_ids)
+        for ticket in tickets:
+            yield ticket.to_dict(comments=comments[ticket.id], history=history[ticket.id])
+
+
+def _simple_rows(model) -> Callable[[Optional[datetime]], Iterator[dict]]:
+    def rows(since: Optional[datetime] = None):
+        for batch in _batches(_rows_to_back_up(model, since)):
+            for obj in batch:
+                yield obj.to_dict()
+    return rows
+
+
+def _deleted_rows(since: Optional[datetime] = None) -> Iterator[dict]:
+    statement = select(DeletedRecord).order_by(DeletedRecord.id)
+    if since:
+        statement = statement.where(DeletedRecord.deleted_at >= since)
+    for batch in _batches(statement):
+        for record in batch:
+            yield record.to_dict()
+
+
+# Sections in the order restore_backup() needs them
+BACKUP_SECTIONS: List[Tuple[str, Callable[[Optional[datetime]], Iterator[dict]]]] = [
+    ('users', _user_rows),
+    ('locations', _simple_rows(Location)),
+    ('schedules', _schedule_rows),
+    ('schedule_rules', _schedule_rule_rows),
+    ('quick_links', _simple_rows(QuickLink)),
+    ('ticket_categories', _simple_rows(TicketCategory)),
+    ('tickets', _ticket_rows),
+    ('email_settings', _simple_rows(EmailSettings)),
+]
+
+
+def incremental_since() -> datetime:
+    """Watermark of the most recent backup, where the next incremental backup starts"""
+    watermark = db.session.scalar(select(db.func.max(BackupRecord.watermark)))
+    if watermark is None:
+        raise ValueError('There is no earlier backup to continue from. Create a full backup first.')
+    return watermark if watermark.tzinfo else pytz.UTC.localize(watermark)
+
+
+def _plan_backup(since: Optional[datetime]):
+    """Header and sections for a new backup: everything, or the changes and deletions since a watermark"""
+    watermark = datetime.now(pytz.UTC) - BACKUP_WATERMARK_MARGIN
+    header = {'type': 'incremental' if since else 'full',
+              'since': since.isoformat() if since else None,
+              'watermark': watermark.isoformat()}
+    sections = BACKUP_SECTIONS + ([('deleted', _deleted_rows)] if since else [])
+    return header, sections
+
+
+def _record_backup(header: dict, since: Optional[datetime], counts: Dict[str, int]) -> None:
+    # Only a complete backup moves the watermark on
+    db.session.add(BackupRecord(kind=header['type'], since=since,
+                                watermark=datetime.fromisoformat(header['watermark'])))
+    db.session.commit()
+    logger.info(f"{header['type'].title()} backup created successfully with {counts['schedules']} schedules "
+                f"and {counts['tickets']} tickets")
+
+
+def generate_backup_json(progress: Optional[Callable] = None, since: Optional[datetime] = None) -> Iterator[str]:
+    """
+    Yield the backup document piece by piece, one row per line: every row,
+    or with since, only rows changed since then and the deletions.
+    progress(done, total, message) is called after each section.
+    """
+    header, sections = _plan_backup(since)
+    counts = {}
+    yield '{\n  "backup": ' + json.dumps(header)
+    for index, (name, rows) in enumerate(sections):
+        yield f',\n  {json.dumps(name)}: ['
+        count = 0
+        for row in rows(since):
+            yield f'{"," if count else ""}\n    {json.dumps(row, default=str)}'
+            count += 1
+        yield '\n  ]' if count else ']'
+        counts[name] = count
+        if progress:
+            progress(index + 1, len(sections), f"Backed up {count} {name.replace('_', ' ')}")
+    yield '\n}\n'
+    _record_backup(header, since, counts)
+
+
+def _encode_times(values: List[Optional[str]]) -> List[Optional[int]]:
+    """ISO timestamps as microseconds since the epoch, each stored as the difference from the one before"""
+    encoded = []
+    previous = 0
+    for value in values:
+        if value is None:
+            encoded.append(None)
+            continue
+        parsed = datetime.fromisoformat(value)
+        if parsed.tzinfo is None:
+            parsed = pytz.UTC.localize(parsed)
+        micros = (parsed - EPOCH) // timedelta(microseconds=1)
+        encoded.append(micros - previous)
+        previous = micros
+    return encoded
+
+
+def _decode_times(values: List[Optional[int]]) -> List[Optional[datetime]]:
+    decoded = []
+    micros = 0
+    for value in values:
+        if value is None:
+            decoded.append(None)
+            continue
+        micros += value
+        decoded.append(EPOCH + timedelta(microseconds=micros))
+    return decoded
+
+
+class _ColumnarSection:
+    """Write one section of a columnar backup as row groups of column arrays, one group per line"""
+
+    def __init__(self, name: str, output):
+        self.name = name
+        self.output = output
+        self.rows = 0
+        self.digest = hashlib.sha256()
+        self._group: List[dict] = []
+
+    def add(self, row: dict) -> None:
+        self._group.append(row)
+        if len(self._group) >= COLUMNAR_GROUP_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._group:
+            return
+        names = list(dict.fromkeys(name for row in self._group for name in row))
+        columns = {name: [row.get(name) for row in self._group] for name in names}
+        for name in COLUMNAR_DATETIME_FIELDS.intersection(columns):
+            columns[name] = _encode_times(columns[name])
+        line = json.dumps({'rows': len(self._group), 'columns': columns}, separators=(',', ':'), default=str)
+        data = (line + '\n').encode('utf-8')
+        self.digest.update(data)
+        self.output.write(data)
+        self.rows += len(self._group)
+        self._group = []
+
+    def entry(self) -> dict:
+        return {'name': self.name, 'file': f'{self.name}.jsonl', 'rows': self.rows, 'sha256': self.digest.hexdigest()}
+
+
+def write_columnar_backup(output, progress: Optional[Callable] = None, since: Optional[datetime] = None) -> None:
+    """
+    Write the backup to a binary file object as a columnar archive: a zip
+    with one member per section, holding row groups of column arrays, and a
+    manifest with the header, row counts and a SHA-256 checksum per section.
+    Ticket comments and history become sections of their own.
+    progress(done, total, message) is called after each section.
+    """
+    header, sections = _plan_backup(since)
+    entries = []
+    counts = {}
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED,
+                         compresslevel=COLUMNAR_COMPRESS_LEVEL) as archive:
+        for index, (name, rows) in enumerate(sections):
+            child_fields = COLUMNAR_CHILD_SECTIONS.get(name, {})
+            # Only one archive member can be written at a time, so nested rows wait in temporary files
+            children = {field: _ColumnarSection(child_name, tempfile.TemporaryFile())
+                        for field, child_name in child_fields.items()}
+            with archive.open(f'{name}.jsonl', 'w', force_zip64=True) as member:
+                section = _ColumnarSection(name, member)
+                for row in rows(since):
+                    for field in COLUMNAR_DROPPED_FIELDS.get(name, ()):
+                        row.pop(field, None)
+                    for field, child in children.items():
+                        for child_row in row.pop(field, None) or []:
+                            child.add(dict(child_row, ticket_id=row['id']))
+                    section.add(row)
+                section.flush()
+            entries.append(section.entry())
+
+            for child in children.values():
+                child.flush()
+                child.output.seek(0)
+                with archive.open(f'{child.name}.jsonl', 'w', force_zip64=True) as member:
+                    shutil.copyfileobj(child.output, member)
+                child.output.close()
+                entries.append(child.entry())
+
+            counts[name] = section.rows
+            if progress:
+                progress(index + 1, len(sections), f"Backed up {section.rows} {name.replace('_', ' ')}")
+
+        manifest = {'format': COLUMNAR_FORMAT, 'version': COLUMNAR_VERSION, 'backup': header,
+                    'datetime_columns': sorted(COLUMNAR_DATETIME_FIELDS), 'sections': entries}
+        archive.writestr(COLUMNAR_MANIFEST, json.dumps(manifest, indent=2))
+    _record_backup(header, since, counts)
+
+
+def _chunked(pieces: Iterable[str], size: int = BACKUP_CHUNK_SIZE) -> Iterator[bytes]:
+    buffer = []
+    buffered = 0
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= size:
+            yield ''.join(buffer).encode('utf-8')
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+
+
+def _gzipped(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)  # gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def generate_backup(compress: bool = False, progress: Optional[Callable] = None,
+                    since: Optional[datetime] = None) -> Iterator[bytes]:
+    """
+    Yield the backup as byte chunks ready to stream, gzipped when compress is
+    set; an incremental backup of the changes since a watermark when since is.
+    """
+    try:
+        chunks = _chunked(generate_backup_json(progress, since))
+        yield from (_gzipped(chunks) if compress else chunks)
+    except Exception as e:
+        # Headers are already sent, so the download can only be cut short
+        logger.error(f"Error creating backup: {str(e)}")
+        raise
+
+
+class BackupReader:
+    """
+    Incremental parser for a backup document: a JSON object whose values are
+    arrays of rows. sections() yields (name, rows) pairs, where rows is a
+    generator decoding one row at a time, so only the current row and one
+    read chunk are ever held in memory. Values that are not arrays (the
+    "backup" header) are kept in values as they are passed.
+    """
+
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, stream, chunk_size: int = RESTORE_CHUNK_SIZE):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._text = codecs.getincrementaldecoder('utf-8-sig')()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self.values: Dict[str, object] = {}
+
+    def _fill(self) -> bool:
+        """Read another chunk, dropping what has been consumed; False at end of input"""
+        if self._eof:
+            return False
+        data = self._stream.read(self._chunk_size)
+        self._eof = not data
+        self._buffer = self._buffer[self._pos:] + self._text.decode(data, final=self._eof)
+        self._pos = 0
+        return not self._eof
+
+    def _peek(self) -> str:
+        """Skip whitespace and return the next character ('' at end of input)"""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in ' \t\r\n':
+                self._pos += 1
+            if self._pos < len(self._buffer) or not self._fill():
+                return self._buffer[self._pos:self._pos + 1]
+
+    def _expect(self, chars: str) -> str:
+        char = self._peek()
+        if not char or char not in chars:
+            raise json.JSONDecodeError(f"Expecting one of {chars!r}", self._buffer, self._pos)
+        self._pos += 1
+        return char
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue  # The value runs on into the next chunk
+                raise
+            # A number or literal at the end of the buffer may continue in the next chunk
+            if end == len(self._buffer) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def _rows(self) -> Iterator:
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._expect(',]') == ']':
+                return
+
+    def sections(self) -> Iterator[Tuple[str, Iterator]]:
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            name = self._value()
+            if not isinstance(name, str):
+                raise json.JSONDecodeError("Expecting section name", self._buffer, self._pos)
+            self._expect(':')
+            if self._peek() == '[':
+                self._pos += 1
+                rows = self._rows()
+                yield name, rows
+                for _ in rows:  # Skip whatever the caller did not read
+                    pass
+            else:
+                self.values[name] = self._value()
+            if self._expect(',}') == '}':
+                return
+
+
+class ColumnarBackupReader:
+    """
+    Reader for a columnar backup archive with the same interface as
+    BackupReader: sections() yields (name, rows) in manifest order, decoding
+    one row group at a time, and each section's checksum is verified once it
+    has been read.
+    """
+
+    def __init__(self, stream):
+        try:
+            self._archive = zipfile.ZipFile(stream)
+            self.manifest = json.loads(self._archive.read(COLUMNAR_MANIFEST))
+        except (zipfile.BadZipFile, KeyError, json.JSONDecodeError):
+            raise ValueError('Invalid backup file format')
+        if self.manifest.get('format') != COLUMNAR_FORMAT or self.manifest.get('version') != COLUMNAR_VERSION:
+            raise ValueError('Unsupported backup format version')
+        self.values: Dict[str, object] = {'backup': self.manifest.get('backup')}
+
+    def _rows(self, section: dict) -> Iterator[dict]:
+        datetime_columns = set(self.manifest.get('datetime_columns', ()))
+        digest = hashlib.sha256()
+        with self._archive.open(section['file']) as member:
+            for line in member:
+                digest.update(line)
+                columns = json.loads(line)['columns']
+                for name in datetime_columns.intersection(columns):
+                    columns[name] = _decode_times(columns[name])
+                names = list(columns)
+                for values in zip(*columns.values()):
+                    yield dict(zip(names, values))
+        if digest.hexdigest() != section['sha256']:
+            raise ValueError(f"Backup section {section['name']} is corrupt (checksum mismatch)")
+
+    def sections(self) -> Iterator[Tuple[str, Iterator]]:
+        for section in self.manifest['sections']:
+            rows = self._rows(section)
+            yield section['name'], rows
+            for _ in rows:  # Skip whatever the caller did not read, still checking it
+                pass
+
+
+def open_backup(stream):
+    """Wrap an uploaded backup stream, decompressing it on the fly when gzipped"""
+    magic = stream.read(2)
+    stream.seek(0)
+    return gzip.GzipFile(fileobj=stream) if magic == b'\x1f\x8b' else stream
+
+
+def open_backup_reader(stream):
+    """Reader for a backup in either format: a columnar archive, or JSON (gzipped or not)"""
+    magic = stream.read(4)
+    stream.seek(0)
+    if magic == b'PK\x03\x04':
+        return ColumnarBackupReader(stream)
+    return BackupReader(open_backup(stream))
+
+
+# Temporary tables the upload is staged into before merging
+staging = MetaData()
+
+# Every staged row records which backup of the chain it came from (sequence)
+# and its id there (backup_id), so later versions and deletions can replace it
+restore_user = Table(
+    'restore_user', staging,
+    Column('backup_id', Integer), Column('sequence', Integer),
+    Column('username', String(64)), Column('email', String(120)), Column('password_hash', String(256)),
+    Column('color', String(7)), Column('is_admin', Boolean), Column('timezone', String(50)),
+    prefixes=['TEMPORARY'])
+
+restore_location = Table(
+    'restore_location', staging,
+    Column('backup_id', Integer), Column('sequence', Integer),
+    Column('name', String(100)), Column('description', String(200)), Column('active', Boolean),
+    prefixes=['TEMPORARY'])
+
+restore_schedule = Table(
+    'restore_schedule', staging,
+    Column('backup_id', Integer), Column('sequence', Integer),
+    Column('technician_username', String(64)), Column('location_name', String(100)),
+    Column('start_time', DateTime(timezone=True)), Column('end_time', DateTime(timezone=True)),
+    Column('description', String(200)), Column('time_off', Boolean),
+    prefixes=['TEMPORARY'])
+
+restore_schedule_rule = Table(
+    'restore_schedule_rule', staging,
+    Column('backup_id', Integer), Column('sequence', Integer),
+    Column('technician_username', String(64)), Column('location_name', String(100)),
+    Column('description', String(200)), Column('time_off', Boolean), Column('weekdays', String(20)),
+    Column('start_time', Time), Column('end_time', Time), Column('timezone', String(50)),
+    Column('start_date', Date), Column('until_date', Date), Column('exceptions', Text),
+    prefixes=['TEMPORARY'])
+
+restore_quick_link = Table(
+    'restore_quick_link', staging,
+    Column('backup_id', Integer), Column('sequence', Integer),
+    Column('title', String(100)), Column('url', String(500)), Column('icon', String(50)),
+    Column('category', String(100)), Column('order', Integer),
+    prefixes=['TEMPORARY'])
+
+restore_ticket_category = Table(
+    'restore_ticket_category', staging,
+    Column('backup_id', Integer), Column('sequence', Integer),
+    Column('name', String(100)), Column('description', String(200)), Column('icon', String(50)),
+    Column('priority_level', Integer),
+    prefixes=['TEMPORARY'])
+
+restore_ticket = Table(
+    'restore_ticket', staging,
+    Column('id', Integer), Column('sequence', Integer), Column('title', String(200)), Column('description', Text),
+    Column('category_name', String(100)), Column('status', String(20)), Column('priority', Integer),
+    Column('creator_username', String(64)), Column('assigned_username', String(64)),
+    Column('created_at', DateTime(timezone=True)), Column('updated_at', DateTime(timezone=True)),
+    Column('due_date', DateTime(timezone=True)), Column('archived', Boolean),
+    Column('existing', Boolean, default=False),
+    prefixes=['TEMPORARY'])
+
+restore_ticket_comment = Table(
+    'restore_ticket_comment', staging,
+    Column('id', Integer), Column('sequence', Integer), Column('ticket_id', Integer), Column('username', String(64)),
+    Column('content', Text), Column('created_at', DateTime(timezone=True)),
+    Column('updated_at', DateTime(timezone=True)),
+    prefixes=['TEMPORARY'])
+
+restore_ticket_history = Table(
+    'restore_ticket_history', staging,
+    Column('id', Integer), Column('sequence', Integer), Column('ticket_id', Integer), Column('username', String(64)),
+    Column('action', String(50)), Column('details', Text), Column('created_at', DateTime(timezone=True)),
+    prefixes=['TEMPORARY'])
+
+restore_deleted = Table(
+    'restore_deleted', staging,
+    Column('table_name', String(50)), Column('record_id', Integer), Column('sequence', Integer),
+    prefixes=['TEMPORARY'])
+
+
+@dataclass
+class SectionCounts:
+    restored: int = 0
+    skipped: int = 0
+
+
+def _parse_datetime(value) -> Optional[datetime]:
+    if not value:
+        return None
+    # Columnar backups hold datetimes already decoded
+    parsed = value if isinstance(value, datetime) else datetime.fromisoformat(value)
+    return parsed.astimezone(pytz.UTC) if parsed.tzinfo else parsed
+
+
+def _stage_user(data: dict) -> Optional[dict]:
+    if not data.get('username') or not data.get('email') or not data.get('password_hash'):
+        return None
+    return {
+        'backup_id': data.get('id'),
+        'username': data['username'],
+        'email': data['email'],
+        'password_hash': data['password_hash'],
+        'color': data.get('color', '#3498db'),
+        'is_admin': data.get('is_admin', False),
+        'timezone': data.get('timezone', 'America/Los_Angeles')
+    }
+
+
+def _stage_location(data: dict) -> Optional[dict]:
+    if not data.get('name'):
+        return None
+    return {
+        'backup_id': data.get('id'),
+        'name': data['name'],
+        'description': data.get('description', ''),
+        'active': data.get('active', True)
+    }
+
+
+def _stage_schedule(data: dict) -> Optional[dict]:
+    if not data.get('technician_username'):
+        return None
+    start_time, end_time = _parse_datetime(data['start_time']), _parse_datetime(data['end_time'])
+    if end_time - start_time > MAX_SHIFT_LENGTH:
+        # Overlap queries could never find it
+        logger.warning(f"Skipping schedule {data.get('id')} longer than {MAX_SHIFT_LENGTH}")
+        return None
+    return {
+        'backup_id': data.get('id'),
+        'technician_username': data['technician_username'],
+        'location_name': data.get('location_name'),
+        'start_time': start_time,
+        'end_time': end_time,
+        'description': data.get('description'),
+        'time_off': data.get('time_off', False)
+    }
+
+
+def _stage_schedule_rule(data: dict) -> Optional[dict]:
+    if not data.get('technician_username') or not data.get('weekdays'):
+        return None
+    return {
+        'backup_id': data.get('id'),
+        'technician_username': data['technician_username'],
+        'location_name': data.get('location_name'),
+        'description': data.get('description'),
+        'time_off': data.get('time_off', False),
+        'weekdays': data['weekdays'],
+        'start_time': time.fromisoformat(data['shift_start']),
+        'end_time': time.fromisoformat(data['shift_end']),
+        'timezone': data.get('timezone') or 'UTC',
+        'start_date': date.fromisoformat(data['start_date']),
+        'until_date': date.fromisoformat(data['until_date']) if data.get('until_date') else None,
+        'exceptions': data.get('exceptions') or ''
+    }
+
+
+def _stage_quick_link(data: dict) -> Optional[dict]:
+    if not data.get('title') or not data.get('url'):
+        return None
+    return {
+        'backup_id': data.get('id'),
+        'title': data['title'],
+        'url': data['url'],
+        'icon': data.get('icon', 'link'),
+        'category': data.get('category', 'Uncategorized'),
+        'order': data.get('order', 0)
+    }
+
+
+def _stage_ticket_category(data: dict) -> Optional[dict]:
+    if not data.get('name'):
+        return None
+    return {
+        'backup_id': data.get('id'),
+        'name': data['name'],
+        'description': data.get('description', ''),
+        'icon': data.get('icon', 'help-circle'),
+        'priority_level': data.get('priority_level', 0)
+    }
+
+
+def _stage_ticket(data: dict) -> Optional[dict]:
+    # Tickets keep their original ids, which their comments and history refer to
+    if not data.get('id') or not data.get('title') or not data.get('description'):
+        return None
+    return {
+        'id': data['id'],
+        'title': data['title'],
+        'description': data['description'],
+        'category_name': data.get('category_name'),
+        'status': data.get('status', TicketStatus.OPEN),
+        'priority': data.get('priority', 0),
+        'creator_username': data.get('creator_username'),
+        'assigned_username': data.get('assigned_username'),
+        'created_at': _parse_datetime(data.get('created_at')),
+        'updated_at': _parse_datetime(data.get('updated_at')),
+        'due_date': _parse_datetime(data.get('due_date')),
+        'archived': data.get('archived', False)
+    }
+
+
+def _stage_comment(ticket_id: int, data: dict) -> dict:
+    return {
+        'id': data.get('id'),
+        'ticket_id': ticket_id,
+        'username': data.get('username'),
+        'content': data.get('content', ''),
+        'created_at': _parse_datetime(data.get('created_at')),
+        'updated_at': _parse_datetime(data.get('updated_at'))
+    }
+
+
+def _stage_ticket_comment(data: dict) -> dict:
+    return _stage_comment(data.get('ticket_id'), data)
+
+
+def _stage_ticket_history(data: dict) -> dict:
+    return _stage_history(data.get('ticket_id'), data)
+
+
+def _stage_deleted(data: dict) -> Optional[dict]:
+    if not data.get('table') or not data.get('id'):
+        return None
+    return {'table_name': data['table'], 'record_id': data['id']}
+
+
+def _stage_history(ticket_id: int, data: dict) -> dict:
+    return {
+        'id': data.get('id'),
+        'ticket_id': ticket_id,
+        'username': data.get('username'),
+        'action': data.get('action', ''),
+        'details': data.get('details', ''),
+        'created_at': _parse_datetime(data.get('created_at'))
+    }
+
+
+# Backup section -> (staging table, row conversion); rows converted to None are skipped
+STAGED_SECTIONS = {
+    'users': (restore_user, _stage_user),
+    'locations': (restore_location, _stage_location),
+    'schedules': (restore_schedule, _stage_schedule),
+    'schedule_rules': (restore_schedule_rule, _stage_schedule_rule),
+    'quick_links': (restore_quick_link, _stage_quick_link),
+    'ticket_categories': (restore_ticket_category, _stage_ticket_category),
+    'tickets': (restore_ticket, _stage_ticket),
+    # Columnar backups hold ticket comments and history as sections of their own
+    'ticket_comments': (restore_ticket_comment, _stage_ticket_comment),
+    'ticket_history': (restore_ticket_history, _stage_ticket_history),
+    'deleted': (restore_deleted, _stage_deleted),
+}
+
+
+class _Stager:
+    """Buffer staged rows and insert them into the staging tables in batches"""
+
+    def __init__(self):
+        self.pending: Dict[Table, List[dict]] = defaultdict(list)
+        self.staged: Dict[Table, int] = defaultdict(int)
+        self.sequence = 0  # Position in the chain of the backup being staged
+
+    def add(self, table: Table, row: dict) -> None:
+        row['sequence'] = self.sequence
+        self.pending[table].append(row)
+        self.staged[table] += 1
+        if len(self.pending[table]) >= RESTORE_BATCH_SIZE:
+            self.flush(table)
+
+    def flush(self, table: Optional[Table] = None) -> None:
+        for pending_table in ([table] if table is not None else list(self.pending)):
+            rows = self.pending.pop(pending_table, None)
+            if rows:
+                db.session.execute(pending_table.insert(), rows)
+
+
+def _insert_ignoring_conflicts(model):
+    """INSERT ... ON CONFLICT DO NOTHING for the configured database"""
+    dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    return dialect.insert(model).on_conflict_do_nothing()
+
+
+def _merge_users() -> int:
+    staged = restore_user.c
+    existing = aliased(User)
+    source = select(staged.username, staged.email, staged.password_hash, staged.color,
+                    staged.is_admin, staged.timezone) \
+        .where(~select(existing.id).where(db.func.lower(existing.username) == db.func.lower(staged.username)).exists())
+    result = db.session.execute(_insert_ignoring_conflicts(User).from_select(
+        ['username', 'email', 'password_hash', 'color', 'is_admin', 'timezone'], source))
+    return result.rowcount
+
+
+def _merge_locations() -> int:
+    staged = restore_location.c
+    source = select(staged.name, staged.description, staged.active, db.func.now(), db.func.now()) \
+        .where(~select(Location.id).where(db.func.lower(Location.name) == db.func.lower(staged.name)).exists())
+    result = db.session.execute(_insert_ignoring_conflicts(Location).from_select(
+        ['name', 'description', 'active', 'created_at', 'updated_at'], source))
+    return result.rowcount
+
+
+def _merge_schedules() -> int:
+    staged = restore_schedule.c
+    existing = aliased(Schedule)
+    source = (select(User.id, Location.id, staged.start_time, staged.end_time,
+                     staged.description, staged.time_off, db.func.now())
+        .select_from(restore_schedule)
+        .join(User, User.username == staged.technician_username)
+        .outerjoin(Location, Location.name == staged.location_name)
+        .where(~select(existing.id).where(
+            existing.technician_id == User.id,
+            existing.start_time == staged.start_time,
+            existing.end_time == staged.end_time,
+            existing.location_id.is_not_distinct_from(Location.id)
+        ).exists())
+        .distinct())
+    result = db.session.execute(db.insert(Schedule).from_select(
+        ['technician_id', 'location_id', 'start_time', 'end_time', 'description', 'time_off', 'created_at'],
+        source))
+    return result.rowcount
+
+
+def _merge_schedule_rules() -> int:
+    staged = restore_schedule_rule.c
+    existing = aliased(ScheduleRule)
+    source = (select(User.id, Location.id, staged.description, staged.time_off, staged.weekdays,
+                     staged.start_time, staged.end_time, staged.timezone, staged.start_date,
+                     staged.until_date, staged.exceptions, db.func.now())
+        .select_from(restore_schedule_rule)
+        .join(User, User.username == staged.technician_username)
+        .outerjoin(Location, Location.name == staged.location_name)
+        .where(~select(existing.id).where(
+            existing.technician_id == User.id,
+            existing.weekdays == staged.weekdays,
+            existing.start_time == staged.start_time,
+            existing.end_time == staged.end_time,
+            existing.start_date == staged.start_date,
+            existing.location_id.is_not_distinct_from(Location.id)
+        ).exists())
+        .distinct())
+    result = db.session.execute(db.insert(ScheduleRule).from_select(
+        ['technician_id', 'location_id', 'description', 'time_off', 'weekdays', 'start_time', 'end_time',
+         'timezone', 'start_date', 'until_date', 'exceptions', 'created_at'],
+        source))
+    return result.rowcount
+
+
+def _merge_quick_links() -> int:
+    staged = restore_quick_link.c
+    source = (select(staged.title, staged.url, staged.icon, staged.category, staged.order,
+                     db.func.now(), db.func.now())
+        .where(~select(QuickLink.id).where(
+            db.func.lower(QuickLink.title) == db.func.lower(staged.title),
+            db.func.lower(QuickLink.url) == db.func.lower(staged.url)
+        ).exists())
+        .distinct())
+    result = db.session.execute(db.insert(QuickLink).from_select(
+        ['title', 'url', 'icon', 'category', 'order', 'created_at', 'updated_at'], source))
+    return result.rowcount
+
+
+def _merge_ticket_categories() -> int:
+    staged = restore_ticket_category.c
+    source = select(staged.name, staged.description, staged.icon, staged.priority_level, db.func.now()) \
+        .where(~select(TicketCategory.id).where(
+            db.func.lower(TicketCategory.name) == db.func.lower(staged.name)).exists())
+    result = db.session.execute(_insert_ignoring_conflicts(TicketCategory).from_select(
+        ['name', 'description', 'icon', 'priority_level', 'created_at'], source))
+    return result.rowcount
+
+
+def _system_user_id(children: List[Table]) -> Optional[int]:
+    """Id of the System user that comments and history fall back to, created only when needed"""
+    needs_fallback = False
+    for table in children:
+        orphaned = select(table.c.ticket_id) \
+            .outerjoin(User, User.username == table.c.username) \
+            .where(User.id.is_(None)).exists()
+        needs_fallback = needs_fallback or db.session.scalar(select(orphaned))
+    if not needs_fallback:
+        return None
+
+    system_user = User.query.filter_by(username="System").first()
+    if not system_user:
+        system_user = User(username="System", email="system@example.com", is_admin=False)
+        system_user.set_password(''.join(random.choice(string.ascii_letters + string.digits) for _ in range(20)))
+        db.session.add(system_user)
+        db.session.flush()
+    return system_user.id
+
+
+def _merge_ticket_children(model, table: Table, columns: List[str], system_user_id: Optional[int]) -> None:
+    staged = table.c
+    restored = restore_ticket.c
+    values = [getattr(staged, column) for column in columns]
+    for keep_ids in (True, False):
+        # Entries keep their original ids when the backup has them
+        source = (select(*([staged.id] if keep_ids else []), staged.ticket_id,
+                         db.func.coalesce(User.id, system_user_id), *values)
+            .select_from(table)
+            .join(restore_ticket, restored.id == staged.ticket_id)
+            .join(Ticket, Ticket.id == staged.ticket_id)
+            .outerjoin(User, User.username == staged.username)
+            .where(~restored.existing, staged.id.is_not(None) if keep_ids else staged.id.is_(None)))
+        db.session.execute(_insert_ignoring_conflicts(model).from_select(
+            (['id'] if keep_ids else []) + ['ticket_id', 'user_id'] + columns, source))
+
+
+def _merge_tickets() -> int:
+    staged = restore_ticket.c
+    # Comments and history are only restored for tickets this restore creates
+    db.session.execute(restore_ticket.update().values(
+        existing=select(Ticket.id).where(Ticket.id == staged.id).exists()))
+
+    creator = aliased(User)
+    assignee = aliased(User)
+    source = (select(staged.id, staged.title, staged.description, TicketCategory.id, staged.status,
+                     staged.priority, assignee.id, creator.id,
+                     db.func.coalesce(staged.created_at, db.func.now()),
+                     db.func.coalesce(staged.updated_at, db.func.now()),
+                     staged.due_date, staged.archived)
+        .select_from(restore_ticket)
+        .join(TicketCategory, TicketCategory.name == staged.category_name)
+        .join(creator, creator.username == staged.creator_username)
+        .outerjoin(assignee, assignee.username == staged.assigned_username)
+        .where(~staged.existing))
+    result = db.session.execute(_insert_ignoring_conflicts(Ticket).from_select(
+        ['id', 'title', 'description', 'category_id', 'status', 'priority', 'assigned_to', 'created_by',
+         'created_at', 'updated_at', 'due_date', 'archived'], source))
+
+    system_user_id = _system_user_id([restore_ticket_comment, restore_ticket_history])
+    _merge_ticket_children(TicketComment, restore_ticket_comment,
+                           ['content', 'created_at', 'updated_at'], system_user_id)
+    _merge_ticket_children(TicketHistory, restore_ticket_history,
+                           ['action', 'details', 'created_at'], system_user_id)
+
+    if db.engine.dialect.name == 'postgresql':
+        # Rows were inserted with explicit ids, so move the sequences past them
+        for model in (Ticket, TicketComment, TicketHistory):
+            table_name = model.__tablename__
+            db.session.execute(db.text(
+                f"SELECT setval(pg_get_serial_sequence('{table_name}', 'id'), "
+                f"COALESCE((SELECT MAX(id) FROM {table_name}), 0) + 1, false)"))
+    return result.rowcount
+
+
+# Merge order follows the foreign keys between sections
+MERGES: List[Tuple[str, Table, Callable[[], int]]] = [
+    ('users', restore_user, _merge_users),
+    ('locations', restore_location, _merge_locations),
+    ('schedules', restore_schedule, _merge_schedules),
+    ('schedule_rules', restore_schedule_rule, _merge_schedule_rules),
+    ('quick_links', restore_quick_link, _merge_quick_links),
+    ('ticket_categories', restore_ticket_category, _merge_ticket_categories),
+    ('tickets', restore_ticket, _merge_tickets),
+]
+
+
+def _restore_email_settings(settings_data: dict) -> None:
+    settings = EmailSettings.query.first()
+    if not settings:
+        settings = EmailSettings()
+        db.session.add(settings)
+
+    settings.admin_email_group = settings_data.get('admin_email_group', 'alerts@obedtv.com')
+    settings.notify_on_create = settings_data.get('notify_on_create', True)
+    settings.notify_on_update = settings_data.get('notify_on_update', True)
+    settings.notify_on_delete = settings_data.get('notify_on_delete', True)
+    settings.digest_minutes = settings_data.get('digest_minutes', 0)
+
+
+def _backup_header(stream) -> dict:
+    """Read a backup's header and rewind it; backups made before headers existed are full"""
+    reader = open_backup_reader(stream)
+    if 'backup' not in reader.values:
+        for _ in reader.sections():
+            break  # The header comes before the first table
+    stream.seek(0)
+    return reader.values.get('backup') or {'type': 'full'}
+
+
+def _order_chain(backups: List[Tuple[dict, object]]) -> list:
+    """Put a full backup and its incrementals in the order they were taken, checking for gaps"""
+    full = [backup for backup in backups if backup[0].get('type') != 'incremental']
+    if len(full) != 1:
+        raise ValueError('Restore one full backup, optionally followed by incremental backups taken after it')
+    incrementals = sorted((backup for backup in backups if backup[0].get('type') == 'incremental'),
+                          key=lambda backup: backup[0].get('watermark') or '')
+
+    previous = _parse_datetime(full[0][0].get('watermark'))
+    for header, _ in incrementals:
+        since = _parse_datetime(header.get('since'))
+        if previous is None or since is None or since > previous:
+            raise ValueError(f"The incremental backup of changes since {header.get('since')} "
+                             f"does not continue from the backups before it")
+        previous = _parse_datetime(header.get('watermark'))
+    return [full[0][1]] + [stream for _, stream in incrementals]
+
+
+def _collapse_chain(table: Table) -> int:
+    """
+    Drop staged rows replaced by a later backup in the chain, or deleted
+    after the backup they came from. Returns the number of rows dropped.
+    """
+    key = table.c.id if 'id' in table.c else table.c.backup_id
+    newer = table.alias('newer')
+    replaced = select(newer.c.sequence).where(newer.c[key.name] == key,
+                                              newer.c.sequence > table.c.sequence).exists()
+    deleted = select(restore_deleted.c.sequence).where(
+        restore_deleted.c.table_name == table.name[len('restore_'):],
+        restore_deleted.c.record_id == key,
+        restore_deleted.c.sequence >= table.c.sequence).exists()
+    result = db.session.execute(table.delete().where(key.is_not(None), or_(replaced, deleted)))
+    return result.rowcount
+
+
+def restore_backup_stream(stream, progress: Optional[Callable] = None) -> Dict[str, SectionCounts]:
+    """Merge a single full backup into the database; see restore_backup_chain()"""
+    return restore_backup_chain([stream], progress)
+
+
+def restore_backup_chain(streams: list, progress: Optional[Callable] = None) -> Dict[str, SectionCounts]:
+    """
+    Merge a full backup, and any incremental backups taken after it, into the
+    database and return restored/skipped counts per section. Existing rows are
+    kept and matching backup rows skipped. The caller commits (or rolls back
+    on error). progress(done, total, message) is called after each entity is
+    merged. Raises ValueError if the backups do not form a chain.
+    """
+    if len(streams) > 1:
+        streams = _order_chain([(_backup_header(stream), stream) for stream in streams])
+
+    connection = db.session.connection()
+    for table in staging.sorted_tables:
+        table.drop(connection, checkfirst=True)  # Left over from a failed restore on this connection
+        table.create(connection)
+
+    counts = {name: SectionCounts() for name in STAGED_SECTIONS}
+    stager = _Stager()
+    for sequence, stream in enumerate(streams):
+        stager.flush()
+        stager.sequence = sequence
+        for name, rows in open_backup_reader(stream).sections():
+            if name == 'email_settings':
+                for settings_data in rows:
+                    _restore_email_settings(settings_data)
+                    break  # Only one settings row is kept
+                continue
+            if name not in STAGED_SECTIONS:
+                logger.warning(f"Ignoring unknown backup section {name}")
+                continue
+
+            table, convert = STAGED_SECTIONS[name]
+            for data in rows:
+                try:
+                    row = convert(data)
+                except (KeyError, TypeError, ValueError) as e:
+                    logger.warning(f"Skipping malformed {name} row: {str(e)}")
+                    row = None
+                if row is None:
+                    counts[name].skipped += 1
+                    continue
+                stager.add(table, row)
+                if name == 'tickets':
+                    for comment_data in data.get('comments') or []:
+                        stager.add(restore_ticket_comment, _stage_comment(row['id'], comment_data))
+                    for history_data in data.get('history') or []:
+                        stager.add(restore_ticket_history, _stage_history(row['id'], history_data))
+    stager.flush()
+
+    replaced = defaultdict(int)
+    if len(streams) > 1:
+        for table in staging.sorted_tables:
+            if table is not restore_deleted:
+                replaced[table] = _collapse_chain(table)
+
+    for index, (name, table, merge) in enumerate(MERGES):
+        restored = merge()
+        counts[name].restored = restored
+        counts[name].skipped += stager.staged[table] - replaced[table] - restored
+        logger.info(f"Restored {restored} {name}, skipped {counts[name].skipped}")
+        if progress:
+            progress(index + 1, len(MERGES), f"Restored {restored} {name.replace('_', ' ')}")
+
+    for table in reversed(staging.sorted_tables):
+        table.drop(connection)
+    return counts
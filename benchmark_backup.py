@@ -0,0 +1,93 @@
+"""
+Compare backup formats: size, dump time and restore time for JSON, gzipped
+JSON and the columnar archive.
+
+Runs against a throwaway in-memory SQLite database filled with generated
+data, never the configured DATABASE_URL:
+
+    python benchmark_backup.py --schedules 50000 --tickets 5000
+"""
+import argparse
+import os
+import time
+from datetime import datetime, timedelta
+from io import BytesIO
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+import pytz
+
+from app import app, db
+from models import User, Location, Schedule, TicketCategory, Ticket, TicketComment, TicketHistory
+from backup_utils import generate_backup, restore_backup_stream, write_columnar_backup
+
+
+def seed(schedule_count, ticket_count):
+    db.drop_all()
+    db.create_all()
+    users = [User(username=f'tech{i}', email=f'tech{i}@example.com', password_hash='x' * 100) for i in range(25)]
+    locations = [Location(name=f'Location {i}') for i in range(5)]
+    category = TicketCategory(name='Hardware')
+    db.session.add_all(users + locations + [category])
+    db.session.flush()
+
+    start = datetime(2025, 1, 6, tzinfo=pytz.UTC)
+    db.session.execute(db.insert(Schedule), [{
+        'technician_id': users[i % len(users)].id,
+        'location_id': locations[i % len(locations)].id,
+        'start_time': start + timedelta(hours=8 * (i // len(users))),
+        'end_time': start + timedelta(hours=8 * (i // len(users)) + 8),
+        'description': 'ON-CALL' if i % 7 == 0 else None,
+        'created_at': start,
+    } for i in range(schedule_count)])
+    db.session.execute(db.insert(Ticket), [{
+        'title': f'Ticket {i}',
+        'description': f'Problem report number {i}',
+        'category_id': category.id,
+        'created_by': users[0].id,
+        'assigned_to': users[1 + i % (len(users) - 1)].id,
+    } for i in range(ticket_count)])
+    ticket_ids = db.session.scalars(db.select(Ticket.id)).all()
+    db.session.execute(db.insert(TicketComment), [
+        {'ticket_id': ticket_id, 'user_id': users[0].id, 'content': content}
+        for ticket_id in ticket_ids for content in ('First look', 'Fixed')])
+    db.session.execute(db.insert(TicketHistory), [
+        {'ticket_id': ticket_id, 'user_id': users[0].id, 'action': 'created'} for ticket_id in ticket_ids])
+    db.session.commit()
+
+
+def dump(backup_format):
+    if backup_format == 'columnar':
+        output = BytesIO()
+        write_columnar_backup(output)
+        return output.getvalue()
+    return b''.join(generate_backup(compress=backup_format == 'json.gz'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--schedules', type=int, default=20000)
+    parser.add_argument('--tickets', type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'format':<10} {'size':>12} {'dump (s)':>10} {'restore (s)':>12}")
+    with app.app_context():
+        for backup_format in ('json', 'json.gz', 'columnar'):
+            seed(args.schedules, args.tickets)
+            started = time.perf_counter()
+            data = dump(backup_format)
+            dumped = time.perf_counter() - started
+
+            # Restore into an empty database so every row is written
+            db.drop_all()
+            db.create_all()
+            started = time.perf_counter()
+            restore_backup_stream(BytesIO(data))
+            db.session.commit()
+            restored = time.perf_counter() - started
+            assert Schedule.query.count() == args.schedules
+
+            print(f"{backup_format:<10} {len(data):>12,} {dumped:>10.2f} {restored:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
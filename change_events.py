@@ -0,0 +1,84 @@
+"""
+Commit-time change notifications for models.
+
+Callbacks registered with on_model_change() run after a commit that inserted,
+updated or deleted rows of that model. ORM flushes and Query.update()/delete()
+are tracked automatically; raw SQL writes must call notify_model_change().
+
+A callback may pass when=predicate to only fire for flushed objects matching
+it. Bulk writes can't be inspected per row, so they always fire.
+"""
+import logging
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+_callbacks: Dict[type, List[Tuple[Callable[[], None], Optional[Callable[[object], bool]]]]] = defaultdict(list)
+
+
+def on_model_change(model: type, callback: Callable[[], None],
+                    when: Optional[Callable[[object], bool]] = None) -> Callable[[], None]:
+    """
+    Register a callback to run after any commit that changes rows of model.
+    If when is given, flushed objects only trigger the callback if when(obj) is true.
+    """
+    _callbacks[model].append((callback, when))
+    return callback
+
+
+def _run_callbacks(callbacks) -> None:
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            logger.error(f"Error in change callback {getattr(callback, '__name__', callback)}: {str(e)}")
+
+
+def notify_model_change(model: type) -> None:
+    """Run every change callback registered for model"""
+    _run_callbacks([callback for callback, _ in _callbacks.get(model, [])])
+
+
+def _mark_changed(session, model, obj=None):
+    pending = session.info.setdefault('pending_change_callbacks', [])
+    for callback, when in _callbacks.get(model, ()):
+        if callback in pending:
+            continue
+        if obj is None or when is None or _matches(when, obj):
+            pending.append(callback)
+
+
+def _matches(when, obj) -> bool:
+    try:
+        return bool(when(obj))
+    except Exception:
+        # e.g. an expired attribute on a deleted row; err on the side of notifying
+        return True
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_flush(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        _mark_changed(session, type(obj), obj)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _track_bulk_write(orm_execute_state):
+    # Query.delete()/update() and bulk inserts bypass the flush
+    if (orm_execute_state.is_delete or orm_execute_state.is_update or orm_execute_state.is_insert) \
+            and orm_execute_state.bind_mapper is not None:
+        _mark_changed(orm_execute_state.session, orm_execute_state.bind_mapper.class_)
+
+
+@event.listens_for(Session, 'after_commit')
+def _notify_on_commit(session):
+    _run_callbacks(session.info.pop('pending_change_callbacks', ()))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_on_rollback(session):
+    session.info.pop('pending_change_callbacks', None)
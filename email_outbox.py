@@ -0,0 +1,336 @@
+"""
+Persistent email outbox.
+
+Routes never talk to SendGrid themselves: enqueue_email() records an
+OutboxEmail row (on its own connection, so it is kept whatever happens to the
+request's transaction) and wakes a background dispatcher thread. The
+dispatcher sends due emails in small batches and retries failures with
+exponential backoff, giving up after OUTBOX_MAX_ATTEMPTS or on an error
+SendGrid reports as permanent. Rows are claimed with FOR UPDATE SKIP LOCKED
+and leased by pushing next_attempt_at out, so several app processes can share
+one outbox without sending twice and no transaction stays open during a send.
+
+Notifications that arrive in bursts (a week of repeat-day schedules, rapid
+ticket edits) are coalesced instead: hold_for_digest() keeps a
+PendingNotification per recipient until that recipient's digest window has
+passed since the first one held, and the dispatcher then turns everything
+held for them into one email. The window is the user's digest_minutes
+preference, or the EmailSettings default for users without one and for
+addresses (like the admin group) that are not users; 0 sends immediately.
+
+The transport is chosen by the EMAIL_TRANSPORT config value: SendGrid by
+default, or any object with a send(email) method, such as StubTransport
+in tests. With EMAIL_SEND_INLINE set, emails are dispatched inside
+enqueue_email() instead of by the thread.
+"""
+import json
+import logging
+import os
+import random
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import pytz
+from flask import current_app
+from sendgrid.helpers.mail import Mail
+
+from app import app, db
+from email_rendering import render_email
+from models import EmailStatus, OutboxEmail, PendingNotification, User
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FROM_EMAIL = 'alerts@obedtv.com'
+# Emails claimed per dispatcher pass
+OUTBOX_BATCH_SIZE = 20
+# Attempts before an email is marked failed
+OUTBOX_MAX_ATTEMPTS = 6
+# Delay before the first retry; doubled for each attempt after that, up to OUTBOX_MAX_BACKOFF
+OUTBOX_BASE_BACKOFF = timedelta(seconds=30)
+OUTBOX_MAX_BACKOFF = timedelta(hours=1)
+# The dispatcher also wakes this often (seconds) to pick up retries and other processes' emails
+OUTBOX_POLL_INTERVAL = 15
+SENDGRID_SEND_URL = 'https://api.sendgrid.com/v3/mail/send'
+# Kept-alive connections to SendGrid; the dispatcher sends from one thread, inline sends from request threads
+SENDGRID_POOL_SIZE = 4
+SENDGRID_TIMEOUT = 30  # seconds
+# How long a claimed email is left to the dispatcher that claimed it; longer than a whole batch can take to send
+OUTBOX_LEASE = timedelta(seconds=2 * OUTBOX_BATCH_SIZE * SENDGRID_TIMEOUT)
+# Recipients whose digests are built per dispatcher pass
+DIGEST_BATCH_SIZE = 50
+# Digest windows offered to users (minutes); None follows the site setting
+DIGEST_CHOICES = [(None, 'Site default'), (0, 'Immediately'), (15, 'Every 15 minutes'),
+                  (60, 'Hourly'), (1440, 'Daily')]
+
+
+class EmailDeliveryError(Exception):
+    """A send that failed; permanent errors are not retried"""
+
+    def __init__(self, message: str, permanent: bool = False):
+        super().__init__(message)
+        self.permanent = permanent
+
+
+class SendGridTransport:
+    """
+    Sends through the SendGrid API over one pooled HTTP session, so emails
+    after the first reuse an open TLS connection instead of handshaking again
+    """
+
+    def __init__(self, api_key: str):
+        # Only needed when actually sending through SendGrid
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self._session = requests.Session()
+        self._session.headers.update({'Authorization': f'Bearer {api_key}'})
+        self._session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=SENDGRID_POOL_SIZE))
+
+    def send(self, email: OutboxEmail) -> None:
+        message = Mail(from_email=email.from_email, to_emails=email.recipient_list, subject=email.subject,
+                       html_content=email.html_content, plain_text_content=email.text_content)
+        response = self._session.post(SENDGRID_SEND_URL, json=message.get(), timeout=SENDGRID_TIMEOUT)
+        if response.status_code != 202:
+            # Rejected requests (bad sender, bad address) fail the same way every time
+            permanent = 400 <= response.status_code < 500 and response.status_code != 429
+            raise EmailDeliveryError(f"SendGrid error {response.status_code}: {response.text}", permanent=permanent)
+
+
+class StubTransport:
+    """Keeps sent emails in memory instead of sending them; fail_next makes sends fail"""
+
+    def __init__(self):
+        self.sent: List[dict] = []
+        self.fail_next = 0
+
+    def send(self, email: OutboxEmail) -> None:
+        if self.fail_next:
+            self.fail_next -= 1
+            raise EmailDeliveryError('Stub transport failure')
+        self.sent.append({'to': email.recipient_list, 'from': email.from_email,
+                          'subject': email.subject, 'html': email.html_content, 'text': email.text_content})
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    global _transport
+    configured = current_app.config.get('EMAIL_TRANSPORT')
+    if configured is not None:
+        return configured
+
+    with _transport_lock:
+        if _transport is None:
+            api_key = os.environ.get('SENDGRID_API_KEY')
+            if not api_key:
+                raise EmailDeliveryError('SendGrid API key is not set in environment variables')
+            _transport = SendGridTransport(api_key)
+    return _transport
+
+
+def _backoff(attempts: int) -> timedelta:
+    delay = min(OUTBOX_BASE_BACKOFF * 2 ** (attempts - 1), OUTBOX_MAX_BACKOFF)
+    # Spread retries out so a SendGrid outage does not end in a burst
+    return delay * random.uniform(0.8, 1.2)
+
+
+def _record_outcome(email_id: int, **values) -> None:
+    # Its own short transaction, so nothing stays open while the next email sends
+    with db.engine.begin() as connection:
+        connection.execute(db.update(OutboxEmail).where(OutboxEmail.id == email_id).values(**values))
+
+
+def dispatch_pending(now: Optional[datetime] = None, limit: int = OUTBOX_BATCH_SIZE) -> int:
+    """
+    Send the emails that are due, recording the outcome of each, and return
+    how many were claimed. The batch is claimed in one short transaction that
+    leases it for OUTBOX_LEASE, and sent after that commits, so no row locks
+    are held while SendGrid answers. Commits, so run it in its own app context.
+    """
+    now = now or datetime.now(pytz.UTC)
+    emails = (OutboxEmail.query
+              .filter(OutboxEmail.status == EmailStatus.PENDING, OutboxEmail.next_attempt_at <= now)
+              .order_by(OutboxEmail.next_attempt_at, OutboxEmail.id)
+              .limit(limit)
+              .with_for_update(skip_locked=True)
+              .all())
+    if not emails:
+        db.session.rollback()
+        return 0
+
+    for email in emails:
+        email.attempts += 1
+        # Another dispatcher skips it until the lease runs out, which only happens if this one dies mid-batch
+        email.next_attempt_at = now + OUTBOX_LEASE
+    db.session.flush()
+    for email in emails:
+        db.session.expunge(email)  # Keep what was loaded for sending; the commit would expire it
+    db.session.commit()
+
+    try:
+        transport = get_transport()
+    except EmailDeliveryError as e:
+        transport, transport_error = None, e
+
+    for email in emails:
+        try:
+            if transport is None:
+                raise transport_error
+            transport.send(email)
+        except Exception as e:
+            permanent = isinstance(e, EmailDeliveryError) and e.permanent
+            if permanent or email.attempts >= OUTBOX_MAX_ATTEMPTS:
+                _record_outcome(email.id, status=EmailStatus.FAILED, last_error=str(e))
+                logger.error(f"Giving up on email {email.id} ({email.subject}) after {email.attempts} attempts: {str(e)}")
+            else:
+                retry_at = now + _backoff(email.attempts)
+                _record_outcome(email.id, next_attempt_at=retry_at, last_error=str(e))
+                logger.warning(f"Email {email.id} failed (attempt {email.attempts}), retrying at {retry_at}: {str(e)}")
+        else:
+            _record_outcome(email.id, status=EmailStatus.SENT, sent_at=now)
+            logger.info(f"Sent email {email.id} to {email.recipient_list}: {email.subject}")
+    return len(emails)
+
+
+def digest_windows(recipients: List[str], default_minutes: int) -> Dict[str, int]:
+    """Digest window (minutes) for each recipient address"""
+    preferences = dict(db.session.execute(
+        db.select(User.email, User.digest_minutes)
+        .where(User.email.in_(recipients), User.digest_minutes.isnot(None))
+    ).all())
+    return {recipient: preferences.get(recipient, default_minutes) for recipient in recipients}
+
+
+def hold_for_digest(recipients: List[str], subject: str, html_content: str, text_content: Optional[str],
+                    default_minutes: int, now: Optional[datetime] = None) -> List[str]:
+    """
+    Hold a notification for the recipients who take digests, and return the
+    recipients it should be sent to straight away
+    """
+    now = now or datetime.now(pytz.UTC)
+    windows = digest_windows(recipients, default_minutes)
+    held = [recipient for recipient in recipients if windows[recipient]]
+    if held:
+        with db.engine.begin() as connection:
+            # A digest is due one window after the first notification held for it
+            due = dict(connection.execute(
+                db.select(PendingNotification.recipient, db.func.min(PendingNotification.send_after))
+                .where(PendingNotification.recipient.in_(held))
+                .group_by(PendingNotification.recipient)
+            ).all())
+            connection.execute(db.insert(PendingNotification), [{
+                'recipient': recipient,
+                'subject': subject,
+                'html_content': html_content,
+                'text_content': text_content,
+                'send_after': due.get(recipient) or now + timedelta(minutes=windows[recipient])
+            } for recipient in held])
+        logger.info(f"Held '{subject}' for the digests of {held}")
+    return [recipient for recipient in recipients if not windows[recipient]]
+
+
+def _digest(notifications: List[PendingNotification]):
+    """The email for one recipient's held notifications"""
+    if len(notifications) == 1:
+        return notifications[0]
+    return render_email('digest', notifications=notifications)
+
+
+def flush_digests(now: Optional[datetime] = None, limit: int = DIGEST_BATCH_SIZE) -> int:
+    """
+    Queue one outbox email per recipient whose digest is due, holding
+    everything held for them, and return how many were queued. Commits, so run
+    it in its own app context.
+    """
+    now = now or datetime.now(pytz.UTC)
+    due = db.session.scalars(
+        db.select(PendingNotification.recipient)
+        .where(PendingNotification.send_after <= now)
+        .distinct()
+        .limit(limit)
+    ).all()
+    held = (PendingNotification.query
+            .filter(PendingNotification.recipient.in_(due))
+            .order_by(PendingNotification.id)
+            .with_for_update(skip_locked=True)
+            .all()) if due else []
+    if not held:
+        db.session.rollback()
+        return 0
+
+    by_recipient = defaultdict(list)
+    for notification in held:
+        by_recipient[notification.recipient].append(notification)
+    for recipient, notifications in by_recipient.items():
+        digest = _digest(notifications)
+        db.session.add(OutboxEmail(recipients=json.dumps([recipient]), from_email=DEFAULT_FROM_EMAIL,
+                                   subject=digest.subject, html_content=digest.html_content,
+                                   text_content=digest.text_content))
+    db.session.execute(db.delete(PendingNotification)
+                       .where(PendingNotification.id.in_([notification.id for notification in held])))
+    db.session.commit()
+    logger.info(f"Queued digests for {list(by_recipient)}")
+    return len(by_recipient)
+
+
+_wakeup = threading.Event()
+_dispatcher: Optional[threading.Thread] = None
+_dispatcher_lock = threading.Lock()
+
+
+def _dispatch_forever() -> None:
+    while True:
+        _wakeup.wait(OUTBOX_POLL_INTERVAL)
+        _wakeup.clear()
+        try:
+            with app.app_context():
+                while flush_digests() == DIGEST_BATCH_SIZE:
+                    pass
+                while dispatch_pending() == OUTBOX_BATCH_SIZE:
+                    pass  # More may be due
+        except Exception as e:
+            logger.error(f"Error dispatching emails: {str(e)}")
+
+
+def start_dispatcher() -> None:
+    """Start the background dispatcher thread for this process, once"""
+    global _dispatcher
+    if current_app.config.get('EMAIL_SEND_INLINE'):
+        return
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = threading.Thread(target=_dispatch_forever, name='email-outbox', daemon=True)
+            _dispatcher.start()
+            _wakeup.set()  # Send whatever was left over from before a restart
+
+
+def enqueue_email(to_emails: List[str], subject: str, html_content: str,
+                  from_email: str = DEFAULT_FROM_EMAIL, text_content: Optional[str] = None) -> int:
+    """Queue an email for the dispatcher and return its outbox id"""
+    with db.engine.begin() as connection:
+        email_id = connection.execute(db.insert(OutboxEmail).values(
+            recipients=json.dumps(list(to_emails)),
+            from_email=from_email,
+            subject=subject,
+            html_content=html_content,
+            text_content=text_content
+        ).returning(OutboxEmail.id)).scalar_one()
+
+    if current_app.config.get('EMAIL_SEND_INLINE'):
+        # A separate app context (and session) leaves the caller's transaction alone
+        with app.app_context():
+            dispatch_pending()
+    else:
+        start_dispatcher()
+        _wakeup.set()
+    return email_id
+
+
+@app.before_request
+def _ensure_dispatcher():
+    if _dispatcher is None:
+        start_dispatcher()
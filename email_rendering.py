@@ -0,0 +1,127 @@
+"""
+Notification email rendering.
+
+Every notification has an HTML template and a plain-text alternate under
+templates/email, compiled once per process. Templates only see the plain
+context objects built here (ScheduleContext, TicketContext), which are filled
+in before rendering, so rendering never touches the database and one context
+can be rendered for many recipients or folded into a digest.
+"""
+import os
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+import pytz
+from jinja2 import Environment, FileSystemLoader, Template, select_autoescape
+
+EMAIL_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'email')
+PRIORITY_LABELS = {0: 'Low', 1: 'Medium', 2: 'High', 3: 'Urgent'}
+# Subject line for each notification; the bodies are <name>.html and <name>.txt
+EMAIL_SUBJECTS = {
+    'schedule_changed': 'Schedule {{ action }} for {{ schedule.technician }}',
+    'ticket_assigned': 'Ticket #{{ ticket.id }} has been assigned to you',
+    'ticket_comment': 'New comment on Ticket #{{ ticket.id }}',
+    'ticket_status': 'Status changed on Ticket #{{ ticket.id }}',
+    'digest': 'Digest of {{ notifications|length }} notifications',
+}
+
+_environment = Environment(
+    loader=FileSystemLoader(EMAIL_TEMPLATE_DIR),
+    autoescape=select_autoescape(['html'], default_for_string=False),
+    trim_blocks=True,
+    lstrip_blocks=True
+)
+_environment.filters['status_label'] = lambda status: (status or '').replace('_', ' ').title()
+_environment.filters['datetime'] = lambda value: value.strftime('%Y-%m-%d %H:%M')
+
+_templates: Dict[str, Tuple[Template, Template, Template]] = {
+    name: (_environment.from_string(subject),
+           _environment.get_template(f'{name}.html'),
+           _environment.get_template(f'{name}.txt'))
+    for name, subject in EMAIL_SUBJECTS.items()
+}
+
+
+@dataclass(frozen=True)
+class RenderedEmail:
+    subject: str
+    html_content: str
+    text_content: str
+
+
+@dataclass(frozen=True)
+class ScheduleContext:
+    technician: str
+    technician_email: str
+    start_time: datetime
+    end_time: datetime
+    location: Optional[str]
+    description: Optional[str]
+
+    @classmethod
+    def from_schedule(cls, schedule) -> 'ScheduleContext':
+        return cls(
+            technician=schedule.technician.username,
+            technician_email=schedule.technician.email,
+            start_time=schedule.start_time,
+            end_time=schedule.end_time,
+            location=schedule.location.name if schedule.location else None,
+            description=schedule.description
+        )
+
+    @classmethod
+    def from_rule(cls, rule) -> 'ScheduleContext':
+        """A recurring rule, described by its first shift (in UTC, like stored schedules)"""
+        tz = rule.get_timezone()
+        start = tz.localize(datetime.combine(rule.start_date, rule.start_time))
+        end = tz.localize(datetime.combine(rule.start_date, rule.end_time))
+        if end <= start:
+            end = tz.localize(datetime.combine(rule.start_date + timedelta(days=1), rule.end_time))
+        return cls(
+            technician=rule.technician.username,
+            technician_email=rule.technician.email,
+            start_time=start.astimezone(pytz.UTC),
+            end_time=end.astimezone(pytz.UTC),
+            location=rule.location.name if rule.location else None,
+            description=rule.description
+        )
+
+
+@dataclass(frozen=True)
+class TicketContext:
+    id: int
+    title: str
+    description: str
+    status: str
+    priority: str
+    category: str
+    url: str
+    assignee: Optional[str]
+    assignee_email: Optional[str]
+
+    @classmethod
+    def from_ticket(cls, ticket, base_url: str) -> 'TicketContext':
+        """Copy what the templates need, loading the category and assignee once"""
+        assignee = ticket.assigned_technician if ticket.assigned_to else None
+        return cls(
+            id=ticket.id,
+            title=ticket.title,
+            description=ticket.description,
+            status=ticket.status,
+            priority=PRIORITY_LABELS.get(ticket.priority, 'Unknown'),
+            category=ticket.category.name if ticket.category else 'Uncategorized',
+            url=f"{base_url}/tickets/{ticket.id}",
+            assignee=assignee.username if assignee else None,
+            assignee_email=assignee.email if assignee else None
+        )
+
+
+def render_email(name: str, **context) -> RenderedEmail:
+    """Render a notification's subject, HTML body and plain-text body"""
+    subject, html_template, text_template = _templates[name]
+    return RenderedEmail(
+        subject=subject.render(**context).strip(),
+        html_content=html_template.render(**context),
+        text_content=text_template.render(**context)
+    )
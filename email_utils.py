@@ -1,121 +1,133 @@
-import os
 import logging
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Email, To, Content
-from typing import List, Optional
-from models import Schedule, EmailSettings, Ticket, User, TicketComment
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import List, Optional, Union
+
+import pytz
+from models import Schedule, ScheduleRule, EmailSettings, Ticket, User, TicketComment
 from flask import current_app, url_for
+from app import db
+from change_events import on_model_change
+from email_outbox import DEFAULT_FROM_EMAIL, enqueue_email, hold_for_digest
+from email_rendering import RenderedEmail, ScheduleContext, TicketContext, render_email
 
 logger = logging.getLogger(__name__)
 
-def get_email_settings() -> EmailSettings:
-    """Get the current email settings or create default settings if none exist"""
-    settings = EmailSettings.query.first()
-    if not settings:
-        settings = EmailSettings()
-        current_app.db.session.add(settings)
-        current_app.db.session.commit()
-    return settings
+@dataclass(frozen=True)
+class EmailSettingsSnapshot:
+    admin_email_group: str
+    notify_on_create: bool
+    notify_on_update: bool
+    notify_on_delete: bool
+    digest_minutes: int
+
+class EmailSettingsCache:
+    """
+    Process-wide copy of the EmailSettings row.
+
+    Reloaded after a commit changes EmailSettings (saving the admin page,
+    restoring a backup) or after max_age, for changes made by other processes.
+    """
+
+    def __init__(self, max_age: timedelta = timedelta(minutes=5)):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._settings: Optional[EmailSettingsSnapshot] = None
+        self._loaded_at: Optional[datetime] = None
+
+    def get(self) -> EmailSettingsSnapshot:
+        now = datetime.now(pytz.UTC)
+        with self._lock:
+            if self._settings is None or now >= self._loaded_at + self.max_age:
+                self._settings = self._load()
+                self._loaded_at = now
+            return self._settings
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._settings = None
+            self._loaded_at = None
+
+    def _load(self) -> EmailSettingsSnapshot:
+        settings = EmailSettings.query.first()
+        if not settings:
+            # Its own transaction, so the caller's session is left alone
+            with db.engine.begin() as connection:
+                connection.execute(db.insert(EmailSettings))
+            settings = EmailSettings.query.first()
+        return EmailSettingsSnapshot(
+            admin_email_group=settings.admin_email_group,
+            notify_on_create=settings.notify_on_create,
+            notify_on_update=settings.notify_on_update,
+            notify_on_delete=settings.notify_on_delete,
+            digest_minutes=settings.digest_minutes or 0
+        )
+
+email_settings = EmailSettingsCache()
+on_model_change(EmailSettings, email_settings.invalidate)
+
+def get_email_settings() -> EmailSettingsSnapshot:
+    """Get the current email settings, creating default settings if none exist"""
+    return email_settings.get()
 
 def send_email(
     to_emails: List[str],
     subject: str,
     html_content: str,
-    from_email: str = 'alerts@obedtv.com'
+    from_email: str = DEFAULT_FROM_EMAIL,
+    text_content: Optional[str] = None
 ) -> bool:
     """
-    Send an email using SendGrid
-    Returns True if successful, False otherwise
+    Queue an email in the outbox; it is sent (and retried) in the background
+    Returns True if queued, False otherwise
     """
-    current_app.logger.info("=== Starting email sending process ===")
-    current_app.logger.info(f"Attempting to send email to {to_emails} with subject: {subject}")
-    
-    try:
-        # Get API key
-        api_key = os.environ.get('SENDGRID_API_KEY')
-        if not api_key:
-            current_app.logger.error("ERROR: SendGrid API key is not set in environment variables")
-            return False
-        
-        # Log first few characters of API key to confirm it's available (safely)
-        key_preview = api_key[:4] + '...' if len(api_key) > 4 else '***'
-        current_app.logger.info(f"Using SendGrid API key starting with: {key_preview}")
-        
-        # Check that we have recipients
-        if not to_emails or len(to_emails) == 0:
-            current_app.logger.error("ERROR: No recipients specified for email")
-            return False
-            
-        current_app.logger.info(f"Recipients: {to_emails}")
-        current_app.logger.info(f"From: {from_email}")
-        current_app.logger.info(f"Subject: {subject}")
-        
-        # Create the email message
-        current_app.logger.info("Creating SendGrid Mail object")
-        try:
-            message = Mail(
-                from_email=from_email,
-                to_emails=to_emails,
-                subject=subject,
-                html_content=html_content
-            )
-            current_app.logger.info("Mail object created successfully")
-        except Exception as mail_error:
-            current_app.logger.error(f"Error creating Mail object: {str(mail_error)}")
-            return False
+    if not to_emails:
+        current_app.logger.error("ERROR: No recipients specified for email")
+        return False
 
-        # Initialize SendGrid client
-        current_app.logger.info("Initializing SendGrid client")
-        try:
-            sg = SendGridAPIClient(api_key)
-            current_app.logger.info("SendGrid client initialized successfully")
-        except Exception as client_error:
-            current_app.logger.error(f"Error initializing SendGrid client: {str(client_error)}")
-            return False
-        
-        # Send the message
-        current_app.logger.info(f"Sending email from {from_email} to {to_emails}")
-        try:
-            response = sg.send(message)
-            current_app.logger.info(f"Got response with status code: {response.status_code}")
-            
-            # Check response status code
-            success = response.status_code == 202
-            if success:
-                current_app.logger.info(f"SUCCESS: Email sent successfully with status code {response.status_code}")
-            else:
-                current_app.logger.error(f"ERROR: SendGrid error with status code {response.status_code}")
-                current_app.logger.error(f"Response body: {response.body}")
-            
-            return success
-        except Exception as send_error:
-            current_app.logger.error(f"ERROR: Failed to send email: {str(send_error)}")
-            return False
-            
+    try:
+        email_id = enqueue_email(to_emails, subject, html_content, from_email=from_email, text_content=text_content)
+        current_app.logger.info(f"Queued email {email_id} to {to_emails} with subject: {subject}")
+        return True
     except Exception as e:
-        error_message = str(e)
-        current_app.logger.error(f"EXCEPTION during email sending: {error_message}")
-        
-        if "The from address does not match a verified Sender Identity" in error_message:
-            current_app.logger.error(f"SendGrid error: Sender email '{from_email}' is not verified. Please verify this domain in your SendGrid account.")
-        else:
-            current_app.logger.error(f"SendGrid error: {error_message}")
-        
-        # Print full exception traceback for debugging
-        import traceback
-        current_app.logger.error(f"Exception traceback: {traceback.format_exc()}")
-        
+        current_app.logger.error(f"Error queueing email: {str(e)}")
         return False
-    finally:
-        current_app.logger.info("=== Email sending process completed ===")
+
+def send_notification(
+    to_emails: List[str],
+    email: RenderedEmail,
+    settings: EmailSettingsSnapshot
+) -> bool:
+    """
+    Send a notification that may be coalesced: recipients who take digests get
+    it in their next digest, the rest get it straight away
+    Returns True if sent or held, False otherwise
+    """
+    try:
+        immediate = hold_for_digest(to_emails, email.subject, email.html_content, email.text_content,
+                                    settings.digest_minutes)
+    except Exception as e:
+        current_app.logger.error(f"Error holding notification for digest: {str(e)}")
+        immediate = to_emails
+    if not immediate:
+        return True
+    return send_email(to_emails=immediate, subject=email.subject, html_content=email.html_content,
+                      text_content=email.text_content)
+
+def ticket_base_url() -> str:
+    """Base URL for links in emails, built from config because SERVER_NAME causes issues"""
+    domain = current_app.config.get('EMAIL_DOMAIN', 'localhost:5000')
+    scheme = current_app.config.get('PREFERRED_URL_SCHEME', 'http')
+    return f"{scheme}://{domain}"
 
 def send_schedule_notification(
-    schedule: Schedule,
+    schedule: Union[Schedule, ScheduleRule],
     action: str,
     additional_info: Optional[str] = None
 ) -> None:
     """
-    Send a notification about a schedule change
+    Send a notification about a schedule change, or a recurring rule (described by its first shift)
     action should be one of: 'created', 'updated', 'deleted'
     """
     try:
@@ -127,39 +139,18 @@ def send_schedule_notification(
             action == 'deleted' and not settings.notify_on_delete):
             return
 
+        if isinstance(schedule, ScheduleRule):
+            context = ScheduleContext.from_rule(schedule)
+        else:
+            context = ScheduleContext.from_schedule(schedule)
+
         # Build recipient list
         recipients = [settings.admin_email_group]
-        if schedule.technician.email not in recipients:
-            recipients.append(schedule.technician.email)
+        if context.technician_email not in recipients:
+            recipients.append(context.technician_email)
 
-        # Build email content
-        action_past = {'created': 'created', 'updated': 'updated', 'deleted': 'deleted'}[action]
-
-        location_info = f" at {schedule.location.name}" if schedule.location else ""
-        time_info = (f"from {schedule.start_time.strftime('%Y-%m-%d %H:%M')} "
-                    f"to {schedule.end_time.strftime('%Y-%m-%d %H:%M')}")
-
-        subject = f"Schedule {action_past} for {schedule.technician.username}"
-
-        html_content = f"""
-        <h3>Schedule {action_past}</h3>
-        <p>A schedule has been {action_past} with the following details:</p>
-        <ul>
-            <li><strong>Technician:</strong> {schedule.technician.username}</li>
-            <li><strong>Time:</strong> {time_info}</li>
-            <li><strong>Location:</strong> {schedule.location.name if schedule.location else 'No location'}</li>
-            <li><strong>Description:</strong> {schedule.description or 'No description'}</li>
-        </ul>
-        """
-
-        if additional_info:
-            html_content += f"<p><strong>Additional Information:</strong> {additional_info}</p>"
-
-        success = send_email(
-            to_emails=recipients,
-            subject=subject,
-            html_content=html_content
-        )
+        email = render_email('schedule_changed', action=action, schedule=context, additional_info=additional_info)
+        success = send_notification(recipients, email, settings)
 
         if not success:
             current_app.logger.warning(f"Failed to send email notification for schedule {action}")
@@ -197,84 +188,34 @@ def send_ticket_assigned_notification(
             logger.warning("Cannot send notification: ticket is not assigned to anyone")
             return False
             
-        # Get the assigned technician
-        logger.info(f"Looking up technician with ID {ticket.assigned_to}")
-        technician = User.query.get(ticket.assigned_to)
-        if not technician:
+        # Everything the email shows, loaded once up front
+        context = TicketContext.from_ticket(ticket, ticket_base_url())
+        if not context.assignee:
             logger.warning(f"Could not find technician with ID {ticket.assigned_to}")
             return False
             
-        if not technician.email:
-            logger.warning(f"Technician {technician.username} has no email address")
+        if not context.assignee_email:
+            logger.warning(f"Technician {context.assignee} has no email address")
             return False
             
-        logger.info(f"Found technician: {technician.username}, Email: {technician.email}")
+        logger.info(f"Found technician: {context.assignee}, Email: {context.assignee_email}")
         
         settings = get_email_settings()
-        logger.info(f"Email settings: admin_email_group={settings.admin_email_group}")
         
         # Build recipient list - the assigned technician
-        recipients = [technician.email]
-        logger.info(f"Added technician email to recipients: {technician.email}")
+        recipients = [context.assignee_email]
         
         # Add admin email for monitoring
         if settings.admin_email_group not in recipients:
             recipients.append(settings.admin_email_group)
-            logger.info(f"Added admin email to recipients: {settings.admin_email_group}")
             
-        # Build ticket URL - manually constructing because SERVER_NAME causes issues
-        domain = current_app.config.get('EMAIL_DOMAIN', 'localhost:5000')
-        scheme = current_app.config.get('PREFERRED_URL_SCHEME', 'http')
-        
-        # Generate the URL path without _external=True to avoid SERVER_NAME issues
-        logger.info(f"Generating URL for ticket ID: {ticket.id}")
-        
-        # Use a direct URL construction approach
-        ticket_url = f"{scheme}://{domain}/tickets/{ticket.id}"
-        logger.info(f"Using domain: {domain} for email URLs")
-        logger.info(f"Generated ticket URL: {ticket_url}")
-        
-        subject = f"Ticket #{ticket.id} has been assigned to you"
-        logger.info(f"Email subject: {subject}")
-        
-        priority_labels = {
-            0: 'Low',
-            1: 'Medium',
-            2: 'High',
-            3: 'Urgent'
-        }
-        
-        # Log ticket details
-        logger.info(f"Ticket details - ID: {ticket.id}, Title: {ticket.title}, Priority: {priority_labels.get(ticket.priority, 'Unknown')}")
-        logger.info(f"Assigned by: {assigned_by.username}")
-        
-        html_content = f"""
-        <h3>Ticket Assigned</h3>
-        <p>A ticket has been assigned to you by {assigned_by.username}:</p>
-        <ul>
-            <li><strong>Ticket ID:</strong> #{ticket.id}</li>
-            <li><strong>Title:</strong> {ticket.title}</li>
-            <li><strong>Priority:</strong> {priority_labels.get(ticket.priority, 'Unknown')}</li>
-            <li><strong>Category:</strong> {ticket.category.name if ticket.category else 'Uncategorized'}</li>
-            <li><strong>Status:</strong> {ticket.status.replace('_', ' ').title()}</li>
-        </ul>
-        <p><strong>Description:</strong><br>
-        {ticket.description}
-        </p>
-        <p>
-        <a href="{ticket_url}" style="background-color: #007bff; color: white; padding: 10px 15px; text-decoration: none; border-radius: 4px; display: inline-block;">View Ticket</a>
-        </p>
-        """
-        
-        # Log number of recipients before sending
-        logger.info(f"About to send email to {len(recipients)} recipients: {recipients}")
-        
-        # Call send_email function with direct parameters (avoid URL generation inside)
-        logger.info("Calling send_email function...")
+        email = render_email('ticket_assigned', ticket=context, assigned_by=assigned_by.username)
+        logger.info(f"About to send '{email.subject}' to {len(recipients)} recipients: {recipients}")
         success = send_email(
             to_emails=recipients,
-            subject=subject,
-            html_content=html_content
+            subject=email.subject,
+            html_content=email.html_content,
+            text_content=email.text_content
         )
         
         # Check result
@@ -329,15 +270,15 @@ def send_ticket_comment_notification(
     try:
         logger.debug(f"Starting comment notification for ticket #{ticket.id}")
         
+        # Everything the email shows, loaded once up front
+        context = TicketContext.from_ticket(ticket, ticket_base_url())
+
         # Get the assigned technician (if any)
         recipients = []
-        if ticket.assigned_to:
-            technician = User.query.get(ticket.assigned_to)
-            if technician and technician.email:
-                recipients.append(technician.email)
-                logger.debug(f"Added technician email to recipients: {technician.email}")
-            else:
-                logger.warning(f"Could not find valid email for technician ID {ticket.assigned_to}")
+        if context.assignee_email:
+            recipients.append(context.assignee_email)
+        elif ticket.assigned_to:
+            logger.warning(f"Could not find valid email for technician ID {ticket.assigned_to}")
         
         # Skip if no recipients
         if not recipients:
@@ -352,38 +293,13 @@ def send_ticket_comment_notification(
             recipients.append(settings.admin_email_group)
             logger.debug(f"Added admin email to recipients: {settings.admin_email_group}")
         
-        # Build ticket URL - manually constructing because SERVER_NAME causes issues
-        domain = current_app.config.get('EMAIL_DOMAIN', 'localhost:5000')
-        scheme = current_app.config.get('PREFERRED_URL_SCHEME', 'http')
-        
-        # Use a direct URL construction approach
-        ticket_url = f"{scheme}://{domain}/tickets/{ticket.id}"
-        
-        logger.debug(f"Using domain: {domain} for email URLs")
-        logger.debug(f"Generated ticket URL: {ticket_url}")
-        
-        subject = f"New comment on Ticket #{ticket.id}"
-        
-        html_content = f"""
-        <h3>New Comment on Ticket #{ticket.id}</h3>
-        <p><strong>{commented_by.username}</strong> added a comment to a ticket assigned to you:</p>
-        <div style="background-color: #f8f9fa; padding: 15px; border-left: 4px solid #007bff; margin: 20px 0;">
-            {comment.content}
-        </div>
-        <h4>Ticket Details</h4>
-        <ul>
-            <li><strong>Title:</strong> {ticket.title}</li>
-            <li><strong>Status:</strong> {ticket.status.replace('_', ' ').title()}</li>
-        </ul>
-        <p>
-        <a href="{ticket_url}" style="background-color: #007bff; color: white; padding: 10px 15px; text-decoration: none; border-radius: 4px; display: inline-block;">View Ticket</a>
-        </p>
-        """
-        
+        email = render_email('ticket_comment', ticket=context, comment=comment.content,
+                             commented_by=commented_by.username)
         success = send_email(
             to_emails=recipients,
-            subject=subject,
-            html_content=html_content
+            subject=email.subject,
+            html_content=email.html_content,
+            text_content=email.text_content
         )
         
         if not success:
@@ -437,15 +353,15 @@ def send_ticket_status_notification(
     try:
         logger.debug(f"Starting status notification for ticket #{ticket.id}: {old_status} -> {new_status}")
         
+        # Everything the email shows, loaded once up front
+        context = TicketContext.from_ticket(ticket, ticket_base_url())
+
         # Get the assigned technician (if any)
         recipients = []
-        if ticket.assigned_to:
-            technician = User.query.get(ticket.assigned_to)
-            if technician and technician.email:
-                recipients.append(technician.email)
-                logger.debug(f"Added technician email to recipients: {technician.email}")
-            else:
-                logger.warning(f"Could not find valid email for technician ID {ticket.assigned_to}")
+        if context.assignee_email:
+            recipients.append(context.assignee_email)
+        elif ticket.assigned_to:
+            logger.warning(f"Could not find valid email for technician ID {ticket.assigned_to}")
         
         # Skip if no recipients
         if not recipients:
@@ -460,51 +376,9 @@ def send_ticket_status_notification(
             recipients.append(settings.admin_email_group)
             logger.debug(f"Added admin email to recipients: {settings.admin_email_group}")
         
-        # Build ticket URL - manually constructing because SERVER_NAME causes issues
-        domain = current_app.config.get('EMAIL_DOMAIN', 'localhost:5000')
-        scheme = current_app.config.get('PREFERRED_URL_SCHEME', 'http')
-        
-        # Use a direct URL construction approach
-        ticket_url = f"{scheme}://{domain}/tickets/{ticket.id}"
-        
-        logger.debug(f"Using domain: {domain} for email URLs")
-        logger.debug(f"Generated ticket URL: {ticket_url}")
-        
-        subject = f"Status changed on Ticket #{ticket.id}"
-        
-        html_content = f"""
-        <h3>Ticket Status Changed</h3>
-        <p>The status of ticket #{ticket.id} has been changed:</p>
-        <ul>
-            <li><strong>Old Status:</strong> {old_status.replace('_', ' ').title()}</li>
-            <li><strong>New Status:</strong> {new_status.replace('_', ' ').title()}</li>
-            <li><strong>Changed by:</strong> {updated_by.username}</li>
-        </ul>
-        """
-        
-        if comment:
-            html_content += f"""
-            <p><strong>Comment:</strong></p>
-            <div style="background-color: #f8f9fa; padding: 15px; border-left: 4px solid #007bff; margin: 20px 0;">
-                {comment}
-            </div>
-            """
-            
-        html_content += f"""
-        <h4>Ticket Details</h4>
-        <ul>
-            <li><strong>Title:</strong> {ticket.title}</li>
-        </ul>
-        <p>
-        <a href="{ticket_url}" style="background-color: #007bff; color: white; padding: 10px 15px; text-decoration: none; border-radius: 4px; display: inline-block;">View Ticket</a>
-        </p>
-        """
-        
-        success = send_email(
-            to_emails=recipients,
-            subject=subject,
-            html_content=html_content
-        )
+        email = render_email('ticket_status', ticket=context, old_status=old_status, new_status=new_status,
+                             updated_by=updated_by.username, comment=comment)
+        success = send_notification(recipients, email, settings)
         
         if not success:
             logger.warning(f"Failed to send email notification for ticket status change")
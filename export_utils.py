@@ -0,0 +1,287 @@
+"""
+Timesheet export engine.
+
+Shifts for the whole team are read with one query ordered by technician and
+start time, streamed from the database in batches, and walked once per
+technician to lay out one timesheet row per shift (or an empty row for days
+without one). Recurring shifts from ScheduleRule are merged in per technician.
+
+The XLSX writer uses openpyxl's write-only mode, so each worksheet is flushed
+to disk as it is written instead of keeping the whole workbook in memory.
+The CSV and NDJSON writers are generators over the same shift stream, yielding
+one line per shift so the response can be sent while rows are still arriving.
+"""
+import csv
+import io
+import json
+import logging
+import shutil
+import tempfile
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from itertools import groupby
+from heapq import merge
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import pytz
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill
+from openpyxl.utils import get_column_letter
+
+from app import db
+from models import Location, Schedule, User
+from schedule_utils import as_utc, rule_occurrences
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EXPORT_TIMEZONE = 'America/Chicago'
+# Rows fetched per round trip while streaming shifts from the database
+EXPORT_BATCH_SIZE = 1000
+
+TIMESHEET_HEADERS = ['Day', 'Date', 'Clock In', 'Clock Out', 'Total', 'Type', 'Notes']
+
+# Flat file columns, one record per shift
+RECORD_FIELDS = ['technician', 'date', 'day', 'clock_in', 'clock_out', 'hours', 'type', 'location', 'notes']
+
+EXPORT_FORMATS = {
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+}
+
+
+def export_period(start_date: str, end_date: str, timezone_name: Optional[str] = None):
+    """
+    Turn inclusive 'YYYY-MM-DD' dates in the export timezone into a UTC
+    [start, end) range. Returns (start_utc, end_utc, tz); raises ValueError
+    for an unknown timezone or malformed dates.
+    """
+    timezone_name = timezone_name or DEFAULT_EXPORT_TIMEZONE
+    if timezone_name not in pytz.all_timezones:
+        raise ValueError('Invalid timezone')
+    tz = pytz.timezone(timezone_name)
+    start_utc = tz.localize(datetime.strptime(start_date, '%Y-%m-%d')).astimezone(pytz.UTC)
+    end_utc = tz.localize(datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)).astimezone(pytz.UTC)
+    return start_utc, end_utc, tz
+
+
+@dataclass(frozen=True)
+class ExportShift:
+    username: str
+    start_time: datetime
+    end_time: datetime
+    description: Optional[str]
+    time_off: bool
+    location_name: Optional[str]
+
+
+def iter_team_shifts(start_utc: datetime, end_utc: datetime) -> Iterator[Tuple[str, List[ExportShift]]]:
+    """
+    Yield (username, shifts) per technician with shifts starting in
+    [start_utc, end_utc), each list ordered by start time.
+    """
+    rows = (db.session.query(User.username, Schedule.start_time, Schedule.end_time,
+                             Schedule.description, Schedule.time_off, Location.name)
+        .join(User, Schedule.technician_id == User.id)
+        .outerjoin(Location, Schedule.location_id == Location.id)
+        .filter(Schedule.start_time >= start_utc, Schedule.start_time < end_utc)
+        .order_by(User.username, Schedule.start_time)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE))
+
+    # Recurring shifts are already expanded (and cached) per window, so group them up front
+    recurring: Dict[str, List[ExportShift]] = {}
+    for occurrence in rule_occurrences.get(start_utc, end_utc):
+        if occurrence.start_time >= start_utc:
+            recurring.setdefault(occurrence.technician.username, []).append(ExportShift(
+                username=occurrence.technician.username,
+                start_time=occurrence.start_time,
+                end_time=occurrence.end_time,
+                description=occurrence.description,
+                time_off=occurrence.time_off,
+                location_name=occurrence.location.name if occurrence.location else None
+            ))
+
+    shifts = (ExportShift(username, as_utc(start), as_utc(end), description, bool(time_off), location_name)
+              for username, start, end, description, time_off, location_name in rows)
+    for username, user_shifts in groupby(shifts, key=lambda shift: shift.username):
+        extra = recurring.pop(username, [])
+        if extra:
+            user_shifts = merge(user_shifts, extra, key=lambda shift: shift.start_time)
+        yield username, list(user_shifts)
+
+    # Technicians whose only shifts in the period are recurring ones
+    for username in sorted(recurring):
+        yield username, recurring[username]
+
+
+def _shift_notes(shift: ExportShift) -> str:
+    notes = []
+    if shift.location_name:
+        notes.append(f"Location: {shift.location_name}")
+    if shift.time_off:
+        notes.append("TIME OFF")
+    if shift.description:
+        if "ON-CALL" in shift.description.upper():
+            notes.append("ON-CALL")
+        elif "PLEX" in shift.description.upper():
+            notes.append("PLEX")
+        else:
+            notes.append(shift.description)
+    return " | ".join(notes)
+
+
+def timesheet_rows(shifts: Iterable[ExportShift], first_day: date, end_day: date, tz) -> Iterator[list]:
+    """
+    Lay out one row per shift, and an empty row for every day in
+    [first_day, end_day) without one. Shifts must be ordered by start time,
+    so days and shifts are walked together in a single pass.
+    """
+    shifts = iter(shifts)
+    pending = next(shifts, None)
+    day = first_day
+    while day < end_day:
+        had_shift = False
+        while pending is not None and pending.start_time.astimezone(tz).date() <= day:
+            start_time = pending.start_time.astimezone(tz)
+            end_time = pending.end_time.astimezone(tz)
+            hours = int((end_time - start_time).total_seconds() / 60) // 60
+            yield [
+                start_time.strftime('%A'),
+                start_time.strftime('%-m/%-d/%Y'),
+                start_time.strftime('%-I:%M %p'),
+                end_time.strftime('%-I:%M %p'),
+                f"{hours}:00",
+                "Time Off" if pending.time_off else "Work",
+                _shift_notes(pending)
+            ]
+            had_shift = True
+            pending = next(shifts, None)
+
+        if not had_shift:
+            yield [day.strftime('%A'), day.strftime('%-m/%-d/%Y'), "0", "0", "0:00"]
+        day += timedelta(days=1)
+
+
+def total_hours(shifts: Iterable[ExportShift]) -> str:
+    total_minutes = sum((shift.end_time - shift.start_time).total_seconds() / 60 for shift in shifts)
+    return f"{total_minutes // 60:.0f}:00:00"
+
+
+class ColumnWidths:
+    """Track the widest value per column as rows are produced"""
+
+    def __init__(self):
+        self.widths: Dict[int, int] = {}
+
+    def update(self, row: list) -> list:
+        for index, value in enumerate(row):
+            if value is not None:
+                self.widths[index] = max(self.widths.get(index, 0), len(str(value)))
+        return row
+
+
+def write_timesheet_xlsx(start_utc: datetime, end_utc: datetime, tz, period_label: str):
+    """
+    Write the team's timesheets, one worksheet per technician, to a temporary
+    file and return it positioned at the start for streaming.
+    """
+    workbook = Workbook(write_only=True)
+    header_font = Font(bold=True)
+    header_fill = PatternFill(start_color='CCCCCC', end_color='CCCCCC', fill_type='solid')
+    first_day = start_utc.astimezone(tz).date()
+    end_day = end_utc.astimezone(tz).date()
+
+    for username, shifts in iter_team_shifts(start_utc, end_utc):
+        worksheet = workbook.create_sheet(title=username[:31])  # Excel limits sheet names to 31 chars
+
+        # Write-only sheets need column widths before the first row, so lay the
+        # sheet out first (one technician at a time) while measuring it
+        widths = ColumnWidths()
+        preamble = [
+            widths.update([f'Schedule Export - {username}']),
+            widths.update([f'Period: {period_label}']),
+            [],
+            widths.update(['Total Hours:', total_hours(shifts)]),
+            [],
+        ]
+        widths.update(TIMESHEET_HEADERS)
+        rows = [widths.update(row) for row in timesheet_rows(shifts, first_day, end_day, tz)]
+
+        for index, width in widths.widths.items():
+            worksheet.column_dimensions[get_column_letter(index + 1)].width = width + 2
+
+        for row in preamble:
+            worksheet.append(row)
+        header_cells = []
+        for header in TIMESHEET_HEADERS:
+            cell = WriteOnlyCell(worksheet, value=header)
+            cell.font = header_font
+            cell.fill = header_fill
+            header_cells.append(cell)
+        worksheet.append(header_cells)
+        for row in rows:
+            worksheet.append(row)
+
+    if not workbook.worksheets:
+        workbook.create_sheet(title='Timesheets').append([f'No schedules found for {period_label}'])
+
+    output = tempfile.TemporaryFile()
+    workbook.save(output)
+    output.seek(0)
+    return output
+
+
+def iter_timesheet_records(start_utc: datetime, end_utc: datetime, tz) -> Iterator[dict]:
+    """Yield one flat record per shift, in local time, for payroll imports"""
+    for username, shifts in iter_team_shifts(start_utc, end_utc):
+        for shift in shifts:
+            start_time = shift.start_time.astimezone(tz)
+            end_time = shift.end_time.astimezone(tz)
+            yield {
+                'technician': username,
+                'date': start_time.date().isoformat(),
+                'day': start_time.strftime('%A'),
+                'clock_in': start_time.strftime('%H:%M'),
+                'clock_out': end_time.strftime('%H:%M'),
+                'hours': round((end_time - start_time).total_seconds() / 3600, 2),
+                'type': "Time Off" if shift.time_off else "Work",
+                'location': shift.location_name or '',
+                'notes': _shift_notes(shift)
+            }
+
+
+def generate_timesheet_csv(start_utc: datetime, end_utc: datetime, tz) -> Iterator[str]:
+    """Yield the CSV export line by line, starting with the header"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=RECORD_FIELDS)
+
+    def flush() -> str:
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line
+
+    writer.writeheader()
+    yield flush()
+    for record in iter_timesheet_records(start_utc, end_utc, tz):
+        writer.writerow(record)
+        yield flush()
+
+
+def generate_timesheet_ndjson(start_utc: datetime, end_utc: datetime, tz) -> Iterator[str]:
+    """Yield the export as newline-delimited JSON, one object per shift"""
+    for record in iter_timesheet_records(start_utc, end_utc, tz):
+        yield json.dumps(record) + "\n"
+
+
+def write_export(output, export_format: str, start_utc: datetime, end_utc: datetime, tz, period_label: str) -> None:
+    """Write a complete export in any of EXPORT_FORMATS to a binary file object"""
+    if export_format == 'xlsx':
+        with write_timesheet_xlsx(start_utc, end_utc, tz, period_label) as excel_file:
+            shutil.copyfileobj(excel_file, output)
+        return
+
+    generate = generate_timesheet_csv if export_format == 'csv' else generate_timesheet_ndjson
+    for piece in generate(start_utc, end_utc, tz):
+        output.write(piece.encode('utf-8'))
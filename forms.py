@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, DateTimeField, DateField, TextAreaField, ColorField, SelectField, IntegerField
-from wtforms.validators import DataRequired, Email, EqualTo, Length, URL, Optional
+from wtforms.validators import DataRequired, Email, EqualTo, Length, URL, Optional, NumberRange
 import pytz
 
 class LocationForm(FlaskForm):
@@ -18,6 +18,8 @@ class ScheduleForm(FlaskForm):
     location_id = SelectField('Location', coerce=int, validators=[Optional()])
     time_off = BooleanField('Time Off')
     repeat_days = StringField('Repeat Days', validators=[Optional()])
+    repeat_weekly = BooleanField('Repeat every week')
+    repeat_until = DateField('Until', validators=[Optional()])
 
 class LoginForm(FlaskForm):
     email = StringField('Username or Email', validators=[DataRequired()])
@@ -77,6 +79,7 @@ class EmailSettingsForm(FlaskForm):
     notify_on_create = BooleanField('Send notifications for new schedules', default=True)
     notify_on_update = BooleanField('Send notifications for schedule updates', default=True)
     notify_on_delete = BooleanField('Send notifications for schedule deletions', default=True)
+    digest_minutes = IntegerField('Digest window (minutes)', validators=[NumberRange(min=0, max=1440)], default=0)
 
 class TicketForm(FlaskForm):
     title = StringField('Title', validators=[DataRequired(), Length(max=200)])
@@ -6,7 +6,9 @@ CREATE TABLE users (
     password_hash VARCHAR(256),
     color VARCHAR(7) DEFAULT '#3498db',
     is_admin BOOLEAN DEFAULT FALSE,
-    timezone VARCHAR(50) DEFAULT 'America/Los_Angeles'
+    timezone VARCHAR(50) DEFAULT 'America/Los_Angeles',
+    digest_minutes INTEGER,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
 CREATE TABLE schedule (
@@ -17,7 +19,26 @@ CREATE TABLE schedule (
     description TEXT,
     time_off BOOLEAN DEFAULT FALSE,
     location_id INTEGER REFERENCES location(id),
-    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Weekly recurring shifts, expanded into occurrences when viewed
+CREATE TABLE schedule_rule (
+    id SERIAL PRIMARY KEY,
+    technician_id INTEGER REFERENCES users(id) NOT NULL,
+    location_id INTEGER REFERENCES location(id),
+    description VARCHAR(200),
+    time_off BOOLEAN DEFAULT FALSE,
+    weekdays VARCHAR(20) NOT NULL,
+    start_time TIME NOT NULL,
+    end_time TIME NOT NULL,
+    timezone VARCHAR(50) NOT NULL DEFAULT 'UTC',
+    start_date DATE NOT NULL,
+    until_date DATE,
+    exceptions TEXT DEFAULT '',
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
 CREATE TABLE quick_link (
@@ -36,7 +57,8 @@ CREATE TABLE ticket_category (
     description TEXT,
     icon VARCHAR(50) DEFAULT 'help-circle',
     priority_level INTEGER DEFAULT 0,
-    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
 CREATE TABLE ticket (
@@ -50,7 +72,8 @@ CREATE TABLE ticket (
     created_by INTEGER REFERENCES users(id) NOT NULL,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-    due_date TIMESTAMP WITH TIME ZONE
+    due_date TIMESTAMP WITH TIME ZONE,
+    search_vector TSVECTOR
 );
 
 CREATE TABLE ticket_comment (
@@ -71,16 +94,128 @@ CREATE TABLE ticket_history (
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Long-running admin operations run by the background job runner
+CREATE TABLE background_job (
+    id SERIAL PRIMARY KEY,
+    kind VARCHAR(50) NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+    params TEXT,
+    progress INTEGER,
+    message VARCHAR(500),
+    error TEXT,
+    result_path VARCHAR(500),
+    result_name VARCHAR(200),
+    result_mimetype VARCHAR(100),
+    created_by INTEGER REFERENCES users(id) NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP WITH TIME ZONE,
+    finished_at TIMESTAMP WITH TIME ZONE,
+    owner VARCHAR(200),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Emails queued for the outbox dispatcher
+CREATE TABLE outbox_email (
+    id SERIAL PRIMARY KEY,
+    recipients TEXT NOT NULL,
+    from_email VARCHAR(120) NOT NULL,
+    subject VARCHAR(300) NOT NULL,
+    html_content TEXT NOT NULL,
+    text_content TEXT,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_error TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    sent_at TIMESTAMP WITH TIME ZONE
+);
+
+-- Notifications waiting to be sent as a per-recipient digest
+CREATE TABLE pending_notification (
+    id SERIAL PRIMARY KEY,
+    recipient VARCHAR(120) NOT NULL,
+    subject VARCHAR(300) NOT NULL,
+    html_content TEXT NOT NULL,
+    text_content TEXT,
+    send_after TIMESTAMP WITH TIME ZONE NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Tombstones for deleted rows, carried by incremental backups
+CREATE TABLE deleted_record (
+    id SERIAL PRIMARY KEY,
+    table_name VARCHAR(50) NOT NULL,
+    record_id INTEGER NOT NULL,
+    deleted_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Completed backups; the latest watermark is where an incremental backup starts
+CREATE TABLE backup_record (
+    id SERIAL PRIMARY KEY,
+    kind VARCHAR(20) NOT NULL,
+    since TIMESTAMP WITH TIME ZONE,
+    watermark TIMESTAMP WITH TIME ZONE NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
 -- Create indexes
 CREATE INDEX idx_schedule_technician ON schedule(technician_id);
 CREATE INDEX idx_schedule_time ON schedule(start_time, end_time);
+CREATE INDEX idx_schedule_technician_start ON schedule(technician_id, start_time);
+CREATE INDEX idx_schedule_time_off ON schedule(start_time) WHERE time_off = true;
 CREATE INDEX idx_quick_link_order ON quick_link("order");
 CREATE INDEX idx_ticket_status ON ticket(status);
 CREATE INDEX idx_ticket_assigned_to ON ticket(assigned_to);
 CREATE INDEX idx_ticket_category ON ticket(category_id);
 CREATE INDEX idx_ticket_created_by ON ticket(created_by);
+CREATE INDEX idx_ticket_created_id ON ticket(created_at, id);
+CREATE INDEX idx_ticket_search ON ticket USING GIN (search_vector);
 CREATE INDEX idx_ticket_comment_ticket ON ticket_comment(ticket_id);
 CREATE INDEX idx_ticket_history_ticket ON ticket_history(ticket_id);
+CREATE INDEX idx_ticket_comment_timeline ON ticket_comment(ticket_id, created_at, id);
+CREATE INDEX idx_ticket_history_timeline ON ticket_history(ticket_id, created_at, id);
+CREATE INDEX idx_background_job_created ON background_job(created_at);
+CREATE INDEX idx_deleted_record_deleted_at ON deleted_record(deleted_at);
+CREATE INDEX idx_outbox_email_due ON outbox_email(status, next_attempt_at);
+CREATE INDEX idx_pending_notification_due ON pending_notification(send_after);
+CREATE INDEX idx_pending_notification_recipient ON pending_notification(recipient);
+
+-- Full-text search: ticket.search_vector holds the weighted title (A), description (B)
+-- and comment text (C), rebuilt when a ticket's text or any of its comments change
+CREATE OR REPLACE FUNCTION ticket_search_document(ticket_id INTEGER, title TEXT, description TEXT)
+RETURNS tsvector AS $$
+    SELECT setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+           setweight(to_tsvector('english', coalesce(description, '')), 'B') ||
+           setweight(to_tsvector('english', coalesce(
+               (SELECT string_agg(content, ' ') FROM ticket_comment WHERE ticket_comment.ticket_id = $1), '')), 'C')
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION ticket_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := ticket_search_document(NEW.id, NEW.title, NEW.description);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION ticket_comment_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE ticket SET search_vector = ticket_search_document(id, title, description) WHERE id = OLD.ticket_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE ticket SET search_vector = ticket_search_document(id, title, description) WHERE id = NEW.ticket_id;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS ticket_search_vector_update ON ticket;
+CREATE TRIGGER ticket_search_vector_update BEFORE INSERT OR UPDATE OF title, description ON ticket
+FOR EACH ROW EXECUTE FUNCTION ticket_search_vector_update();
+
+DROP TRIGGER IF EXISTS ticket_comment_search_vector_update ON ticket_comment;
+CREATE TRIGGER ticket_comment_search_vector_update AFTER INSERT OR UPDATE OF content, ticket_id OR DELETE
+ON ticket_comment FOR EACH ROW EXECUTE FUNCTION ticket_comment_search_vector_update();
 
 -- Insert actual user data
 INSERT INTO users (username, email, password_hash, color, is_admin, timezone) VALUES 
@@ -0,0 +1,277 @@
+"""
+Background jobs for long-running admin operations.
+
+Backups, restores, timesheet exports and batch archiving are recorded as
+BackgroundJob rows and run on a small in-process thread pool, each in its own
+app context (and so its own database session), instead of tying up a request
+worker until a proxy times out. Handlers report progress, which is written on
+a separate connection so it shows while the job's own transaction is open.
+Admins poll /admin/jobs/<id> and download the result once it is ready.
+
+Each job records the process that queued it, which touches the job's
+updated_at while it is unfinished. A job whose heartbeat goes stale, or that
+this process's predecessor left behind, is marked failed; jobs still live in
+another worker or instance are left alone. Result files (and uploads waiting
+for a restore) are kept on the local disk of the process that ran the job, so
+with several instances JOB_RESULTS_DIR must point at storage they all share.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional
+
+import pytz
+from flask import Blueprint, current_app, flash, jsonify, redirect, request, send_file, url_for
+from flask_login import current_user, login_required
+from werkzeug.utils import secure_filename
+
+from app import app, db
+from models import BackgroundJob, JobStatus
+
+logger = logging.getLogger(__name__)
+
+jobs_bp = Blueprint('jobs', __name__)
+
+# Jobs run at the same time; the rest wait in the queue
+JOB_WORKERS = 2
+# Result files are deleted after this long
+JOB_RESULT_MAX_AGE = timedelta(days=1)
+# Jobs listed on the admin pages
+RECENT_JOB_COUNT = 10
+# How often a process touches the jobs it owns, and how long without a touch before one counts as dead
+JOB_HEARTBEAT_INTERVAL = timedelta(seconds=30)
+JOB_HEARTBEAT_TIMEOUT = timedelta(minutes=5)
+
+_handlers: Dict[str, Callable] = {}
+# Jobs only run in the process that queued them
+_owner = f'{socket.gethostname()}:{os.getpid()}'
+_process_started_at = datetime.now(pytz.UTC)
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+_heartbeat: Optional[threading.Thread] = None
+
+
+def job_handler(kind: str):
+    """
+    Register a function as the handler for a kind of job. It is called as
+    handler(job, **params) with a JobContext and may return a message to show
+    when the job finishes.
+    """
+    def register(func):
+        _handlers[kind] = func
+        return func
+    return register
+
+
+def results_dir() -> str:
+    return current_app.config.get('JOB_RESULTS_DIR') or os.path.join(current_app.instance_path, 'jobs')
+
+
+def _update_job(job_id: int, **values) -> None:
+    # A separate connection, so updates show while the job's own transaction is open
+    with db.engine.begin() as connection:
+        connection.execute(db.update(BackgroundJob).where(BackgroundJob.id == job_id).values(**values))
+
+
+class JobContext:
+    """Passed to a running handler: progress reporting and somewhere to write its result"""
+
+    def __init__(self, job_id: int):
+        self.job_id = job_id
+        self.result = None
+
+    def progress(self, done: int, total: Optional[int] = None, message: Optional[str] = None) -> None:
+        values = {'progress': int(done * 100 / total) if total else None}
+        if message:
+            values['message'] = message
+        _update_job(self.job_id, **values)
+
+    def result_file(self, name: str, mimetype: str) -> str:
+        """Path to write the job's downloadable result to"""
+        os.makedirs(results_dir(), exist_ok=True)
+        path = os.path.join(results_dir(), f'{self.job_id}_{secure_filename(name)}')
+        self.result = (path, name, mimetype)
+        return path
+
+
+def save_upload(file) -> str:
+    """Keep an uploaded file on disk for a job to read after the request ends"""
+    os.makedirs(results_dir(), exist_ok=True)
+    path = os.path.join(results_dir(), f'upload_{uuid.uuid4().hex}')
+    file.save(path)
+    return path
+
+
+def _run(job_id: int) -> None:
+    with app.app_context():
+        job = db.session.get(BackgroundJob, job_id)
+        kind = job.kind
+        params = json.loads(job.params or '{}')
+        context = JobContext(job_id)
+        _update_job(job_id, status=JobStatus.RUNNING, started_at=datetime.now(pytz.UTC))
+
+        try:
+            handler = _handlers[kind]
+            message = handler(context, **params)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Background job {job_id} ({kind}) failed: {str(e)}")
+            _update_job(job_id, status=JobStatus.FAILED, error=str(e) or type(e).__name__,
+                        finished_at=datetime.now(pytz.UTC))
+            return
+
+        values = {'status': JobStatus.SUCCEEDED, 'progress': 100, 'finished_at': datetime.now(pytz.UTC)}
+        if message:
+            values['message'] = message
+        if context.result:
+            values['result_path'], values['result_name'], values['result_mimetype'] = context.result
+        _update_job(job_id, **values)
+        logger.info(f"Background job {job_id} ({kind}) finished")
+
+
+def _remove_expired_results() -> None:
+    cutoff = datetime.now(pytz.UTC) - JOB_RESULT_MAX_AGE
+    expired = BackgroundJob.query.filter(BackgroundJob.result_path.isnot(None),
+                                         BackgroundJob.finished_at < cutoff).all()
+    for job in expired:
+        try:
+            os.remove(job.result_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Error removing result of job {job.id}: {str(e)}")
+            continue
+        job.result_path = None
+    if expired:
+        db.session.commit()
+
+
+def _touch_owned_jobs() -> None:
+    """Heartbeat loop: keep updated_at current on this process's unfinished jobs"""
+    while True:
+        time.sleep(JOB_HEARTBEAT_INTERVAL.total_seconds())
+        try:
+            with app.app_context(), db.engine.begin() as connection:
+                connection.execute(db.update(BackgroundJob)
+                                   .where(BackgroundJob.owner == _owner,
+                                          BackgroundJob.status.in_([JobStatus.QUEUED, JobStatus.RUNNING]))
+                                   .values(updated_at=datetime.now(pytz.UTC)))
+        except Exception as e:
+            logger.error(f"Error updating background job heartbeat: {str(e)}")
+
+
+def start_job(kind: str, **params) -> BackgroundJob:
+    """Record a job for the current user and queue it (or run it now when JOBS_RUN_INLINE is set)"""
+    global _executor, _heartbeat
+    if kind not in _handlers:
+        raise ValueError(f"Unknown job kind: {kind}")
+
+    job = BackgroundJob(kind=kind, params=json.dumps(params), created_by=current_user.id, owner=_owner)
+    db.session.add(job)
+    db.session.commit()
+    _remove_expired_results()
+
+    if current_app.config.get('JOBS_RUN_INLINE'):
+        _run(job.id)
+        db.session.refresh(job)
+    else:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+            if _heartbeat is None:
+                _heartbeat = threading.Thread(target=_touch_owned_jobs, name='job-heartbeat', daemon=True)
+                _heartbeat.start()
+        _executor.submit(_run, job.id)
+    return job
+
+
+def job_status(job: BackgroundJob) -> dict:
+    status = job.to_dict()
+    status['status_url'] = url_for('jobs.get_job', job_id=job.id)
+    status['download_url'] = url_for('jobs.download_job_result', job_id=job.id) if status['has_result'] else None
+    return status
+
+
+def job_response(job: BackgroundJob, redirect_to: str, started_message: str):
+    """
+    Answer a request that started a job: JSON for scripts that will poll it,
+    otherwise a flash message (the outcome, if it already finished) and a redirect.
+    """
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(job_status(job)), 202
+
+    if job.status == JobStatus.SUCCEEDED:
+        flash(job.message or 'Done.')
+    elif job.status == JobStatus.FAILED:
+        flash(f'Error: {job.error}')
+    else:
+        flash(started_message)
+    return redirect(redirect_to)
+
+
+def job_error(message: str, redirect_to: str):
+    """Reject a request to start a job, in the same form job_response() would answer it"""
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'error': message}), 400
+    flash(message)
+    return redirect(redirect_to)
+
+
+def _fail_interrupted_jobs() -> None:
+    """
+    Mark unfinished jobs whose process has gone as failed, so nothing polls them
+    forever: those whose heartbeat is stale, and those an earlier run of this
+    process (same host and pid, as in a restarted container) left behind.
+    """
+    interrupted = BackgroundJob.query.filter(
+        BackgroundJob.status.in_([JobStatus.QUEUED, JobStatus.RUNNING]),
+        db.or_(BackgroundJob.updated_at < datetime.now(pytz.UTC) - JOB_HEARTBEAT_TIMEOUT,
+               db.and_(BackgroundJob.owner == _owner, BackgroundJob.created_at < _process_started_at)))
+    if interrupted.update({'status': JobStatus.FAILED, 'finished_at': datetime.now(pytz.UTC),
+                           'error': 'Interrupted by a restart before it finished'}, synchronize_session=False):
+        db.session.commit()
+
+
+def recent_jobs(limit: int = RECENT_JOB_COUNT):
+    _fail_interrupted_jobs()
+    return BackgroundJob.query.order_by(BackgroundJob.created_at.desc(), BackgroundJob.id.desc()).limit(limit).all()
+
+
+@jobs_bp.route('/admin/jobs')
+@login_required
+def list_jobs():
+    if not current_user.is_admin:
+        return jsonify({'error': 'Access denied'}), 403
+    return jsonify([job_status(job) for job in recent_jobs()])
+
+
+@jobs_bp.route('/admin/jobs/<int:job_id>')
+@login_required
+def get_job(job_id):
+    if not current_user.is_admin:
+        return jsonify({'error': 'Access denied'}), 403
+    _fail_interrupted_jobs()
+    job = BackgroundJob.query.get_or_404(job_id)
+    return jsonify(job_status(job))
+
+
+@jobs_bp.route('/admin/jobs/<int:job_id>/download')
+@login_required
+def download_job_result(job_id):
+    if not current_user.is_admin:
+        flash('Access denied.')
+        return redirect(url_for('calendar'))
+
+    job = BackgroundJob.query.get_or_404(job_id)
+    if job.status != JobStatus.SUCCEEDED or not job.result_path or not os.path.exists(job.result_path):
+        flash('That download is no longer available.')
+        return redirect(url_for('admin_backup'))
+    return send_file(job.result_path, mimetype=job.result_mimetype, as_attachment=True,
+                     download_name=job.result_name)
@@ -0,0 +1,137 @@
+"""
+Server-Sent Events stream for the sidebar panels.
+
+Open pages keep one /api/live connection instead of polling every minute.
+Commits that touch Schedule or Ticket rows publish a channel name to the
+in-process hub; each stream then recomputes the affected panels and only
+pushes the ones whose content actually changed.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+
+import pytz
+from flask import Blueprint, Response, stream_with_context, url_for
+from flask_login import login_required, current_user
+
+from app import db
+from change_events import on_model_change
+from models import Ticket
+from schedule_utils import active_shifts, format_active_shifts, on_schedule_change, upcoming_time_off
+
+logger = logging.getLogger(__name__)
+
+live_bp = Blueprint('live', __name__)
+
+# Seconds between keep-alive comments (also bounds how late a shift boundary is noticed)
+HEARTBEAT_INTERVAL = 30
+# Time off only changes with the date when no rows change, so re-check it sparingly
+TIME_OFF_RECHECK_INTERVAL = 60
+
+# Which panels need recomputing when a channel is published
+CHANNEL_EVENTS = {
+    'schedules': ('active_users', 'time_off'),
+    'tickets': ('tickets',),
+}
+
+
+class EventHub:
+    """In-process fan-out of change notifications to every open stream"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+
+    def subscribe(self) -> queue.Queue:
+        subscriber = queue.Queue()
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: queue.Queue) -> None:
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, channel: str) -> None:
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.put_nowait(channel)
+
+
+hub = EventHub()
+on_schedule_change(lambda: hub.publish('schedules'))
+on_model_change(Ticket, lambda: hub.publish('tickets'))
+
+
+def _sidebar_tickets():
+    from ticket_routes import get_active_sidebar_tickets
+    return [{
+        'id': ticket.id,
+        'title': ticket.title,
+        'status': ticket.status,
+        'priority': ticket.priority,
+        'url': url_for('tickets.view_ticket', ticket_id=ticket.id)
+    } for ticket in get_active_sidebar_tickets()]
+
+
+def _format_event(name, data) -> str:
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+@live_bp.route('/api/live')
+@login_required
+def live_stream():
+    """Stream active users, upcoming time off and sidebar tickets as they change"""
+    user_tz = current_user.get_timezone()
+    builders = {
+        'active_users': lambda: format_active_shifts(active_shifts.get(), user_tz),
+        'time_off': lambda: upcoming_time_off(datetime.now(pytz.UTC)),
+        'tickets': _sidebar_tickets,
+    }
+
+    def generate():
+        subscriber = hub.subscribe()
+        last_sent = {}
+        last_time_off_check = 0
+        pending = set(builders)  # Send the full state on (re)connect
+        try:
+            # Ask the browser to wait 10 seconds before reconnecting after a drop
+            yield "retry: 10000\n\n"
+            while True:
+                if 'time_off' in pending:
+                    last_time_off_check = time.monotonic()
+                for name in sorted(pending):
+                    try:
+                        data = builders[name]()
+                    except Exception as e:
+                        logger.error(f"Error building live update '{name}': {str(e)}")
+                        continue
+                    if last_sent.get(name) != data:
+                        last_sent[name] = data
+                        yield _format_event(name, data)
+                # Don't hold a database connection while idle
+                db.session.remove()
+
+                try:
+                    channel = subscriber.get(timeout=HEARTBEAT_INTERVAL)
+                    pending = set(CHANNEL_EVENTS.get(channel, ()))
+                    # Coalesce a burst of commits into one round of updates
+                    while not subscriber.empty():
+                        pending.update(CHANNEL_EVENTS.get(subscriber.get_nowait(), ()))
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    # A shift may have started or ended without any row changing
+                    pending = {'active_users'}
+                    if time.monotonic() - last_time_off_check >= TIME_OFF_RECHECK_INTERVAL:
+                        pending.add('time_off')
+        finally:
+            hub.unsubscribe(subscriber)
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Disable proxy buffering
+    return response
@@ -1,11 +1,14 @@
+import json
 import pytz
 from app import db, login_manager
 from flask_login import UserMixin
-from datetime import datetime
+from datetime import datetime, date, timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask import current_app
 from typing import List
-from sqlalchemy.orm import validates
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import deferred, validates
 
 @login_manager.user_loader
 def load_user(id):
@@ -49,6 +52,7 @@ class QuickLink(db.Model):
     def to_dict(self):
         """Serialize quick link data for backup"""
         return {
+            'id': self.id,
             'title': self.title,
             'url': self.url,
             'icon': self.icon,
@@ -65,6 +69,8 @@ class User(UserMixin, db.Model):
     color = db.Column(db.String(7), default="#3498db")  # Default color for calendar
     timezone = db.Column(db.String(50), default='UTC')  # New timezone field
     theme_preference = db.Column(db.String(20), default='dark')  # Theme preference (dark/light)
+    digest_minutes = db.Column(db.Integer)  # Notification digest window; None follows the site setting, 0 sends immediately
+    updated_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.UTC), onupdate=lambda: datetime.now(pytz.UTC))
     
     # Override email property to ensure lowercase
     @property
@@ -96,8 +102,10 @@ class User(UserMixin, db.Model):
         except pytz.exceptions.UnknownTimeZoneError:
             return current_app.config['TIMEZONE']
 
-    def to_dict(self):
-        """Serialize user data for backup"""
+    def to_dict(self, schedule_ids=None):
+        """Serialize user data for backup; schedule_ids may be passed in when prefetched"""
+        if schedule_ids is None:
+            schedule_ids = [schedule.id for schedule in self.schedules]
         return {
             'id': self.id,
             'username': self.username,
@@ -107,9 +115,14 @@ class User(UserMixin, db.Model):
             'color': self.color,
             'timezone': self.timezone,
             'theme_preference': self.theme_preference,
-            'created_schedules': [schedule.id for schedule in self.schedules]
+            'created_schedules': schedule_ids
         }
 
+# Longest schedule entry that can be saved. Bounding the length lets overlap
+# queries bound start_time from both sides, so they stay an index range scan
+# instead of walking every earlier schedule.
+MAX_SHIFT_LENGTH = timedelta(days=14)
+
 class Schedule(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     technician_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -119,8 +132,42 @@ class Schedule(db.Model):
     location_id = db.Column(db.Integer, db.ForeignKey('location.id'))
     location = db.relationship('Location', backref='schedules')
     created_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(current_app.config['TIMEZONE']))
+    updated_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.UTC), onupdate=lambda: datetime.now(pytz.UTC))
     time_off = db.Column(db.Boolean, default=False)  # For time off entries
 
+    __table_args__ = (
+        # Per-technician lookups (personal schedule, overlap checks)
+        db.Index('idx_schedule_technician_start', 'technician_id', 'start_time'),
+        # Window lookups (calendar week, active users)
+        db.Index('idx_schedule_time', 'start_time', 'end_time'),
+        # Time off is a small slice of the table, so keep a partial index for it
+        db.Index('idx_schedule_time_off', 'start_time',
+                 postgresql_where=db.text('time_off = true'),
+                 sqlite_where=db.text('time_off = 1')),
+    )
+
+    @classmethod
+    def overlapping(cls, start, end, technician=None, location=None, time_off=None, exclude_id=None):
+        """
+        Query schedules whose [start_time, end_time) interval overlaps [start, end).
+        technician and location accept either a model instance or an id.
+        time_off=True/False restricts to time off or working entries.
+        Returns an unexecuted query ordered by start_time.
+        """
+        # No schedule is longer than MAX_SHIFT_LENGTH, so one overlapping start can only start that much earlier
+        query = cls.query.filter(cls.start_time > start - MAX_SHIFT_LENGTH, cls.start_time < end, cls.end_time > start)
+        if technician is not None:
+            query = query.filter(cls.technician_id == getattr(technician, 'id', technician))
+        if location is not None:
+            query = query.filter(cls.location_id == getattr(location, 'id', location))
+        if time_off is True:
+            query = query.filter(cls.time_off == True)
+        elif time_off is False:
+            query = query.filter(~cls.time_off)
+        if exclude_id is not None:
+            query = query.filter(cls.id != exclude_id)
+        return query.order_by(cls.start_time)
+
     def to_dict(self):
         """Serialize schedule data for backup with reference data"""
         return {
@@ -136,6 +183,103 @@ class Schedule(db.Model):
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
 
+class ScheduleRule(db.Model):
+    """
+    A weekly recurring shift, e.g. "Mon/Wed/Fri 09:00-17:00 until June 30".
+
+    Rules are stored once and expanded into concrete occurrences only for the
+    window being viewed (see occurrences()), instead of materializing a
+    Schedule row per day. Times are wall-clock times in the rule's timezone,
+    so a 09:00 shift stays at 09:00 across daylight saving changes.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    technician_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    technician = db.relationship('User', backref=db.backref('schedule_rules', lazy='dynamic'))
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'))
+    location = db.relationship('Location', backref='schedule_rules')
+    description = db.Column(db.String(200))
+    time_off = db.Column(db.Boolean, default=False)
+    weekdays = db.Column(db.String(20), nullable=False)  # Comma-separated, Monday=0 .. Sunday=6
+    start_time = db.Column(db.Time, nullable=False)  # Local wall-clock start
+    end_time = db.Column(db.Time, nullable=False)  # Local wall-clock end; <= start_time ends the next day
+    timezone = db.Column(db.String(50), nullable=False, default='UTC')
+    start_date = db.Column(db.Date, nullable=False)
+    until_date = db.Column(db.Date)  # Inclusive; None repeats indefinitely
+    exceptions = db.Column(db.Text, default='')  # Comma-separated ISO dates that are skipped
+    created_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.UTC))
+    updated_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.UTC), onupdate=lambda: datetime.now(pytz.UTC))
+
+    def __repr__(self):
+        return f'<ScheduleRule {self.technician_id} {self.weekdays} {self.start_time}-{self.end_time}>'
+
+    def get_weekdays(self) -> List[int]:
+        return sorted(int(day) for day in (self.weekdays or '').split(',') if day.strip())
+
+    def set_weekdays(self, weekdays) -> None:
+        self.weekdays = ','.join(str(day) for day in sorted(set(weekdays)))
+
+    def get_exceptions(self) -> set:
+        return {date.fromisoformat(day) for day in (self.exceptions or '').split(',') if day.strip()}
+
+    def add_exception(self, day: date) -> None:
+        """Skip the occurrence on the given local date"""
+        exceptions = self.get_exceptions()
+        exceptions.add(day)
+        self.exceptions = ','.join(sorted(d.isoformat() for d in exceptions))
+
+    def get_timezone(self):
+        try:
+            return pytz.timezone(self.timezone)
+        except pytz.exceptions.UnknownTimeZoneError:
+            return pytz.UTC
+
+    def occurrences(self, window_start, window_end):
+        """
+        Yield (local_date, start_utc, end_utc) for every occurrence overlapping
+        [window_start, window_end), which must be timezone-aware.
+        """
+        tz = self.get_timezone()
+        weekdays = set(self.get_weekdays())
+        exceptions = self.get_exceptions()
+        overnight = self.end_time <= self.start_time
+
+        # Start a day early so an overnight shift running into the window is included
+        day = max(self.start_date, window_start.astimezone(tz).date() - timedelta(days=1))
+        last_day = window_end.astimezone(tz).date()
+        if self.until_date:
+            last_day = min(last_day, self.until_date)
+
+        while day <= last_day:
+            if day.weekday() in weekdays and day not in exceptions:
+                start = tz.localize(datetime.combine(day, self.start_time)).astimezone(pytz.UTC)
+                end_day = day + timedelta(days=1) if overnight else day
+                end = tz.localize(datetime.combine(end_day, self.end_time)).astimezone(pytz.UTC)
+                if start < window_end and end > window_start:
+                    yield day, start, end
+            day += timedelta(days=1)
+
+    def to_dict(self):
+        """Serialize schedule rule data for backup with reference data"""
+        return {
+            'id': self.id,
+            'technician_id': self.technician_id,
+            'technician_username': self.technician.username,
+            'location_id': self.location_id,
+            'location_name': self.location.name if self.location else None,
+            'description': self.description,
+            'time_off': self.time_off,
+            'weekdays': self.weekdays,
+            # Wall-clock times; not start_time/end_time, which backups treat as timestamps
+            'shift_start': self.start_time.strftime('%H:%M'),
+            'shift_end': self.end_time.strftime('%H:%M'),
+            'timezone': self.timezone,
+            'start_date': self.start_date.isoformat(),
+            'until_date': self.until_date.isoformat() if self.until_date else None,
+            'exceptions': self.exceptions or '',
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
 class TicketCategory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False, unique=True)
@@ -143,6 +287,7 @@ class TicketCategory(db.Model):
     icon = db.Column(db.String(50), default='help-circle')  # Feather icon name
     priority_level = db.Column(db.Integer, default=0)  # Higher number = higher priority
     created_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.UTC))
+    updated_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.UTC), onupdate=lambda: datetime.now(pytz.UTC))
     tickets = db.relationship('Ticket', backref='category', lazy='dynamic')
 
     def __repr__(self):
@@ -179,6 +324,15 @@ class Ticket(db.Model):
     updated_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.UTC), onupdate=lambda: datetime.now(pytz.UTC))
     due_date = db.Column(db.DateTime(timezone=True))
     archived = db.Column(db.Boolean, default=False)  # Flag for archived tickets
+    # Full-text search document (title, description and comments), maintained by
+    # triggers on PostgreSQL; stays empty on SQLite, where search falls back to LIKE
+    search_vector = deferred(db.Column(db.Text().with_variant(TSVECTOR(), 'postgresql')))
+
+    __table_args__ = (
+        # Keyset pages of the dashboard, newest first
+        db.Index('idx_ticket_created_id', 'created_at', 'id'),
+        db.Index('idx_ticket_search', 'search_vector', postgresql_using='gin'),
+    )
 
     comments = db.relationship('TicketComment', backref='ticket', lazy='dynamic', cascade='all, delete-orphan')
     history = db.relationship('TicketHistory', backref='ticket', lazy='dynamic', cascade='all, delete-orphan')
@@ -206,8 +360,15 @@ class Ticket(db.Model):
         db.session.add(history)
         return history
         
-    def to_dict(self):
-        """Serialize ticket data for backup with reference data"""
+    def to_dict(self, comments=None, history=None):
+        """
+        Serialize ticket data for backup with reference data.
+        comments and history may be passed in when prefetched for a batch of tickets.
+        """
+        if comments is None:
+            comments = self.comments
+        if history is None:
+            history = self.history
         return {
             'id': self.id,
             'title': self.title,
@@ -226,8 +387,8 @@ class Ticket(db.Model):
             'creator_username': self.creator.username if self.creator else None,
             'assigned_username': self.assigned_technician.username if self.assigned_technician else None,
             # Include associated data
-            'comments': [comment.to_dict() for comment in self.comments],
-            'history': [history.to_dict() for history in self.history]
+            'comments': [comment.to_dict() for comment in comments],
+            'history': [entry.to_dict() for entry in history]
         }
 
 class TicketComment(db.Model):
@@ -239,6 +400,11 @@ class TicketComment(db.Model):
     created_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.UTC))
     updated_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.UTC), onupdate=lambda: datetime.now(pytz.UTC))
 
+    __table_args__ = (
+        # Keyset pages of a ticket's timeline, newest first
+        db.Index('idx_ticket_comment_timeline', 'ticket_id', 'created_at', 'id'),
+    )
+
     user = db.relationship('User', backref='ticket_comments')
     
     def to_dict(self):
@@ -253,6 +419,56 @@ class TicketComment(db.Model):
             'username': self.user.username if self.user else None
         }
 
+# Keeps ticket.search_vector current: weighted title (A), description (B) and
+# comment text (C), rebuilt when a ticket's text or any of its comments change.
+# Also in init.sql and update_schema.sql for databases not made by create_all().
+TICKET_SEARCH_DDL = [
+    """
+    CREATE OR REPLACE FUNCTION ticket_search_document(ticket_id INTEGER, title TEXT, description TEXT)
+    RETURNS tsvector AS $$
+        SELECT setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+               setweight(to_tsvector('english', coalesce(description, '')), 'B') ||
+               setweight(to_tsvector('english', coalesce(
+                   (SELECT string_agg(content, ' ') FROM ticket_comment WHERE ticket_comment.ticket_id = $1), '')), 'C')
+    $$ LANGUAGE sql STABLE
+    """,
+    """
+    CREATE OR REPLACE FUNCTION ticket_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector := ticket_search_document(NEW.id, NEW.title, NEW.description);
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE FUNCTION ticket_comment_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            UPDATE ticket SET search_vector = ticket_search_document(id, title, description) WHERE id = OLD.ticket_id;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            UPDATE ticket SET search_vector = ticket_search_document(id, title, description) WHERE id = NEW.ticket_id;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS ticket_search_vector_update ON ticket",
+    """
+    CREATE TRIGGER ticket_search_vector_update BEFORE INSERT OR UPDATE OF title, description ON ticket
+    FOR EACH ROW EXECUTE FUNCTION ticket_search_vector_update()
+    """,
+    "DROP TRIGGER IF EXISTS ticket_comment_search_vector_update ON ticket_comment",
+    """
+    CREATE TRIGGER ticket_comment_search_vector_update AFTER INSERT OR UPDATE OF content, ticket_id OR DELETE
+    ON ticket_comment FOR EACH ROW EXECUTE FUNCTION ticket_comment_search_vector_update()
+    """,
+]
+
+# ticket_comment is created after ticket, and the functions read it
+for statement in TICKET_SEARCH_DDL:
+    event.listen(TicketComment.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+
 class TicketHistory(db.Model):
     # Use db.sequence to generate unique IDs
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -262,6 +478,10 @@ class TicketHistory(db.Model):
     details = db.Column(db.Text)  # Additional details about the action
     created_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.UTC))
 
+    __table_args__ = (
+        db.Index('idx_ticket_history_timeline', 'ticket_id', 'created_at', 'id'),
+    )
+
     user = db.relationship('User', backref='ticket_history_entries')
     
     def to_dict(self):
@@ -282,6 +502,7 @@ class EmailSettings(db.Model):
     notify_on_create = db.Column(db.Boolean, default=True)
     notify_on_update = db.Column(db.Boolean, default=True)
     notify_on_delete = db.Column(db.Boolean, default=True)
+    digest_minutes = db.Column(db.Integer, nullable=False, default=0)  # Default window for coalescing notifications; 0 (the default) disables digests
     created_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.UTC))
     updated_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.UTC), onupdate=lambda: datetime.now(pytz.UTC))
 
@@ -291,5 +512,130 @@ class EmailSettings(db.Model):
             'admin_email_group': self.admin_email_group,
             'notify_on_create': self.notify_on_create,
             'notify_on_update': self.notify_on_update,
-            'notify_on_delete': self.notify_on_delete
-        }
\ No newline at end of file
+            'notify_on_delete': self.notify_on_delete,
+            'digest_minutes': self.digest_minutes
+        }
+
+class JobStatus:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+class BackgroundJob(db.Model):
+    """A long-running admin operation (backup, restore, export, batch archive) run off the request thread"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default=JobStatus.QUEUED)
+    params = db.Column(db.Text)  # JSON arguments for the job handler
+    progress = db.Column(db.Integer)  # Percent complete; None while unknown
+    message = db.Column(db.String(500))
+    error = db.Column(db.Text)
+    # Downloadable output, if the job produces a file
+    result_path = db.Column(db.String(500))
+    result_name = db.Column(db.String(200))
+    result_mimetype = db.Column(db.String(100))
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.UTC))
+    started_at = db.Column(db.DateTime(timezone=True))
+    finished_at = db.Column(db.DateTime(timezone=True))
+    # The process (host:pid) running the job, and its last heartbeat
+    owner = db.Column(db.String(200))
+    updated_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.UTC),
+                           onupdate=lambda: datetime.now(pytz.UTC))
+
+    creator = db.relationship('User', backref=db.backref('background_jobs', lazy='dynamic'))
+
+    __table_args__ = (
+        db.Index('idx_background_job_created', 'created_at'),
+    )
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (JobStatus.SUCCEEDED, JobStatus.FAILED)
+
+    def to_dict(self):
+        """Serialize job state for the status endpoint"""
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'message': self.message,
+            'error': self.error,
+            'has_result': bool(self.result_path) and self.status == JobStatus.SUCCEEDED,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+class EmailStatus:
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+class OutboxEmail(db.Model):
+    """An email waiting to be sent (or already sent) by the outbox dispatcher"""
+    id = db.Column(db.Integer, primary_key=True)
+    recipients = db.Column(db.Text, nullable=False)  # JSON list of addresses
+    from_email = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(300), nullable=False)
+    html_content = db.Column(db.Text, nullable=False)
+    text_content = db.Column(db.Text)  # Plain-text alternate
+    status = db.Column(db.String(20), nullable=False, default=EmailStatus.PENDING)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime(timezone=True), nullable=False, default=lambda: datetime.now(pytz.UTC))
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.UTC))
+    sent_at = db.Column(db.DateTime(timezone=True))
+
+    __table_args__ = (
+        # The dispatcher's queue scan
+        db.Index('idx_outbox_email_due', 'status', 'next_attempt_at'),
+    )
+
+    @property
+    def recipient_list(self) -> List[str]:
+        return json.loads(self.recipients)
+
+class PendingNotification(db.Model):
+    """A notification held back to be sent to one recipient as part of a digest"""
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(300), nullable=False)
+    html_content = db.Column(db.Text, nullable=False)
+    text_content = db.Column(db.Text)
+    send_after = db.Column(db.DateTime(timezone=True), nullable=False)  # When the recipient's digest is due
+    created_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.UTC))
+
+    __table_args__ = (
+        db.Index('idx_pending_notification_due', 'send_after'),
+        db.Index('idx_pending_notification_recipient', 'recipient'),
+    )
+
+class DeletedRecord(db.Model):
+    """Tombstone for a deleted row, so incremental backups can carry deletions"""
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(50), nullable=False)
+    record_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime(timezone=True), nullable=False, default=lambda: datetime.now(pytz.UTC))
+
+    __table_args__ = (
+        db.Index('idx_deleted_record_deleted_at', 'deleted_at'),
+    )
+
+    def to_dict(self):
+        """Serialize the tombstone for an incremental backup"""
+        return {
+            'table': self.table_name,
+            'id': self.record_id,
+            'deleted_at': self.deleted_at.isoformat() if self.deleted_at else None
+        }
+
+class BackupRecord(db.Model):
+    """A completed backup; its watermark is where the next incremental backup starts"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # 'full' or 'incremental'
+    since = db.Column(db.DateTime(timezone=True))  # Start of an incremental backup's window
+    watermark = db.Column(db.DateTime(timezone=True), nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(pytz.UTC))
@@ -1,7 +1,8 @@
-from flask import render_template, redirect, url_for, flash, request, jsonify, send_file, make_response
+from flask import (render_template, redirect, url_for, flash, request, jsonify, send_file, make_response,
+                   Response, stream_with_context)
 from flask_login import login_user, logout_user, login_required, current_user
 from app import app, db, is_mobile_device
-from models import User, Schedule, QuickLink, Location, EmailSettings, TicketCategory, Ticket, TicketComment, TicketHistory, TicketStatus
+from models import User, Schedule, ScheduleRule, QuickLink, Location, EmailSettings, TicketCategory, Ticket, TicketComment, TicketHistory, TicketStatus, BackgroundJob, MAX_SHIFT_LENGTH
 from forms import (
     LoginForm, RegistrationForm, ScheduleForm, AdminUserForm, EditUserForm, 
     ChangePasswordForm, QuickLinkForm, LocationForm, EmailSettingsForm
@@ -9,18 +10,30 @@ from forms import (
 from datetime import datetime, timedelta, time
 import pytz
 import csv
+from calendar import day_abbr
 import random
 import string
 from io import StringIO
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill
-from io import BytesIO
 import json
 import os
+import tempfile
 from werkzeug.utils import secure_filename
 from email_utils import send_schedule_notification
+from email_outbox import DIGEST_CHOICES
+from backup_utils import generate_backup, incremental_since, restore_backup_chain, write_columnar_backup
+from export_utils import (DEFAULT_EXPORT_TIMEZONE, EXPORT_FORMATS, export_period, write_export,
+                          write_timesheet_xlsx, generate_timesheet_csv, generate_timesheet_ndjson)
+from jobs import job_handler, job_error, job_response, recent_jobs, save_upload, start_job
+from schedule_utils import (load_week_schedules, active_shifts, format_active_shifts, upcoming_time_off,
+                            time_off_cache, find_shift_conflicts, insert_schedules, rule_occurrences,
+                            copy_week, diff_week_copy)
 from flask import session
 
+# How far ahead a new recurring schedule is checked for conflicting shifts
+RULE_CONFLICT_HORIZON_DAYS = 90
+# Most weeks a previous week can be copied into at once
+MAX_COPY_WEEKS = 12
+
 @app.route('/')
 def index():
     if current_user.is_authenticated:
@@ -86,59 +99,8 @@ def get_active_users():
         return jsonify({'error': 'Authentication required'}), 401
 
     try:
-        # Get current time in UTC since our database stores times in UTC
-        current_time = datetime.now(pytz.UTC)
-        app.logger.debug(f"Current time (UTC): {current_time}")
-        
-        # Find who is actively scheduled right now
-        active_users_query = (db.session.query(
-                User, Schedule, Location
-            )
-            .join(Schedule, User.id == Schedule.technician_id)
-            .outerjoin(Location, Schedule.location_id == Location.id)
-            .filter(
-                Schedule.start_time <= current_time,
-                Schedule.end_time > current_time,
-                ~Schedule.time_off  # Exclude time off entries
-            ))
-            
-        app.logger.debug(f"Active users query SQL: {str(active_users_query)}")
-        active_users_data = active_users_query.all()
-        app.logger.debug(f"Found {len(active_users_data)} active schedules")
-
-        # Build the result - only show currently active users
-        result = []
-        
-        # Process active users data
-        user_tz = current_user.get_timezone()
-        for user, schedule, location in active_users_data:
-            # Skip if any key component is None
-            if not user or not schedule:
-                app.logger.warning(f"Skipping schedule with missing user or schedule data")
-                continue
-                
-            try:
-                # Convert schedule times to user's timezone
-                start_time = schedule.start_time.astimezone(user_tz)
-                end_time = schedule.end_time.astimezone(user_tz)
-                
-                # Add this active user to the result
-                result.append({
-                    'username': user.username,
-                    'color': user.color,
-                    'schedule': {
-                        'start_time': start_time.strftime('%H:%M'),
-                        'end_time': end_time.strftime('%H:%M'),
-                        'description': schedule.description or ''
-                    },
-                    'location': {
-                        'name': location.name if location else 'No Location',
-                        'description': location.description if location else ''
-                    }
-                })
-            except Exception as inner_e:
-                app.logger.error(f"Error processing schedule for user {user.id}: {str(inner_e)}")
-                # Continue processing other users
+        # Served from the shared snapshot; only the timezone formatting is per user
+        result = format_active_shifts(active_shifts.get(), current_user.get_timezone())
 
         app.logger.debug(f"Returning {len(result)} active users")
         return jsonify(result)
@@ -163,18 +125,24 @@ def profile():
         return render_template('mobile_profile.html', 
                              form=form, 
                              password_form=password_form,
-                             timezones=pytz.common_timezones)
+                             timezones=pytz.common_timezones,
+                             digest_choices=DIGEST_CHOICES)
     
     # Use desktop template
-    return render_template('profile.html', form=form, password_form=password_form)
+    return render_template('profile.html', form=form, password_form=password_form, digest_choices=DIGEST_CHOICES)
 
 @app.route('/profile/update', methods=['POST'])
 @login_required
 def update_profile():
     color = request.form.get('color')
-    if color:
+    digest_minutes = request.form.get('digest_minutes')
+    if color or digest_minutes is not None:
         try:
-            current_user.color = color
+            if color:
+                current_user.color = color
+            if digest_minutes is not None:
+                # An empty choice follows the site setting
+                current_user.digest_minutes = int(digest_minutes) if digest_minutes else None
             db.session.commit()
             flash('Profile updated successfully!')
         except Exception as e:
@@ -269,31 +237,11 @@ def calendar():
     week_start_utc = week_start.astimezone(pytz.UTC)
     week_end_utc = (week_start + timedelta(days=7)).astimezone(pytz.UTC)
 
-    # Query schedules in UTC with optional location filter
-    query = Schedule.query.filter(
-        Schedule.start_time >= week_start_utc,
-        Schedule.start_time < week_end_utc
+    # Load the week's schedules (with technicians and locations) in the user's timezone
+    schedules = load_week_schedules(
+        week_start_utc, week_end_utc, current_user.get_timezone(), location=location_filter or None
     )
 
-    if location_filter:
-        query = query.filter(Schedule.location_id == location_filter)
-        
-    # Order by start_time to ensure chronological display
-    query = query.order_by(Schedule.start_time)
-
-    schedules = query.all()
-
-    # Convert schedule times to user's timezone
-    user_tz = current_user.get_timezone()
-    for schedule in schedules:
-        if schedule.start_time.tzinfo is None:
-            schedule.start_time = pytz.UTC.localize(schedule.start_time)
-        if schedule.end_time.tzinfo is None:
-            schedule.end_time = pytz.UTC.localize(schedule.end_time)
-
-        schedule.start_time = schedule.start_time.astimezone(user_tz)
-        schedule.end_time = schedule.end_time.astimezone(user_tz)
-
     form = ScheduleForm()
     if current_user.is_admin:
         form.technician.choices = [(u.id, u.username) for u in User.query.all()]
@@ -301,11 +249,9 @@ def calendar():
         form.technician.choices = [(current_user.id, current_user.username)]
         form.technician.data = current_user.id
 
-    # Add location choices to the form
-    form.location_id.choices = [(l.id, l.name) for l in Location.query.filter_by(active=True).order_by(Location.name).all()]
-
-    # Get all active locations for the filter dropdown
+    # Get all active locations for the filter dropdown and the form choices
     locations = Location.query.filter_by(active=True).order_by(Location.name).all()
+    form.location_id.choices = [(l.id, l.name) for l in locations]
 
     # Debug the mobile detection
     print(f"is_mobile_device() in calendar: {is_mobile_device()}")
@@ -459,14 +405,24 @@ def new_schedule():
                 flash('End time must be after start time.')
                 return redirect(url_for('calendar', week_start=week_start))
 
-            overlapping_query = Schedule.query.filter(
-                Schedule.technician_id == technician_id,
-                Schedule.id != (int(schedule_id) if schedule_id else None),
-                Schedule.start_time < end_time_utc,
-                Schedule.end_time > start_time_utc
-            )
+            if end_time_utc - start_time_utc > MAX_SHIFT_LENGTH:
+                flash(f'Schedules can be at most {MAX_SHIFT_LENGTH.days} days long.')
+                return redirect(url_for('calendar', week_start=week_start))
 
-            overlapping_schedules = overlapping_query.first()
+            overlapping_schedules = Schedule.overlapping(
+                start_time_utc, end_time_utc,
+                technician=technician_id,
+                exclude_id=int(schedule_id) if schedule_id else None
+            ).first()
+
+            # Editing one occurrence of a recurring rule detaches it into a regular schedule
+            rule_id = request.form.get('rule_id', type=int)
+            occurrence_date = request.form.get('occurrence_date')
+            if not overlapping_schedules:
+                overlapping_schedules = next((
+                    occurrence for occurrence in rule_occurrences.get(start_time_utc, end_time_utc, technician=technician_id)
+                    if not (occurrence.rule_id == rule_id and occurrence.occurrence_date.isoformat() == occurrence_date)
+                ), None)
 
             if overlapping_schedules and not form.time_off.data:
                 flash('Schedule conflicts with existing appointments.')
@@ -530,7 +486,60 @@ def new_schedule():
                 db.session.commit()
                 flash('Schedule updated successfully!')
                 
+            elif form.repeat_weekly.data and not rule_id:
+                # A weekly recurring shift is stored once as a rule and expanded when viewed
+                primary_date = form.start_time.data.date()
+                weekdays = {primary_date.weekday()}
+                for date_str in (repeat_days.split(',') if isinstance(repeat_days, str) else repeat_days or []):
+                    try:
+                        weekdays.add(datetime.strptime(date_str.strip(), '%Y-%m-%d').weekday())
+                    except ValueError:
+                        app.logger.warning(f"Invalid date format ignored: {date_str}")
+
+                rule = ScheduleRule(
+                    technician_id=technician_id,
+                    location_id=form.location_id.data if form.location_id.data != 0 else None,
+                    description=form.description.data,
+                    time_off=form.time_off.data,
+                    start_time=form.start_time.data.time(),
+                    end_time=form.end_time.data.time(),
+                    timezone=user_tz.zone,
+                    start_date=primary_date,
+                    until_date=form.repeat_until.data
+                )
+                rule.set_weekdays(weekdays)
+
+                if not form.time_off.data:
+                    # Skip the dates that clash with existing shifts over the next few months
+                    horizon = start_time_utc + timedelta(days=RULE_CONFLICT_HORIZON_DAYS)
+                    day_ranges = [(day.isoformat(), start, end) for day, start, end in rule.occurrences(start_time_utc, horizon)]
+                    conflicts = find_shift_conflicts(technician_id, day_ranges)
+                    for date_str in conflicts:
+                        rule.add_exception(datetime.strptime(date_str, '%Y-%m-%d').date())
+                    if conflicts:
+                        skipped = ', '.join(datetime.strptime(d, '%Y-%m-%d').strftime('%a %b %d') for d in sorted(conflicts))
+                        flash(f"Skipped {len(conflicts)} date{'s' if len(conflicts) != 1 else ''} with conflicting shifts: {skipped}")
+
+                db.session.add(rule)
+                db.session.flush()
+                days = ', '.join(day_abbr[day] for day in rule.get_weekdays())
+                send_schedule_notification(rule, 'created',
+                    f"Recurring schedule ({days}) created by {current_user.username}")
+                db.session.commit()
+                flash('Recurring schedule created successfully!')
+
             else:
+                if rule_id and occurrence_date:
+                    rule = ScheduleRule.query.get_or_404(rule_id)
+                    if rule.technician_id != current_user.id and not current_user.is_admin:
+                        flash('You do not have permission to edit this schedule.')
+                        if personal_view:
+                            return redirect(url_for('personal_schedule', week_start=week_start))
+                        else:
+                            return redirect(url_for('calendar', week_start=week_start))
+                    rule.add_exception(datetime.strptime(occurrence_date, '%Y-%m-%d').date())
+                    app.logger.debug(f"Detached {occurrence_date} from schedule rule {rule_id}")
+
                 # Creating new schedule(s)
                 schedules_created = 0
                 
@@ -616,7 +625,8 @@ def new_schedule():
                         app.logger.debug("No additional dates selected besides primary date")
                         # We already created the primary schedule, so continue processing
                     
-                    # Create a schedule for each selected day
+                    # Work out every selected day's times, then check them all at once
+                    day_ranges = []
                     for date_str in dates:
                         # Parse the date
                         day_date = datetime.strptime(date_str.strip(), '%Y-%m-%d').date()
@@ -640,30 +650,38 @@ def new_schedule():
                         # Handle midnight end time
                         if end_time.hour == 0 and end_time.minute == 0:
                             day_end_time_utc = day_end_time_utc + timedelta(days=1)
-                            
-                        # Check for overlapping schedules for this specific day
-                        overlapping_query = Schedule.query.filter(
-                            Schedule.technician_id == technician_id,
-                            Schedule.start_time < day_end_time_utc,
-                            Schedule.end_time > day_start_time_utc
-                        )
-                        overlapping_schedule = overlapping_query.first()
-                        
-                        if overlapping_schedule and not form.time_off.data:
+
+                        day_ranges.append((date_str, day_start_time_utc, day_end_time_utc))
+
+                    # Time off may overlap existing shifts, so only regular shifts are checked
+                    conflicts = {} if form.time_off.data else find_shift_conflicts(technician_id, day_ranges)
+
+                    new_rows = []
+                    for date_str, day_start_time_utc, day_end_time_utc in day_ranges:
+                        if date_str in conflicts:
                             app.logger.warning(f"Skipping schedule for {date_str} due to conflict")
                             continue
-                            
-                        # Create the schedule for this day
-                        schedule = Schedule(
-                            technician_id=technician_id,
-                            start_time=day_start_time_utc,
-                            end_time=day_end_time_utc,
-                            description=form.description.data,
-                            time_off=form.time_off.data,
-                            location_id=form.location_id.data if form.location_id.data != 0 else None
-                        )
-                        db.session.add(schedule)
-                        schedules_created += 1
+                        new_rows.append({
+                            'technician_id': technician_id,
+                            'start_time': day_start_time_utc,
+                            'end_time': day_end_time_utc,
+                            'description': form.description.data,
+                            'time_off': form.time_off.data,
+                            'location_id': form.location_id.data if form.location_id.data != 0 else None
+                        })
+                    schedules_created += insert_schedules(new_rows)
+
+                    if conflicts:
+                        # Tell the user which dates were skipped and what they clash with
+                        skipped = []
+                        for date_str, shifts in conflicts.items():
+                            day_label = datetime.strptime(date_str, '%Y-%m-%d').strftime('%a %b %d')
+                            times = ', '.join(
+                                f"{shift_start.astimezone(user_tz).strftime('%H:%M')}-{shift_end.astimezone(user_tz).strftime('%H:%M')}"
+                                for shift_start, shift_end in shifts
+                            )
+                            skipped.append(f"{day_label} (existing shift {times})")
+                        flash(f"Skipped {len(conflicts)} date{'s' if len(conflicts) != 1 else ''} with conflicting shifts: {'; '.join(skipped)}")
                         
                     if schedules_created > 0:
                         send_schedule_notification(primary_schedule, 'created', 
@@ -760,6 +778,66 @@ def delete_schedule(schedule_id):
     else:
         return redirect(url_for('calendar', week_start=week_start))
 
+def _load_own_rule(rule_id):
+    """Get a schedule rule the current user may change, or None after flashing why not"""
+    rule = ScheduleRule.query.get(rule_id)
+    if not rule:
+        flash('Recurring schedule not found or already deleted.')
+        return None
+    if rule.technician_id != current_user.id and not current_user.is_admin:
+        flash('You do not have permission to change this schedule.')
+        return None
+    return rule
+
+@app.route('/schedule/rule/<int:rule_id>/skip', methods=['POST'])
+@login_required
+def skip_schedule_occurrence(rule_id):
+    """Remove a single occurrence of a recurring schedule"""
+    week_start = request.form.get('week_start')
+    personal_view = request.form.get('personal_view') == 'true'
+
+    rule = _load_own_rule(rule_id)
+    if rule:
+        try:
+            occurrence_date = datetime.strptime(request.form.get('date', ''), '%Y-%m-%d').date()
+            rule.add_exception(occurrence_date)
+            db.session.commit()
+            flash('Schedule deleted successfully!')
+        except ValueError:
+            flash('Invalid date.')
+        except Exception as e:
+            db.session.rollback()
+            flash('Error deleting schedule.')
+            app.logger.error(f"Error skipping occurrence of schedule rule {rule_id}: {str(e)}")
+
+    if personal_view:
+        return redirect(url_for('personal_schedule', week_start=week_start))
+    else:
+        return redirect(url_for('calendar', week_start=week_start))
+
+@app.route('/schedule/rule/delete/<int:rule_id>', methods=['POST'])
+@login_required
+def delete_schedule_rule(rule_id):
+    """Delete a recurring schedule and every occurrence of it"""
+    week_start = request.form.get('week_start')
+    personal_view = request.form.get('personal_view') == 'true'
+
+    rule = _load_own_rule(rule_id)
+    if rule:
+        try:
+            db.session.delete(rule)
+            db.session.commit()
+            flash('Recurring schedule deleted successfully!')
+        except Exception as e:
+            db.session.rollback()
+            flash('Error deleting recurring schedule.')
+            app.logger.error(f"Error deleting schedule rule {rule_id}: {str(e)}")
+
+    if personal_view:
+        return redirect(url_for('personal_schedule', week_start=week_start))
+    else:
+        return redirect(url_for('calendar', week_start=week_start))
+
 @app.route('/schedule/copy_previous_week', methods=['POST'])
 @login_required
 def copy_previous_week_schedules():
@@ -777,6 +855,13 @@ def copy_previous_week_schedules():
             flash('Invalid week start date.')
             return redirect(url_for('calendar'))
 
+        # Copy into this many consecutive weeks, starting at the target week
+        week_count = request.form.get('weeks', 1, type=int)
+        if not 1 <= week_count <= MAX_COPY_WEEKS:
+            flash(f'Schedules can be copied to between 1 and {MAX_COPY_WEEKS} weeks.')
+            return redirect(url_for('calendar', week_start=target_week_start_str))
+        dry_run = request.form.get('dry_run') == 'true'
+
         user_tz = current_user.get_timezone()
 
         # Convert target week start to user's timezone
@@ -785,48 +870,34 @@ def copy_previous_week_schedules():
         )
         previous_week_start = target_week_start - timedelta(days=7)
 
-        # Convert to UTC for database operations
-        target_week_start_utc = target_week_start.astimezone(pytz.UTC)
-        target_week_end_utc = (target_week_start + timedelta(days=7)).astimezone(pytz.UTC)
+        # Convert to UTC for database operations; localizing each week separately
+        # keeps shifts at the same wall-clock time across daylight saving changes
         previous_week_start_utc = previous_week_start.astimezone(pytz.UTC)
-        previous_week_end_utc = (previous_week_start + timedelta(days=7)).astimezone(pytz.UTC)
-
-        app.logger.debug(f"Copying schedules from {previous_week_start_utc} to {previous_week_end_utc}")
-        app.logger.debug(f"To target week: {target_week_start_utc} to {target_week_end_utc}")
+        target_week_starts_utc = [
+            user_tz.localize(target_week_start.replace(tzinfo=None) + timedelta(days=7 * week)).astimezone(pytz.UTC)
+            for week in range(week_count)
+        ]
 
-        # Get previous week's schedules
-        previous_schedules = Schedule.query.filter(
-            Schedule.start_time >= previous_week_start_utc,
-            Schedule.start_time < previous_week_end_utc
-        ).all()
+        app.logger.debug(f"Copying schedules from week of {previous_week_start_utc} "
+                         f"to {week_count} week(s) starting {target_week_starts_utc[0]}")
 
-        if not previous_schedules:
-            flash('No schedules found in previous week to copy.')
-            return redirect(url_for('calendar'))
+        if dry_run:
+            # Report what the copy would change without touching anything
+            return jsonify(diff_week_copy(previous_week_start_utc, target_week_starts_utc))
 
         try:
-            # Delete existing schedules in target week
-            Schedule.query.filter(
-                Schedule.start_time >= target_week_start_utc,
-                Schedule.start_time < target_week_end_utc
-            ).delete()
-
-            # Copy schedules to new week
-            time_difference = target_week_start_utc - previous_week_start_utc
-
-            for schedule in previous_schedules:
-                new_schedule = Schedule(
-                    technician_id=schedule.technician_id,
-                    start_time=schedule.start_time + time_difference,
-                    end_time=schedule.end_time + time_difference,
-                    description=schedule.description,
-                    time_off=schedule.time_off,
-                    location_id=schedule.location_id
-                )
-                db.session.add(new_schedule)
+            copied = copy_week(previous_week_start_utc, target_week_starts_utc)
+
+            if not copied:
+                db.session.rollback()
+                flash('No schedules found in previous week to copy.')
+                return redirect(url_for('calendar'))
 
             db.session.commit()
-            flash(f'Successfully copied {len(previous_schedules)} schedules from previous week!')
+            if week_count == 1:
+                flash(f'Successfully copied {copied} schedules from previous week!')
+            else:
+                flash(f'Successfully copied {copied // week_count} schedules from previous week into the next {week_count} weeks!')
 
         except Exception as e:
             db.session.rollback()
@@ -835,6 +906,8 @@ def copy_previous_week_schedules():
 
     except Exception as e:
         app.logger.error(f"Error in copy_previous_week_schedules: {str(e)}")
+        if request.form.get('dry_run') == 'true':
+            return jsonify({'error': 'Error previewing the copy'}), 400
         flash('Error copying schedules from previous week.')
 
     return redirect(url_for('calendar', week_start=target_week_start_str))
@@ -866,7 +939,9 @@ def admin_dashboard():
                          users=users, 
                          form=form, 
                          edit_form=edit_form,
-                         quick_links=quick_links)
+                         quick_links=quick_links,
+                         export_timezones=pytz.common_timezones,
+                         default_export_timezone=DEFAULT_EXPORT_TIMEZONE)
 
 @app.route('/admin/create_user', methods=['POST'])
 @login_required
@@ -1067,9 +1142,13 @@ def admin_delete_user(user_id):
         assigned_tickets = Ticket.query.filter_by(assigned_to=user_id).all()
         for ticket in assigned_tickets:
             ticket.assigned_to = None
-            
+
+        # Reassign background jobs this user started
+        BackgroundJob.query.filter_by(created_by=user_id).update({'created_by': system_user.id})
+
         # Delete associated schedules
         Schedule.query.filter_by(technician_id=user_id).delete()
+        ScheduleRule.query.filter_by(technician_id=user_id).delete()
         
         # Now delete the user
         db.session.delete(user)
@@ -1100,25 +1179,10 @@ def personal_schedule():
     week_start_utc = week_start.astimezone(pytz.UTC)
     week_end_utc = (week_start + timedelta(days=7)).astimezone(pytz.UTC)
 
-    # Query schedules in UTC
-    schedules = Schedule.query.filter(
-        Schedule.technician_id == current_user.id,
-        Schedule.start_time >= week_start_utc,
-        Schedule.start_time < week_end_utc
-    ).order_by(Schedule.start_time).all()
-
-    # Convert schedule times to user's timezone
-    user_tz = current_user.get_timezone()
-    for schedule in schedules:
-        # Ensure times are timezone-aware in UTC
-        if schedule.start_time.tzinfo is None:
-            schedule.start_time = pytz.UTC.localize(schedule.start_time)
-        if schedule.end_time.tzinfo is None:
-            schedule.end_time = pytz.UTC.localize(schedule.end_time)
-
-        # Convert to user's timezone
-        schedule.start_time = schedule.start_time.astimezone(user_tz)
-        schedule.end_time = schedule.end_time.astimezone(user_tz)
+    # Load the user's schedules for the week in their timezone
+    schedules = load_week_schedules(
+        week_start_utc, week_end_utc, current_user.get_timezone(), technician=current_user
+    )
 
     form = ScheduleForm()
     form.technician.choices = [(current_user.id, current_user.username)]
@@ -1182,144 +1246,71 @@ def export_schedules():
             flash('Please select both start and end dates.')
             return redirect(url_for('admin_dashboard'))
 
-        # Convert dates to UTC datetime objects
-        start_datetime = pytz.timezone('America/Chicago').localize(
-            datetime.strptime(start_date, '%Y-%m-%d')
-        ).astimezone(pytz.UTC)
-        end_datetime = (pytz.timezone('America/Chicago').localize(
-            datetime.strptime(end_date, '%Y-%m-%d')
-        ) + timedelta(days=1)).astimezone(pytz.UTC)
-
-        # Create a new Excel workbook
-        wb = Workbook()
-        # Remove the default sheet
-        wb.remove(wb.active)
-
-        # Get all users sorted by username
-        users = User.query.order_by(User.username).all()
-
-        header_font = Font(bold=True)
-        header_fill = PatternFill(start_color='CCCCCC', end_color='CCCCCC', fill_type='solid')
-
-        for user in users:
-            # Get user's schedules for the date range
-            schedules = Schedule.query.filter(
-                Schedule.technician_id == user.id,
-                Schedule.start_time >= start_datetime,
-                Schedule.start_time < end_datetime
-            ).order_by(Schedule.start_time).all()
-
-            if not schedules:
-                continue
-
-            # Create a new worksheet for each user
-            ws = wb.create_sheet(title=user.username[:31])  # Excel limits sheet names to 31 chars
-
-            # Write header
-            ws['A1'] = f'Schedule Export - {user.username}'
-            ws['A2'] = f'Period: {start_date} to {end_date}'
-
-            # Calculate total hours
-            user_tz = pytz.timezone('America/Chicago')
-            total_minutes = 0
-
-            for schedule in schedules:
-                start_time = schedule.start_time.astimezone(user_tz)
-                end_time = schedule.end_time.astimezone(user_tz)
-                duration = (end_time - start_time).total_seconds() / 60
-                total_minutes += duration
-
-            total_hours = total_minutes // 60
-            ws['A4'] = 'Total Hours:'
-            ws['B4'] = f"{total_hours:.0f}:00:00"
-
-            # Write column headers
-            headers = ['Day', 'Date', 'Clock In', 'Clock Out', 'Total', 'Type', 'Notes']
-            for col, header in enumerate(headers, 1):
-                cell = ws.cell(row=6, column=col)
-                cell.value = header
-                cell.font = header_font
-                cell.fill = header_fill
-
-            row = 7
-            date_cursor = start_datetime.astimezone(user_tz)
-            end_date = end_datetime.astimezone(user_tz)
-
-            while date_cursor.date() < end_date.date():
-                day_schedules = [s for s in schedules 
-                               if s.start_time.astimezone(user_tz).date() == date_cursor.date()]
-
-                if day_schedules:
-                    for schedule in sorted(day_schedules, key=lambda s: s.start_time):
-                        start_time = schedule.start_time.astimezone(user_tz)
-                        end_time = schedule.end_time.astimezone(user_tz)
-                        minutes = int((end_time - start_time).total_seconds() / 60)
-                        hours = minutes // 60
-
-                        # Determine the type and notes
-                        entry_type = "Time Off" if schedule.time_off else "Work"
-                        notes = []
-                        if schedule.location:
-                            notes.append(f"Location: {schedule.location.name}")
-                        if schedule.time_off:
-                            notes.append("TIME OFF")
-                        if schedule.description:
-                            if "ON-CALL" in schedule.description.upper():
-                                notes.append("ON-CALL")
-                            elif "PLEX" in schedule.description.upper():
-                                notes.append("PLEX")
-                            else:
-                                notes.append(schedule.description)
-
-                        # Write schedule data
-                        ws.cell(row=row, column=1).value = start_time.strftime('%A')
-                        ws.cell(row=row, column=2).value = start_time.strftime('%-m/%-d/%Y')
-                        ws.cell(row=row, column=3).value = start_time.strftime('%-I:%M %p')
-                        ws.cell(row=row, column=4).value = end_time.strftime('%-I:%M %p')
-                        ws.cell(row=row, column=5).value = f"{hours}:00"
-                        ws.cell(row=row, column=6).value = entry_type
-                        ws.cell(row=row,column=7).value = " | ".join(notes) if notes else ""
-                        row += 1
-                else:
-                    # Write empty row for days with no schedule
-                    ws.cell(row=row, column=1).value= date_cursor.strftime('%A')
-                    ws.cell(row=row, column=2).value = date_cursor.strftime('%-m/%-d/%Y')
-                    ws.cell(row=row, column=3).value = "0"
-                    ws.cell(row=row, column=4).value = "0"
-                    ws.cell(row=row, column=5).value = "0:00"
-                    row += 1
-
-                date_cursor += timedelta(days=1)
-
-            # Auto-adjust column widths
-            for column in ws.columns:
-                max_length = 0
-                column = [cell for cell in column]
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = (max_length + 2)
-                ws.column_dimensions[column[0].column_letter].width = adjusted_width
-
-        # Save to BytesIO
-        excel_file = BytesIO()
-        wb.save(excel_file)
-        excel_file.seek(0)
-
-        return send_file(
-            excel_file,            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=f'timesheets_{start_date}_to_{end_date}.xlsx'
-        )
+        export_format = request.args.get('format', 'xlsx')
+        if export_format not in EXPORT_FORMATS:
+            flash('Invalid export format.')
+            return redirect(url_for('admin_dashboard'))
+
+        try:
+            start_datetime, end_datetime, export_tz = export_period(start_date, end_date, request.args.get('timezone'))
+        except ValueError as e:
+            flash(f'{e}.' if str(e) == 'Invalid timezone' else 'Invalid date format.')
+            return redirect(url_for('admin_dashboard'))
+
+        mimetype, extension = EXPORT_FORMATS[export_format]
+        filename = f'timesheets_{start_date}_to_{end_date}.{extension}'
+
+        if export_format == 'xlsx':
+            # Streamed from a temporary file so large ranges never sit in memory as a workbook
+            excel_file = write_timesheet_xlsx(start_datetime, end_datetime, export_tz, f'{start_date} to {end_date}')
+            return send_file(excel_file, mimetype=mimetype, as_attachment=True, download_name=filename)
+
+        # Flat files are generated row by row while the shifts stream from the database
+        generate = generate_timesheet_csv if export_format == 'csv' else generate_timesheet_ndjson
+        response = Response(stream_with_context(generate(start_datetime, end_datetime, export_tz)),
+                            mimetype=mimetype)
+        response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+        return response
 
     except Exception as e:
         app.logger.error(f"Error exporting schedules: {str(e)}")
         flash('Error exporting schedules. Please try again.')
         return redirect(url_for('admin_dashboard'))
 
+@app.route('/admin/export_schedules/start', methods=['POST'])
+@login_required
+def start_export_schedules():
+    """Run a timesheet export as a background job and download it when ready"""
+    if not current_user.is_admin:
+        flash('Access denied.')
+        return redirect(url_for('calendar'))
+
+    start_date = request.form.get('start_date')
+    end_date = request.form.get('end_date')
+    export_format = request.form.get('format', 'xlsx')
+    timezone_name = request.form.get('timezone') or DEFAULT_EXPORT_TIMEZONE
+    if not start_date or not end_date:
+        return job_error('Please select both start and end dates.', url_for('admin_dashboard'))
+    if export_format not in EXPORT_FORMATS:
+        return job_error('Invalid export format.', url_for('admin_dashboard'))
+    try:
+        export_period(start_date, end_date, timezone_name)
+    except ValueError:
+        return job_error('Invalid dates or timezone.', url_for('admin_dashboard'))
+
+    job = start_job('export_schedules', start_date=start_date, end_date=end_date,
+                    export_format=export_format, timezone_name=timezone_name)
+    return job_response(job, url_for('admin_dashboard'), 'Export started. It will download when ready.')
+
+@job_handler('export_schedules')
+def export_schedules_job(job, start_date, end_date, export_format, timezone_name):
+    start_datetime, end_datetime, export_tz = export_period(start_date, end_date, timezone_name)
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    path = job.result_file(f'timesheets_{start_date}_to_{end_date}.{extension}', mimetype)
+    with open(path, 'wb') as output:
+        write_export(output, export_format, start_datetime, end_datetime, export_tz, f'{start_date} to {end_date}')
+    return f'Timesheets for {start_date} to {end_date} are ready.'
+
 @app.route('/admin/quick_links')
 @login_required
 def admin_quick_links():
@@ -1509,100 +1500,26 @@ def get_upcoming_time_off(for_template=False):
     try:
         # Get current time in UTC since our database stores times in UTC
         current_time = datetime.now(pytz.UTC)
-        two_weeks_later = current_time + timedelta(days=14)
-
-        # Query for upcoming time off entries
-        time_off_entries = (Schedule.query
-            .join(User)
-            .filter(
-                Schedule.start_time >= current_time,
-                Schedule.start_time <= two_weeks_later,
-                Schedule.time_off == True
-            )
-            .order_by(Schedule.start_time)
-            .all())
 
         # Format data for template rendering with user color
         if for_template:
+            user_tz = current_user.get_timezone()
             template_entries = []
-            for entry in time_off_entries:
-                user = User.query.get(entry.technician_id)
-                if user:
-                    # Convert to user's timezone
-                    user_tz = current_user.get_timezone()
-                    start_time = entry.start_time.astimezone(user_tz)
-                    end_time = entry.end_time.astimezone(user_tz)
-                    
-                    template_entries.append({
-                        'username': user.username,
-                        'color': user.color,
-                        'start_time': start_time.strftime('%b %d, %I:%M %p'),
-                        'end_time': end_time.strftime('%b %d, %I:%M %p'),
-                        'description': entry.description
-                    })
+            for entry in time_off_cache.get(current_time):
+                # Convert to user's timezone
+                start_time = entry.start_time.astimezone(user_tz)
+                end_time = entry.end_time.astimezone(user_tz)
+
+                template_entries.append({
+                    'username': entry.username,
+                    'color': entry.color,
+                    'start_time': start_time.strftime('%b %d, %I:%M %p'),
+                    'end_time': end_time.strftime('%b %d, %I:%M %p'),
+                    'description': entry.description
+                })
             return template_entries
         
-        # Original API response formatting
-        time_off_data = []
-        user_tz = pytz.timezone('America/Los_Angeles')  # Default timezone
-        
-        # Group entries by username and consolidate consecutive dates
-        user_entries = {}
-        formatted_entries = []
-
-        for entry in time_off_entries:
-            user = User.query.get(entry.technician_id)
-            if not user:
-                continue
-                
-            username = user.username
-            
-            if username not in user_entries:
-                user_entries[username] = []
-
-            start_local = entry.start_time.astimezone(user_tz)
-            end_local = entry.end_time.astimezone(user_tz)
-
-            user_entries[username].append({
-                'start_date': start_local.date(),
-                'end_date': end_local.date(),
-                'description': entry.description,
-                'color': user.color
-            })
-
-        # Consolidate consecutive dates for each user
-        for username, entries in user_entries.items():
-            if not entries:
-                continue
-                
-            entries.sort(key=lambda x: x['start_date'])
-            consolidated = []
-            current_entry = entries[0]
-
-            for entry in entries[1:]:
-                if (entry['start_date'] - current_entry['end_date']).days <= 1:
-                    # Consecutive days, extend the current entry
-                    current_entry['end_date'] = max(current_entry['end_date'], entry['end_date'])
-                else:
-                    # Non-consecutive, add current entry and start a new one
-                    consolidated.append(current_entry)
-                    current_entry = entry
-
-            consolidated.append(current_entry)
-
-            # Format consolidated entries
-            for entry in consolidated:
-                duration = (entry['end_date'] - entry['start_date']).days + 1
-                formatted_entries.append({
-                    'username': username,
-                    'start_date': entry['start_date'].strftime('%b %d'),
-                    'end_date': entry['end_date'].strftime('%b %d'),
-                    'duration': f"{duration} day{'s' if duration != 1 else ''}",
-                    'description': entry.get('description') or 'Time Off',
-                    'color': entry.get('color', '#3498db')
-                })
-
-        return jsonify(formatted_entries)
+        return jsonify(upcoming_time_off(current_time))
     except Exception as e:
         app.logger.error(f"Error in get_upcoming_time_off: {str(e)}")
         if for_template:
@@ -1615,7 +1532,7 @@ def admin_backup():
     if not current_user.is_admin:
         flash('Access denied.')
         return redirect(url_for('calendar'))
-    return render_template('admin/backup.html')
+    return render_template('admin/backup.html', jobs=recent_jobs())
 
 @app.route('/admin/backup/download')
 @login_required
@@ -1624,34 +1541,64 @@ def download_backup():
         flash('Access denied.')
         return redirect(url_for('calendar'))
 
+    compress = request.args.get('compress') == 'gzip'
+    incremental = request.args.get('mode') == 'incremental'
+    columnar = request.args.get('format') == 'columnar'
     try:
-        # Collect all data with complete reference information
-        backup_data = {
-            'users': [user.to_dict() for user in User.query.all()],
-            'locations': [location.to_dict() for location in Location.query.all()],
-            'schedules': [schedule.to_dict() for schedule in Schedule.query.all()],
-            'quick_links': [link.to_dict() for link in QuickLink.query.all()],
-            'ticket_categories': [category.to_dict() for category in TicketCategory.query.all()],
-            'tickets': [ticket.to_dict() for ticket in Ticket.query.all()],  # Include all tickets (archived and non-archived)
-            'email_settings': [settings.to_dict() for settings in EmailSettings.query.all()]
-        }
-
-        # Create the backup file
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        backup_json = json.dumps(backup_data, indent=2, default=str)
-
-        response = make_response(backup_json)
-        response.headers['Content-Type'] = 'application/json'
-        response.headers['Content-Disposition'] = f'attachment; filename=backup_{timestamp}.json'
-
-        app.logger.info(f"Backup created successfully with {len(backup_data['schedules'])} schedules")
-        return response
-
-    except Exception as e:
-        app.logger.error(f"Error creating backup: {str(e)}")
-        flash('Error creating backup')
+        since = incremental_since() if incremental else None
+    except ValueError as e:
+        flash(str(e))
         return redirect(url_for('admin_backup'))
 
+    filename, mimetype = backup_file(compress, incremental, columnar)
+    if columnar:
+        # The archive's manifest is written last, so it is built before sending
+        output = tempfile.TemporaryFile()
+        write_columnar_backup(output, since=since)
+        output.seek(0)
+        return send_file(output, mimetype=mimetype, as_attachment=True, download_name=filename)
+
+    # Rows are read in batches and written out as they arrive
+    response = Response(stream_with_context(generate_backup(compress=compress, since=since)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
+
+def backup_file(compress, incremental, columnar):
+    """Download name and mimetype for a new backup"""
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    name = f"backup_{'incremental_' if incremental else ''}{timestamp}"
+    if columnar:
+        return f'{name}.zip', 'application/zip'
+    if compress:
+        return f'{name}.json.gz', 'application/gzip'
+    return f'{name}.json', 'application/json'
+
+@app.route('/admin/backup/start', methods=['POST'])
+@login_required
+def start_backup():
+    """Create a backup as a background job; it can be downloaded from the backup page when ready"""
+    if not current_user.is_admin:
+        flash('Access denied.')
+        return redirect(url_for('calendar'))
+
+    job = start_job('backup', compress=request.form.get('compress') == 'gzip',
+                    incremental=request.form.get('mode') == 'incremental',
+                    columnar=request.form.get('format') == 'columnar')
+    return job_response(job, url_for('admin_backup'), 'Backup started. It will be listed below when ready.')
+
+@job_handler('backup')
+def backup_job(job, compress=False, incremental=False, columnar=False):
+    # An incremental backup holds the changes since the last backup finished
+    since = incremental_since() if incremental else None
+    path = job.result_file(*backup_file(compress, incremental, columnar))
+    with open(path, 'wb') as output:
+        if columnar:
+            write_columnar_backup(output, progress=job.progress, since=since)
+        else:
+            for chunk in generate_backup(compress=compress, progress=job.progress, since=since):
+                output.write(chunk)
+    return 'Incremental backup created successfully.' if incremental else 'Backup created successfully.'
+
 @app.route('/admin/restore', methods=['POST'])
 @login_required
 def restore_backup():
@@ -1663,455 +1610,36 @@ def restore_backup():
         flash('No file uploaded')
         return redirect(url_for('admin_backup'))
 
-    file = request.files['backup_file']
-    if not file.filename:
+    # A full backup, optionally with the incremental backups taken after it
+    files = [file for file in request.files.getlist('backup_file') if file.filename]
+    if not files:
         flash('No file selected')
         return redirect(url_for('admin_backup'))
 
+    # The uploads are kept on disk and restored by a background job
+    job = start_job('restore', paths=[save_upload(file) for file in files])
+    return job_response(job, url_for('admin_backup'), 'Restore started. Progress is shown below.')
+
+@job_handler('restore')
+def restore_job(job, paths):
+    backup_files = []
     try:
-        backup_data = json.loads(file.read().decode('utf-8'))
         app.logger.info("Starting backup restoration process...")
-
-        # Initialize mappings for existing data
-        existing_users = {user.username.lower(): user for user in User.query.all()}
-        existing_locations = {loc.name.lower(): loc for loc in Location.query.all()}
-        existing_quick_links = {(link.title.lower(), link.url.lower()): link for link in QuickLink.query.all()}
-
-        try:
-            # Process users first
-            if 'users' in backup_data:
-                app.logger.info("Starting user restoration...")
-                for user_data in backup_data['users']:
-                    try:
-                        username = user_data.get('username')
-                        email = user_data.get('email')
-
-                        if not username or not email:
-                            app.logger.warning(f"Skipping user with missing data")
-                            continue
-
-                        # Check if user exists (case-insensitive)
-                        existing_user = existing_users.get(username.lower())
-                        if existing_user:
-                            app.logger.info(f"User {username} already exists")
-                            continue
-
-                        # Create new user
-                        user = User(
-                            username=username,
-                            email=email,
-                            password_hash=user_data['password_hash'],
-                            color=user_data.get('color', '#3498db'),
-                            is_admin=user_data.get('is_admin', False),
-                            timezone=user_data.get('timezone', 'America/Los_Angeles')
-                        )
-                        db.session.add(user)
-                        app.logger.info(f"Created new user {username}")
-
-                    except Exception as e:
-                        app.logger.error(f"Error processing user {username}: {str(e)}")
-                        continue
-
-                db.session.commit()
-                app.logger.info("Users committed successfully")
-
-            # Process locations
-            if 'locations' in backup_data:
-                app.logger.info("Starting location restoration...")
-                for loc_data in backup_data['locations']:
-                    try:
-                        name = loc_data.get('name')
-                        if not name:
-                            continue
-
-                        # Check if location exists (case-insensitive)
-                        existing_location = existing_locations.get(name.lower())
-                        if existing_location:
-                            app.logger.info(f"Location {name} already exists")
-                            continue
-
-                        # Create new location
-                        location = Location(
-                            name=name,
-                            description=loc_data.get('description', ''),
-                            active=loc_data.get('active', True)
-                        )
-                        db.session.add(location)
-                        app.logger.info(f"Created new location {name}")
-
-                    except Exception as e:
-                        app.logger.error(f"Error processing location {name}: {str(e)}")
-                        continue
-
-                db.session.commit()
-                app.logger.info("Locations committed successfully")
-
-            # Process schedules
-            restored_count = 0
-            skipped_count = 0
-
-            if 'schedules' in backup_data:
-                app.logger.info("Starting schedule restoration...")
-
-                # Refresh user and location data after commits
-                users_by_username = {user.username: user for user in User.query.all()}
-                locations_by_name = {loc.name: loc for loc in Location.query.all()}
-
-                for schedule_data in backup_data['schedules']:
-                    try:
-                        # Get technician by username
-                        tech_username = schedule_data.get('technician_username')
-                        if not tech_username:
-                            app.logger.warning("Schedule missing technician username")
-                            skipped_count += 1
-                            continue
-
-                        technician = users_by_username.get(tech_username)
-                        if not technician:
-                            app.logger.warning(f"Could not find technician: {tech_username}")
-                            skipped_count += 1
-                            continue
-
-                        # Get location by name if specified
-                        location_id = None
-                        location_name = schedule_data.get('location_name')
-                        if location_name:
-                            location = locations_by_name.get(location_name)
-                            if location:
-                                location_id = location.id
-
-                        start_time = datetime.fromisoformat(schedule_data['start_time'])
-                        end_time = datetime.fromisoformat(schedule_data['end_time'])
-
-                        # Check for existing schedule with same technician, time, and location
-                        existing_schedule = Schedule.query.filter_by(
-                            technician_id=technician.id,
-                            start_time=start_time,
-                            end_time=end_time,
-                            location_id=location_id
-                        ).first()
-
-                        if existing_schedule:
-                            app.logger.info(f"Schedule already exists for {tech_username} at {start_time}")
-                            skipped_count += 1
-                            continue
-
-                        schedule = Schedule(
-                            technician_id=technician.id,
-                            location_id=location_id,
-                            start_time=start_time,
-                            end_time=end_time,
-                            description=schedule_data.get('description'),
-                            time_off=schedule_data.get('time_off', False)
-                        )
-                        db.session.add(schedule)
-                        restored_count += 1
-
-                    except Exception as e:
-                        app.logger.error(f"Error processing schedule: {str(e)}")
-                        skipped_count += 1
-                        continue
-
-                db.session.commit()
-                app.logger.info(f"Schedules committed successfully. Restored: {restored_count}, Skipped: {skipped_count}")
-
-            # Process quick links if present
-            if 'quick_links' in backup_data:
-                app.logger.info("Starting quick links restoration...")
-                for link_data in backup_data['quick_links']:
-                    try:
-                        title = link_data.get('title', '')
-                        url = link_data.get('url', '')
-                        
-                        # Skip if title or url is missing
-                        if not title or not url:
-                            app.logger.warning(f"Skipping quick link with missing title or URL")
-                            continue
-
-                        # Check if link already exists (case-insensitive)
-                        title_lower = title.lower()
-                        url_lower = url.lower()
-                        
-                        if (title_lower, url_lower) in existing_quick_links:
-                            app.logger.info(f"Quick link already exists: {title}")
-                            continue
-
-                        # Create new quick link
-                        link = QuickLink(
-                            title=title,
-                            url=url,
-                            icon=link_data.get('icon', 'link'),
-                            category=link_data.get('category', 'Uncategorized'),
-                            order=link_data.get('order', 0)
-                        )
-                        db.session.add(link)
-                        
-                        # Add to existing_quick_links to prevent duplicates within this restore
-                        existing_quick_links[(title_lower, url_lower)] = link
-                        app.logger.info(f"Created new quick link: {title}")
-
-                    except Exception as e:
-                        app.logger.error(f"Error processing quick link {link_data.get('title', 'Unknown')}: {str(e)}")
-                        continue
-
-                db.session.commit()
-                app.logger.info("Quick links committed successfully")
-                
-            # Process ticket categories if present
-            if 'ticket_categories' in backup_data:
-                app.logger.info("Starting ticket categories restoration...")
-                existing_categories = {cat.name.lower(): cat for cat in TicketCategory.query.all()}
-                
-                for category_data in backup_data['ticket_categories']:
-                    try:
-                        name = category_data.get('name')
-                        if not name:
-                            continue
-                            
-                        # Check if category already exists
-                        if name.lower() in existing_categories:
-                            app.logger.info(f"Ticket category {name} already exists")
-                            continue
-                            
-                        # Create new category
-                        category = TicketCategory(
-                            name=name,
-                            description=category_data.get('description', ''),
-                            icon=category_data.get('icon', 'help-circle'),
-                            priority_level=category_data.get('priority_level', 0)
-                        )
-                        db.session.add(category)
-                        app.logger.info(f"Created new ticket category: {name}")
-                        
-                    except Exception as e:
-                        app.logger.error(f"Error processing ticket category: {str(e)}")
-                        continue
-                        
-                db.session.commit()
-                app.logger.info("Ticket categories committed successfully")
-                
-            # Process tickets if present
-            tickets_restored = 0
-            tickets_skipped = 0
-            
-            if 'tickets' in backup_data:
-                app.logger.info("Starting tickets restoration...")
-                
-                # Refresh reference data
-                users_by_username = {user.username: user for user in User.query.all()}
-                categories_by_name = {cat.name: cat for cat in TicketCategory.query.all()}
-                
-                for ticket_data in backup_data['tickets']:
-                    try:
-                        title = ticket_data.get('title')
-                        description = ticket_data.get('description')
-                        
-                        if not title or not description:
-                            app.logger.warning("Ticket missing title or description")
-                            tickets_skipped += 1
-                            continue
-                            
-                        # Find category by name
-                        category_name = ticket_data.get('category_name')
-                        if not category_name or category_name not in categories_by_name:
-                            app.logger.warning(f"Could not find category: {category_name}")
-                            tickets_skipped += 1
-                            continue
-                            
-                        # Find creator by username
-                        creator_username = ticket_data.get('creator_username')
-                        if not creator_username or creator_username not in users_by_username:
-                            app.logger.warning(f"Could not find creator: {creator_username}")
-                            tickets_skipped += 1
-                            continue
-                            
-                        # Find assigned user by username if present
-                        assigned_to = None
-                        assigned_username = ticket_data.get('assigned_username')
-                        if assigned_username and assigned_username in users_by_username:
-                            assigned_to = users_by_username[assigned_username].id
-                            
-                        # Parse dates
-                        created_at = None
-                        if ticket_data.get('created_at'):
-                            created_at = datetime.fromisoformat(ticket_data['created_at'])
-                            
-                        updated_at = None
-                        if ticket_data.get('updated_at'):
-                            updated_at = datetime.fromisoformat(ticket_data['updated_at'])
-                            
-                        due_date = None
-                        if ticket_data.get('due_date'):
-                            due_date = datetime.fromisoformat(ticket_data['due_date'])
-                            
-                        # Check if ticket with the original ID already exists
-                        ticket_id = ticket_data.get('id')
-                        existing_ticket = None
-                        if ticket_id:
-                            existing_ticket = Ticket.query.get(ticket_id)
-                            
-                        if existing_ticket:
-                            app.logger.info(f"Ticket ID {ticket_id} already exists, skipping")
-                            tickets_skipped += 1
-                            continue
-                            
-                        # Create the ticket with its original ID to properly restore it
-                        from sqlalchemy import text
-                        
-                        # First create the ticket without ID
-                        ticket = Ticket(
-                            title=title,
-                            description=description,
-                            category_id=categories_by_name[category_name].id,
-                            status=ticket_data.get('status', TicketStatus.OPEN),
-                            priority=ticket_data.get('priority', 0),
-                            assigned_to=assigned_to,
-                            created_by=users_by_username[creator_username].id,
-                            created_at=created_at,
-                            updated_at=updated_at,
-                            due_date=due_date,
-                            archived=ticket_data.get('archived', False)
-                        )
-                        
-                        # Set the ID to match the original if provided
-                        if ticket_id:
-                            # Use raw SQL to set the ID explicitly
-                            db.session.execute(text("ALTER SEQUENCE ticket_id_seq RESTART WITH :next_id"), 
-                                            {"next_id": int(ticket_id) + 1})
-                            ticket.id = ticket_id
-                            
-                        db.session.add(ticket)
-                        db.session.flush()  # Get the ticket ID before adding comments
-                        
-                        # Process comments if present
-                        if 'comments' in ticket_data:
-                            for comment_data in ticket_data['comments']:
-                                user_username = comment_data.get('username')
-                                if not user_username or user_username not in users_by_username:
-                                    # Try to use system user for comments if the original user isn't found
-                                    system_user = User.query.filter_by(username="System").first()
-                                    if not system_user:
-                                        # Create system user if needed
-                                        system_user = User(
-                                            username="System", 
-                                            email="system@example.com",
-                                            is_admin=False
-                                        )
-                                        system_user.set_password(''.join(random.choice(string.ascii_letters + string.digits) for _ in range(20)))
-                                        db.session.add(system_user)
-                                        db.session.flush()
-                                    user_id = system_user.id
-                                else:
-                                    user_id = users_by_username[user_username].id
-                                    
-                                # Get original comment ID if available
-                                comment_id = comment_data.get('id')
-                                
-                                # Create the comment
-                                comment = TicketComment(
-                                    ticket_id=ticket.id,
-                                    user_id=user_id,
-                                    content=comment_data.get('content', ''),
-                                    created_at=datetime.fromisoformat(comment_data['created_at']) if comment_data.get('created_at') else None,
-                                    updated_at=datetime.fromisoformat(comment_data['updated_at']) if comment_data.get('updated_at') else None
-                                )
-                                
-                                # Restore the original ID if possible
-                                if comment_id:
-                                    db.session.execute(text("ALTER SEQUENCE ticket_comment_id_seq RESTART WITH :next_id"), 
-                                                    {"next_id": int(comment_id) + 1})
-                                    comment.id = comment_id
-                                    
-                                db.session.add(comment)
-                                
-                        # Process history entries if present
-                        if 'history' in ticket_data:
-                            for history_data in ticket_data['history']:
-                                user_username = history_data.get('username')
-                                if not user_username or user_username not in users_by_username:
-                                    # Try to use system user for history entries if the original user isn't found
-                                    system_user = User.query.filter_by(username="System").first()
-                                    if not system_user:
-                                        # Create system user if needed
-                                        system_user = User(
-                                            username="System", 
-                                            email="system@example.com",
-                                            is_admin=False
-                                        )
-                                        system_user.set_password(''.join(random.choice(string.ascii_letters + string.digits) for _ in range(20)))
-                                        db.session.add(system_user)
-                                        db.session.flush()
-                                    user_id = system_user.id
-                                else:
-                                    user_id = users_by_username[user_username].id
-                                
-                                # Get original history ID if available
-                                history_id = history_data.get('id')
-                                
-                                # Create the history entry
-                                history = TicketHistory(
-                                    ticket_id=ticket.id,
-                                    user_id=user_id,
-                                    action=history_data.get('action', ''),
-                                    details=history_data.get('details', ''),
-                                    created_at=datetime.fromisoformat(history_data['created_at']) if history_data.get('created_at') else None
-                                )
-                                
-                                # Restore the original ID if possible
-                                if history_id:
-                                    db.session.execute(text("ALTER SEQUENCE ticket_history_id_seq RESTART WITH :next_id"), 
-                                                    {"next_id": int(history_id) + 1})
-                                    history.id = history_id
-                                    
-                                db.session.add(history)
-                                
-                        tickets_restored += 1
-                        
-                    except Exception as e:
-                        app.logger.error(f"Error processing ticket: {str(e)}")
-                        tickets_skipped += 1
-                        continue
-                        
-                db.session.commit()
-                app.logger.info(f"Tickets committed successfully. Restored: {tickets_restored}, Skipped: {tickets_skipped}")
-                
-            # Process email settings if present
-            if 'email_settings' in backup_data and backup_data['email_settings']:
-                app.logger.info("Restoring email settings...")
-                try:
-                    settings_data = backup_data['email_settings'][0]
-                    settings = EmailSettings.query.first()
-                    
-                    if not settings:
-                        settings = EmailSettings()
-                        db.session.add(settings)
-                        
-                    settings.admin_email_group = settings_data.get('admin_email_group', 'alerts@obedtv.com')
-                    settings.notify_on_create = settings_data.get('notify_on_create', True)
-                    settings.notify_on_update = settings_data.get('notify_on_update', True)
-                    settings.notify_on_delete = settings_data.get('notify_on_delete', True)
-                    
-                    db.session.commit()
-                    app.logger.info("Email settings restored successfully")
-                except Exception as e:
-                    app.logger.error(f"Error restoring email settings: {str(e)}")
-
-            flash(f'Backup restored successfully! {restored_count} schedules restored, {skipped_count} skipped. {tickets_restored} tickets restored, {tickets_skipped} skipped.')
-            app.logger.info("Backup restore completed successfully")
-
-        except Exception as e:
-            db.session.rollback()
-            app.logger.error(f"Error in backup restoration: {str(e)}")
-            flash('Error restoring backup')
-            raise
-
+        backup_files = [open(path, 'rb') for path in paths]
+        # Parsed as it is read and merged into the database in bulk per entity
+        counts = restore_backup_chain(backup_files, progress=job.progress)
+        app.logger.info("Backup restore completed successfully")
     except json.JSONDecodeError:
-        flash('Invalid backup file format')
-    except Exception as e:
-        flash('Error restoring backup')
-        app.logger.error(f"Unexpected error in restore_backup: {str(e)}")
+        raise ValueError('Invalid backup file format')
+    finally:
+        for backup_file in backup_files:
+            backup_file.close()
+        for path in paths:
+            os.remove(path)
 
-    return redirect(url_for('admin_backup'))
+    schedules, tickets = counts['schedules'], counts['tickets']
+    return (f'Backup restored successfully! {schedules.restored} schedules restored, {schedules.skipped} skipped. '
+            f'{tickets.restored} tickets restored, {tickets.skipped} skipped.')
 
 @app.route('/admin/locations/edit/<int:location_id>', methods=['POST'])
 @login_required
@@ -2167,7 +1695,7 @@ def admin_delete_location(location_id):
     location = Location.query.get_or_404(location_id)
 
     # Check if location is being used in any schedules
-    if location.schedules:
+    if location.schedules or location.schedule_rules:
         flash('Cannot delete location that has associated schedules.')
         return redirect(url_for('admin_locations'))
 
@@ -2202,6 +1730,7 @@ def admin_email_settings():
             settings.notify_on_create = form.notify_on_create.data
             settings.notify_on_update = form.notify_on_update.data
             settings.notify_on_delete = form.notify_on_delete.data
+            settings.digest_minutes = form.digest_minutes.data
             db.session.commit()
             flash('Email settings updated successfully!')
         except Exception as e:
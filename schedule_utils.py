@@ -0,0 +1,588 @@
+"""
+Schedule loading and caching helpers.
+
+The calendar templates touch schedule.technician and schedule.location for
+every shift, so the week is loaded in a single joined query and handed to the
+templates as lightweight, already timezone-converted view objects.
+
+Frequently polled data (who is on shift right now, upcoming time off) is
+cached in-process and dropped whenever a relevant Schedule row is committed;
+see on_schedule_change().
+"""
+import logging
+import threading
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pytz
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload
+
+from app import db
+from change_events import on_model_change, notify_model_change
+from models import Location, Schedule, ScheduleRule, User
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class TechnicianView:
+    id: int
+    username: str
+    color: str
+
+
+@dataclass(frozen=True)
+class LocationView:
+    id: int
+    name: str
+    description: Optional[str]
+
+
+@dataclass(frozen=True)
+class ScheduleView:
+    id: int
+    technician_id: int
+    location_id: Optional[int]
+    start_time: datetime
+    end_time: datetime
+    description: Optional[str]
+    time_off: bool
+    technician: TechnicianView
+    location: Optional[LocationView]
+    # Set for occurrences expanded from a ScheduleRule, which have no Schedule id
+    rule_id: Optional[int] = None
+    occurrence_date: Optional[date] = None
+
+
+def as_utc(value: datetime) -> datetime:
+    """Treat naive datetimes from the database as UTC"""
+    if value.tzinfo is None:
+        return pytz.UTC.localize(value)
+    return value
+
+
+@dataclass(frozen=True)
+class RuleOccurrence:
+    rule_id: int
+    occurrence_date: date
+    start_time: datetime
+    end_time: datetime
+    description: Optional[str]
+    time_off: bool
+    technician: TechnicianView
+    location: Optional[LocationView]
+
+    def to_view(self, user_tz) -> ScheduleView:
+        return ScheduleView(
+            id=None,
+            technician_id=self.technician.id,
+            location_id=self.location.id if self.location else None,
+            start_time=self.start_time.astimezone(user_tz),
+            end_time=self.end_time.astimezone(user_tz),
+            description=self.description,
+            time_off=self.time_off,
+            technician=self.technician,
+            location=self.location,
+            rule_id=self.rule_id,
+            occurrence_date=self.occurrence_date
+        )
+
+
+class RuleOccurrenceCache:
+    """
+    Lazily expanded ScheduleRule occurrences.
+
+    Rules are expanded per whole UTC day span on first use and the result is
+    kept for the most recently used spans, so repeated week views and the
+    polled panels don't re-expand anything. Any committed change to a rule,
+    technician or location drops the cache; max_age covers other processes.
+    """
+
+    def __init__(self, max_spans: int = 32, max_age: timedelta = timedelta(minutes=5)):
+        self.max_spans = max_spans
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._spans: 'OrderedDict[Tuple[datetime, datetime], Tuple[datetime, List[RuleOccurrence]]]' = OrderedDict()
+
+    def get(self, window_start: datetime, window_end: datetime, technician=None, location=None) -> List[RuleOccurrence]:
+        """Occurrences overlapping [window_start, window_end), ordered by start time"""
+        window_start, window_end = as_utc(window_start), as_utc(window_end)
+        span_start = window_start.replace(hour=0, minute=0, second=0, microsecond=0)
+        span_end = window_end.replace(hour=0, minute=0, second=0, microsecond=0)
+        if span_end < window_end or span_end == span_start:
+            span_end += timedelta(days=1)
+        now = datetime.now(pytz.UTC)
+
+        with self._lock:
+            cached = self._spans.get((span_start, span_end))
+            if cached is None or now >= cached[0] + self.max_age:
+                cached = (now, self._expand(span_start, span_end))
+                self._spans[(span_start, span_end)] = cached
+                while len(self._spans) > self.max_spans:
+                    self._spans.popitem(last=False)
+                logger.debug(f"Expanded {len(cached[1])} rule occurrences for {span_start} - {span_end}")
+            else:
+                self._spans.move_to_end((span_start, span_end))
+            occurrences = cached[1]
+
+        technician_id = getattr(technician, 'id', technician)
+        location_id = getattr(location, 'id', location)
+        return [occurrence for occurrence in occurrences
+                if occurrence.start_time < window_end and occurrence.end_time > window_start
+                and (technician_id is None or occurrence.technician.id == technician_id)
+                and (location_id is None or (occurrence.location and occurrence.location.id == location_id))]
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._spans.clear()
+
+    def _expand(self, span_start: datetime, span_end: datetime) -> List[RuleOccurrence]:
+        # Pad by a day either side for timezone offsets and overnight shifts
+        rules = (ScheduleRule.query
+            .filter(ScheduleRule.start_date <= (span_end + timedelta(days=1)).date(),
+                    db.or_(ScheduleRule.until_date.is_(None),
+                           ScheduleRule.until_date >= (span_start - timedelta(days=1)).date()))
+            .options(joinedload(ScheduleRule.technician), joinedload(ScheduleRule.location))
+            .all())
+
+        occurrences = []
+        for rule in rules:
+            tech, loc = rule.technician, rule.location
+            tech_view = TechnicianView(id=tech.id, username=tech.username, color=tech.color)
+            loc_view = LocationView(id=loc.id, name=loc.name, description=loc.description) if loc else None
+            for day, start, end in rule.occurrences(span_start, span_end):
+                occurrences.append(RuleOccurrence(
+                    rule_id=rule.id,
+                    occurrence_date=day,
+                    start_time=start,
+                    end_time=end,
+                    description=rule.description,
+                    time_off=bool(rule.time_off),
+                    technician=tech_view,
+                    location=loc_view
+                ))
+        occurrences.sort(key=lambda occurrence: occurrence.start_time)
+        return occurrences
+
+
+rule_occurrences = RuleOccurrenceCache()
+on_model_change(ScheduleRule, rule_occurrences.invalidate)
+on_model_change(User, rule_occurrences.invalidate)
+on_model_change(Location, rule_occurrences.invalidate)
+
+
+def load_week_schedules(week_start_utc, week_end_utc, user_tz, technician=None, location=None) -> List[ScheduleView]:
+    """
+    Load every schedule starting in the given week with its technician and
+    location in one round trip, converted to the viewer's timezone. A shift
+    that runs past midnight into the next week is only shown in the week it starts.
+    """
+    schedules = (Schedule.overlapping(week_start_utc, week_end_utc, technician=technician, location=location)
+        .filter(Schedule.start_time >= week_start_utc)
+        .options(joinedload(Schedule.technician), joinedload(Schedule.location))
+        .all())
+
+    technicians: Dict[int, TechnicianView] = {}
+    locations: Dict[int, LocationView] = {}
+    views = []
+    for schedule in schedules:
+        tech = schedule.technician
+        if tech.id not in technicians:
+            technicians[tech.id] = TechnicianView(id=tech.id, username=tech.username, color=tech.color)
+
+        loc_view = None
+        if schedule.location:
+            loc = schedule.location
+            if loc.id not in locations:
+                locations[loc.id] = LocationView(id=loc.id, name=loc.name, description=loc.description)
+            loc_view = locations[loc.id]
+
+        views.append(ScheduleView(
+            id=schedule.id,
+            technician_id=schedule.technician_id,
+            location_id=schedule.location_id,
+            start_time=as_utc(schedule.start_time).astimezone(user_tz),
+            end_time=as_utc(schedule.end_time).astimezone(user_tz),
+            description=schedule.description,
+            time_off=bool(schedule.time_off),
+            technician=technicians[tech.id],
+            location=loc_view
+        ))
+
+    for occurrence in rule_occurrences.get(week_start_utc, week_end_utc, technician=technician, location=location):
+        if occurrence.start_time >= week_start_utc:
+            views.append(occurrence.to_view(user_tz))
+    views.sort(key=lambda view: view.start_time)
+
+    return views
+
+
+def find_shift_conflicts(technician_id: int, ranges: List[Tuple[str, datetime, datetime]]) -> Dict[str, List[Tuple[datetime, datetime]]]:
+    """
+    Check many requested (key, start, end) ranges for one technician against
+    their existing shifts (and recurring rule occurrences) with a single range query.
+    Both lists are swept in start order, so each existing shift is picked up
+    once and dropped as soon as a requested range starts after it ends.
+    Returns the overlapping existing (start, end) pairs, in UTC, per conflicting key.
+    """
+    if not ranges:
+        return {}
+
+    window_start = min(start for _, start, _ in ranges)
+    window_end = max(end for _, _, end in ranges)
+    existing = (Schedule.overlapping(window_start, window_end, technician=technician_id)
+        .with_entities(Schedule.start_time, Schedule.end_time)
+        .all())
+    existing = [(as_utc(start), as_utc(end)) for start, end in existing]
+    existing += [(occurrence.start_time, occurrence.end_time)
+                 for occurrence in rule_occurrences.get(window_start, window_end, technician=technician_id)]
+    existing.sort()
+
+    conflicts: Dict[str, List[Tuple[datetime, datetime]]] = {}
+    active: List[Tuple[datetime, datetime]] = []  # Existing shifts already reached that may still overlap
+    next_existing = 0
+    for key, start, end in sorted(ranges, key=lambda requested: requested[1]):
+        while next_existing < len(existing) and existing[next_existing][0] < end:
+            active.append(existing[next_existing])
+            next_existing += 1
+        # Later ranges start no earlier, so shifts ending by this start can't overlap them either
+        active = [shift for shift in active if shift[1] > start]
+        overlapping = [shift for shift in active if shift[0] < end]
+        if overlapping:
+            conflicts[key] = overlapping
+    return conflicts
+
+
+def insert_schedules(rows: List[dict]) -> int:
+    """Insert many schedules with one multi-row INSERT; the caller commits"""
+    if not rows:
+        return 0
+    db.session.execute(db.insert(Schedule).values(rows))
+    return len(rows)
+
+
+def _shift_by_seconds(column, seconds):
+    """SQL expression for a datetime column moved by a number of seconds"""
+    if db.engine.dialect.name == 'sqlite':
+        # Keep SQLAlchemy's "YYYY-MM-DD HH:MM:SS.ffffff" storage format so string comparisons still order correctly
+        shifted = db.func.datetime(column, db.cast(seconds, db.String) + ' seconds')
+        return shifted + '.' + db.func.coalesce(db.func.nullif(db.func.substr(column, 21, 6), ''), '000000')
+    return column + db.func.make_interval(0, 0, 0, 0, 0, 0, seconds)
+
+
+def _week_offsets(source_week_start_utc: datetime, target_week_starts_utc: List[datetime]):
+    """A one-column (seconds) subquery with the offset from the source week to each target week"""
+    offsets = [int((target - source_week_start_utc).total_seconds()) for target in target_week_starts_utc]
+    return db.union_all(*[db.select(db.literal(offset, db.Integer).label('seconds')) for offset in offsets]).subquery('offsets')
+
+
+def _starts_in_weeks(week_starts_utc: List[datetime]):
+    return db.or_(*[db.and_(Schedule.start_time >= start, Schedule.start_time < start + timedelta(days=7))
+                    for start in week_starts_utc])
+
+
+def copy_week(source_week_start_utc: datetime, target_week_starts_utc: List[datetime]) -> int:
+    """
+    Replace the schedules of each target week with a copy of the source week,
+    shifted by the offset between the weeks, using one DELETE and one
+    INSERT ... SELECT however many shifts or target weeks there are.
+    Returns the number of schedules created; the caller commits.
+    """
+    offsets = _week_offsets(source_week_start_utc, target_week_starts_utc)
+    source = (db.select(
+            Schedule.technician_id,
+            _shift_by_seconds(Schedule.start_time, offsets.c.seconds),
+            _shift_by_seconds(Schedule.end_time, offsets.c.seconds),
+            Schedule.description,
+            Schedule.time_off,
+            Schedule.location_id,
+            db.func.now())
+        .select_from(Schedule)
+        .join(offsets, db.true())
+        .where(_starts_in_weeks([source_week_start_utc])))
+
+    db.session.execute(db.delete(Schedule).where(_starts_in_weeks(target_week_starts_utc)))
+    result = db.session.execute(db.insert(Schedule).from_select(
+        ['technician_id', 'start_time', 'end_time', 'description', 'time_off', 'location_id', 'created_at'],
+        source
+    ))
+    return result.rowcount
+
+
+def diff_week_copy(source_week_start_utc: datetime, target_week_starts_utc: List[datetime]) -> Dict[str, int]:
+    """
+    Dry run of copy_week(): how many schedules in the target weeks would be
+    added, removed or left as they are. Reads both sides in two queries.
+    """
+    def shift_key(row, offset=timedelta(0)):
+        return (row.technician_id, as_utc(row.start_time) + offset, as_utc(row.end_time) + offset,
+                row.location_id, row.description or '', bool(row.time_off))
+
+    columns = (Schedule.technician_id, Schedule.start_time, Schedule.end_time,
+               Schedule.location_id, Schedule.description, Schedule.time_off)
+    source_rows = db.session.query(*columns).filter(_starts_in_weeks([source_week_start_utc])).all()
+    target_rows = db.session.query(*columns).filter(_starts_in_weeks(target_week_starts_utc)).all()
+
+    copied = Counter(shift_key(row, target - source_week_start_utc)
+                     for target in target_week_starts_utc for row in source_rows)
+    existing = Counter(shift_key(row) for row in target_rows)
+    unchanged = sum((copied & existing).values())
+    return {
+        'source': len(source_rows),
+        'weeks': len(target_week_starts_utc),
+        'added': sum(copied.values()) - unchanged,
+        'removed': sum(existing.values()) - unchanged,
+        'unchanged': unchanged
+    }
+
+
+def on_schedule_change(callback: Callable[[], None],
+                       when: Optional[Callable[[Schedule], bool]] = None) -> Callable[[], None]:
+    """Register a callback to run after any commit that changes Schedule rows (optionally only those matching when)"""
+    return on_model_change(Schedule, callback, when=when)
+
+
+def notify_schedule_change() -> None:
+    """
+    Run the schedule change callbacks.
+    Called automatically on commit; call it directly after raw SQL writes.
+    """
+    notify_model_change(Schedule)
+
+
+@dataclass(frozen=True)
+class ActiveShift:
+    username: str
+    color: str
+    start_time: datetime
+    end_time: datetime
+    description: str
+    location_name: str
+    location_description: str
+
+
+class ActiveShiftSnapshot:
+    """
+    Process-wide snapshot of who is on shift right now.
+
+    The snapshot is only recomputed when the next shift boundary (a shift
+    starting or ending) has passed, when a Schedule row changes, or after
+    max_age as a safety net against writes made outside this process.
+    Times are kept in UTC; per-user formatting is left to the caller.
+    """
+
+    def __init__(self, max_age: timedelta = timedelta(minutes=5)):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._shifts: Optional[List[ActiveShift]] = None
+        self._valid_until: Optional[datetime] = None
+
+    def get(self, now: Optional[datetime] = None) -> List[ActiveShift]:
+        now = now or datetime.now(pytz.UTC)
+        with self._lock:
+            if self._shifts is None or now >= self._valid_until:
+                self._shifts, self._valid_until = self._compute(now)
+                logger.debug(f"Active shift snapshot refreshed: {len(self._shifts)} active until {self._valid_until}")
+            return self._shifts
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._shifts = None
+            self._valid_until = None
+
+    def _compute(self, now: datetime) -> Tuple[List[ActiveShift], datetime]:
+        schedules = (Schedule.overlapping(now, now, time_off=False)
+            .options(joinedload(Schedule.technician), joinedload(Schedule.location))
+            .all())
+
+        shifts = []
+        for schedule in schedules:
+            user, location = schedule.technician, schedule.location
+            if not user:
+                continue
+            shifts.append(ActiveShift(
+                username=user.username,
+                color=user.color,
+                start_time=as_utc(schedule.start_time),
+                end_time=as_utc(schedule.end_time),
+                description=schedule.description or '',
+                location_name=location.name if location else 'No Location',
+                location_description=location.description if location else ''
+            ))
+
+        # Recurring shifts, expanded from the cached rules
+        upcoming_rules = rule_occurrences.get(now, now + self.max_age)
+        for occurrence in upcoming_rules:
+            if occurrence.time_off or occurrence.start_time > now:
+                continue
+            shifts.append(ActiveShift(
+                username=occurrence.technician.username,
+                color=occurrence.technician.color,
+                start_time=occurrence.start_time,
+                end_time=occurrence.end_time,
+                description=occurrence.description or '',
+                location_name=occurrence.location.name if occurrence.location else 'No Location',
+                location_description=occurrence.location.description if occurrence.location else ''
+            ))
+
+        # The snapshot stays valid until the next shift starts or an active one ends
+        next_start = (db.session.query(db.func.min(Schedule.start_time))
+            .filter(Schedule.start_time >= now, ~Schedule.time_off)
+            .scalar())
+        boundaries = [now + self.max_age] + [shift.end_time for shift in shifts]
+        boundaries += [occurrence.start_time for occurrence in upcoming_rules
+                       if not occurrence.time_off and occurrence.start_time > now]
+        if next_start is not None:
+            boundaries.append(as_utc(next_start))
+        return shifts, min(boundaries)
+
+
+active_shifts = ActiveShiftSnapshot()
+on_schedule_change(active_shifts.invalidate)
+on_model_change(ScheduleRule, active_shifts.invalidate)
+
+
+def format_active_shifts(shifts: List[ActiveShift], user_tz) -> List[dict]:
+    """Format an active shift snapshot for the /api/active_users response in the viewer's timezone"""
+    return [{
+        'username': shift.username,
+        'color': shift.color,
+        'schedule': {
+            'start_time': shift.start_time.astimezone(user_tz).strftime('%H:%M'),
+            'end_time': shift.end_time.astimezone(user_tz).strftime('%H:%M'),
+            'description': shift.description
+        },
+        'location': {
+            'name': shift.location_name,
+            'description': shift.location_description
+        }
+    } for shift in shifts]
+
+
+@dataclass(frozen=True)
+class TimeOffEntry:
+    username: str
+    color: str
+    start_time: datetime
+    end_time: datetime
+    description: Optional[str]
+
+
+def _is_time_off_change(schedule) -> bool:
+    """True if a flushed Schedule is, or just stopped being, time off"""
+    return bool(schedule.time_off) or inspect(schedule).attrs.time_off.history.has_changes()
+
+
+class TimeOffCache:
+    """
+    Process-wide cache of time off entries with their technicians.
+
+    Entries are loaded for a window of `days` days starting at the current
+    UTC date and reused until the date rolls over, a time off Schedule row
+    changes, or max_age passes (for writes made outside this process).
+    """
+
+    def __init__(self, days: int = 14, max_age: timedelta = timedelta(minutes=5)):
+        self.days = days
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._window_start: Optional[datetime] = None
+        self._loaded_at: Optional[datetime] = None
+        self._entries: List[TimeOffEntry] = []
+
+    def get(self, current_time: datetime) -> List[TimeOffEntry]:
+        """Time off overlapping [current_time, current_time + days), ordered by start time"""
+        window_start = current_time.astimezone(pytz.UTC).replace(hour=0, minute=0, second=0, microsecond=0)
+        with self._lock:
+            if window_start != self._window_start or current_time >= self._loaded_at + self.max_age:
+                self._entries = self._load(window_start)
+                self._window_start = window_start
+                self._loaded_at = current_time
+                logger.debug(f"Time off cache refreshed: {len(self._entries)} entries from {window_start}")
+            entries = self._entries
+
+        window_end = current_time + timedelta(days=self.days)
+        return [entry for entry in entries if entry.start_time < window_end and entry.end_time > current_time]
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._window_start = None
+            self._loaded_at = None
+            self._entries = []
+
+    def _load(self, window_start: datetime) -> List[TimeOffEntry]:
+        # One extra day covers any current_time later on the window's first day
+        window_end = window_start + timedelta(days=self.days + 1)
+        rows = (db.session.query(Schedule, User)
+            .join(User, Schedule.technician_id == User.id)
+            .filter(Schedule.start_time < window_end, Schedule.end_time > window_start, Schedule.time_off == True)
+            .order_by(Schedule.start_time)
+            .all())
+        entries = [TimeOffEntry(
+            username=user.username,
+            color=user.color,
+            start_time=as_utc(schedule.start_time),
+            end_time=as_utc(schedule.end_time),
+            description=schedule.description
+        ) for schedule, user in rows]
+
+        # Recurring time off
+        entries += [TimeOffEntry(
+            username=occurrence.technician.username,
+            color=occurrence.technician.color,
+            start_time=occurrence.start_time,
+            end_time=occurrence.end_time,
+            description=occurrence.description
+        ) for occurrence in rule_occurrences.get(window_start, window_end) if occurrence.time_off]
+        entries.sort(key=lambda entry: entry.start_time)
+        return entries
+
+
+time_off_cache = TimeOffCache()
+on_schedule_change(time_off_cache.invalidate, when=_is_time_off_change)
+on_model_change(ScheduleRule, time_off_cache.invalidate, when=_is_time_off_change)
+
+
+def upcoming_time_off(current_time: datetime) -> List[dict]:
+    """
+    Upcoming time off grouped by technician, with consecutive days
+    consolidated into ranges, for the upcoming time off panel.
+    """
+    user_tz = pytz.timezone('America/Los_Angeles')  # Default timezone
+
+    # Entries arrive ordered by start time, so each technician's ranges can be
+    # extended or started in a single pass
+    ranges_by_user: Dict[str, List[dict]] = {}
+    for entry in time_off_cache.get(current_time):
+        start_date = entry.start_time.astimezone(user_tz).date()
+        end_date = entry.end_time.astimezone(user_tz).date()
+
+        ranges = ranges_by_user.setdefault(entry.username, [])
+        if ranges and (start_date - ranges[-1]['end_date']).days <= 1:
+            # Consecutive days, extend the current range
+            ranges[-1]['end_date'] = max(ranges[-1]['end_date'], end_date)
+        else:
+            ranges.append({
+                'start_date': start_date,
+                'end_date': end_date,
+                'description': entry.description,
+                'color': entry.color
+            })
+
+    formatted_entries = []
+    for username, ranges in ranges_by_user.items():
+        for entry in ranges:
+            duration = (entry['end_date'] - entry['start_date']).days + 1
+            formatted_entries.append({
+                'username': username,
+                'start_date': entry['start_date'].strftime('%b %d'),
+                'end_date': entry['end_date'].strftime('%b %d'),
+                'duration': f"{duration} day{'s' if duration != 1 else ''}",
+                'description': entry['description'] or 'Time Off',
+                'color': entry['color']
+            })
+
+    return formatted_entries
@@ -191,6 +191,14 @@ document.addEventListener('DOMContentLoaded', function() {
             
             // Set form values
             document.getElementById('schedule_id').value = scheduleId;
+
+            // Occurrences of a recurring schedule have no id of their own; saving one
+            // detaches that date from the series
+            const ruleId = this.dataset.ruleId || '';
+            document.getElementById('rule_id').value = ruleId;
+            document.getElementById('occurrence_date').value = this.dataset.occurrenceDate || '';
+            document.getElementById('delete_series_button').style.display = ruleId ? 'block' : 'none';
+            document.getElementById('repeat_weekly_container').style.display = 'none';
             
             // Fix for date display - adjust for timezone issues
             // Use the date from the data attribute directly without timezone conversion
@@ -267,6 +275,10 @@ document.addEventListener('DOMContentLoaded', function() {
     document.getElementById('copy_button').addEventListener('click', function() {
         // Clear the schedule ID to create a new entry
         document.getElementById('schedule_id').value = '';
+        document.getElementById('rule_id').value = '';
+        document.getElementById('occurrence_date').value = '';
+        document.getElementById('delete_series_button').style.display = 'none';
+        document.getElementById('repeat_weekly_container').style.display = 'block';
 
         // Update modal title and buttons
         document.querySelector('.modal-title').textContent = 'Copy Schedule';
@@ -284,6 +296,11 @@ document.addEventListener('DOMContentLoaded', function() {
             // Reset form
             document.getElementById('schedule_form').reset();
             document.getElementById('schedule_id').value = '';
+            document.getElementById('rule_id').value = '';
+            document.getElementById('occurrence_date').value = '';
+            document.getElementById('delete_series_button').style.display = 'none';
+            document.getElementById('repeat_weekly_container').style.display = 'block';
+            document.getElementById('repeat_until_container').style.display = 'none';
 
             // Set the date and initial times
             document.getElementById('schedule_date').value = date;
@@ -682,10 +699,57 @@ document.addEventListener('DOMContentLoaded', function() {
         this.submit();
     });
 
+    // Build the query string that brings us back to the same week view
+    function returnParams() {
+        const urlParams = new URLSearchParams(window.location.search);
+        const params = new URLSearchParams();
+        if (urlParams.get('week_start')) {
+            params.set('week_start', urlParams.get('week_start'));
+        }
+        if (window.location.pathname.includes('/personal_schedule')) {
+            params.set('personal_view', 'true');
+        }
+        return params;
+    }
+
+    // Changes to recurring schedules are POSTed with the schedule form's CSRF token
+    function submitPost(action, params) {
+        const form = document.createElement('form');
+        form.method = 'POST';
+        form.action = action;
+        params.set('csrf_token', document.querySelector('#schedule_form input[name="csrf_token"]').value);
+        params.forEach((value, name) => {
+            const input = document.createElement('input');
+            input.type = 'hidden';
+            input.name = name;
+            input.value = value;
+            form.appendChild(input);
+        });
+        document.body.appendChild(form);
+        form.submit();
+    }
+
+    // Handle delete series button (recurring schedules only)
+    document.getElementById('delete_series_button').addEventListener('click', function() {
+        if (confirm('Delete every occurrence of this recurring schedule?')) {
+            const ruleId = document.getElementById('rule_id').value;
+            submitPost(`/schedule/rule/delete/${ruleId}`, returnParams());
+        }
+    });
+
     // Handle delete button
     document.getElementById('delete_button').addEventListener('click', function() {
         if (confirm('Are you sure you want to delete this schedule?')) {
             const scheduleId = document.getElementById('schedule_id').value;
+
+            // A recurring schedule occurrence is skipped rather than deleted
+            const ruleId = document.getElementById('rule_id').value;
+            if (ruleId) {
+                const params = returnParams();
+                params.set('date', document.getElementById('occurrence_date').value);
+                submitPost(`/schedule/rule/${ruleId}/skip`, params);
+                return;
+            }
             
             // Get the current week_start from the URL
             const urlParams = new URLSearchParams(window.location.search);
@@ -707,80 +771,62 @@ document.addEventListener('DOMContentLoaded', function() {
     // Initialize positions
     positionSchedules();
 
-    // Update upcoming time off panel
-    function updateUpcomingTimeOff() {
+    // Render upcoming time off panel
+    function renderUpcomingTimeOff(entries) {
         const timeOffDiv = document.getElementById('upcoming-time-off');
         if (!timeOffDiv) return;
 
-        fetch('/api/upcoming_time_off')
-            .then(response => response.json())
-            .then(entries => {
-                if (entries.length === 0) {
-                    timeOffDiv.innerHTML = '<p class="text-muted">No upcoming time off scheduled</p>';
-                    return;
-                }
+        if (entries.length === 0) {
+            timeOffDiv.innerHTML = '<p class="text-muted">No upcoming time off scheduled</p>';
+            return;
+        }
 
-                timeOffDiv.innerHTML = entries.map(entry => `
-                    <div class="time-off-entry p-3 mb-3" 
-                         style="border-left: 4px solid ${entry.color || '#6c757d'};">
-                        <div class="d-flex align-items-top">
-                            <i data-feather="calendar" class="me-2 mt-1"></i>
-                            <div>
-                                <strong>${entry.username}</strong>
-                                <br>
-                                <small>
-                                    ${entry.start_date} to ${entry.end_date}
-                                    <span class="badge bg-danger ms-1">${entry.duration}</span>
-                                </small>
-                                ${entry.description ? `<div class="mt-1 small">${entry.description}</div>` : ''}
-                            </div>
-                        </div>
+        timeOffDiv.innerHTML = entries.map(entry => `
+            <div class="time-off-entry p-3 mb-3" 
+                 style="border-left: 4px solid ${entry.color || '#6c757d'};">
+                <div class="d-flex align-items-top">
+                    <i data-feather="calendar" class="me-2 mt-1"></i>
+                    <div>
+                        <strong>${entry.username}</strong>
+                        <br>
+                        <small>
+                            ${entry.start_date} to ${entry.end_date}
+                            <span class="badge bg-danger ms-1">${entry.duration}</span>
+                        </small>
+                        ${entry.description ? `<div class="mt-1 small">${entry.description}</div>` : ''}
                     </div>
-                `).join('');
-
-                // Initialize the newly added feather icons
-                feather.replace();
-            })
-            .catch(error => {
-                console.error('Error fetching time off entries:', error);
-                timeOffDiv.innerHTML = '<p class="text-danger">Error loading time off entries</p>';
-            });
+                </div>
+            </div>
+        `).join('');
+
+        // Initialize the newly added feather icons
+        feather.replace();
     }
 
-    // Update time off entries every minute along with active users
-    updateUpcomingTimeOff();
-    setInterval(updateUpcomingTimeOff, 60000);
+    // Time off is pushed over the live stream, polled while it is unavailable
+    LiveUpdates.subscribe('time_off', renderUpcomingTimeOff, '/api/upcoming_time_off');
 
-    // Update active users panel
-    function updateActiveUsers() {
+    // Render active users panel
+    function renderActiveUsers(users) {
         const activeUsersDiv = document.getElementById('active-users');
         if (!activeUsersDiv) return;
 
-        fetch('/api/active_users')
-            .then(response => response.json())
-            .then(users => {
-                if (users.length === 0) {
-                    activeUsersDiv.innerHTML = '<p class="text-muted">No active technicians</p>';
-                    return;
-                }
+        if (users.length === 0) {
+            activeUsersDiv.innerHTML = '<p class="text-muted">No active technicians</p>';
+            return;
+        }
 
-                activeUsersDiv.innerHTML = users.map(user => `
-                    <div class="active-user-entry d-flex align-items-center mb-3 p-2" 
-                         style="border-left: 4px solid ${user.color};">
-                        <span class="me-2" style="width: 12px; height: 12px; border-radius: 50%; background-color: ${user.color}"></span>
-                        <span class="fw-medium">${user.username}</span>
-                    </div>
-                `).join('');
-            })
-            .catch(error => {
-                console.error('Error fetching active users:', error);
-                activeUsersDiv.innerHTML = '<p class="text-danger">Error loading active users</p>';
-            });
+        activeUsersDiv.innerHTML = users.map(user => `
+            <div class="active-user-entry d-flex align-items-center mb-3 p-2" 
+                 style="border-left: 4px solid ${user.color};">
+                <span class="me-2" style="width: 12px; height: 12px; border-radius: 50%; background-color: ${user.color}"></span>
+                <span class="fw-medium">${user.username}</span>
+            </div>
+        `).join('');
     }
 
-    // Update active users every minute
-    updateActiveUsers(); // Call immediately when loaded
-    setInterval(updateActiveUsers, 60000);
+    // Active users are pushed over the live stream, polled while it is unavailable
+    LiveUpdates.subscribe('active_users', renderActiveUsers, '/api/active_users');
     
     // Current time line functionality
     function updateCurrentTimeLine() {
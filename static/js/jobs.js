@@ -0,0 +1,82 @@
+// Background jobs for long-running admin operations (backups, restores,
+// exports, batch archiving). A form is posted to the route that starts the
+// job, then /admin/jobs/<id> is polled until it finishes; a result file is
+// downloaded automatically.
+const BackgroundJobs = (function() {
+    const POLL_INTERVAL = 2000;
+
+    function describe(job) {
+        if (job.status === 'queued') return 'Waiting to start...';
+        if (job.status === 'failed') return `Failed: ${job.error}`;
+        const progress = job.progress !== null ? `${job.progress}%` : '';
+        const message = job.message || (job.status === 'succeeded' ? 'Done' : 'Working...');
+        return progress && job.status === 'running' ? `${message} (${progress})` : message;
+    }
+
+    function start(url, formData) {
+        return fetch(url, {
+            method: 'POST',
+            body: formData,
+            headers: { 'Accept': 'application/json' }
+        }).then(response => response.json().then(data => {
+            if (!response.ok) {
+                throw new Error(data.error || `HTTP error! status: ${response.status}`);
+            }
+            return data;
+        }));
+    }
+
+    // Poll a job until it finishes, calling onUpdate with each status
+    function follow(job, onUpdate) {
+        return new Promise((resolve, reject) => {
+            function check(current) {
+                if (onUpdate) onUpdate(current);
+                if (current.status === 'succeeded' || current.status === 'failed') {
+                    resolve(current);
+                    return;
+                }
+                setTimeout(() => {
+                    fetch(current.status_url, { headers: { 'Accept': 'application/json' } })
+                        .then(response => {
+                            if (!response.ok) {
+                                throw new Error(`HTTP error! status: ${response.status}`);
+                            }
+                            return response.json();
+                        })
+                        .then(check)
+                        .catch(reject);
+                }, POLL_INTERVAL);
+            }
+            check(job);
+        });
+    }
+
+    // Start a job from a form, show its progress in statusElement and download the result
+    function run(form, statusElement) {
+        const show = job => {
+            if (!statusElement) return;
+            statusElement.textContent = describe(job);
+            statusElement.classList.toggle('text-danger', job.status === 'failed');
+        };
+        if (statusElement) statusElement.textContent = 'Starting...';
+
+        return start(form.action, new FormData(form))
+            .then(job => follow(job, show))
+            .then(job => {
+                if (job.download_url) {
+                    window.location.href = job.download_url;
+                }
+                return job;
+            })
+            .catch(error => {
+                console.error('Background job error:', error);
+                if (statusElement) {
+                    statusElement.textContent = error.message;
+                    statusElement.classList.add('text-danger');
+                }
+                throw error;
+            });
+    }
+
+    return { start: start, follow: follow, run: run, describe: describe };
+})();
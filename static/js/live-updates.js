@@ -0,0 +1,88 @@
+// Shared live update connection for the sidebar panels.
+// One Server-Sent Events stream (/api/live) per page pushes active users,
+// upcoming time off and sidebar tickets when they change. While the stream
+// is unavailable, subscribers that gave a poll URL fall back to polling it.
+const LiveUpdates = (function() {
+    const STREAM_URL = '/api/live';
+    const EVENT_NAMES = ['active_users', 'time_off', 'tickets'];
+    const POLL_INTERVAL = 60000;
+    const RECONNECT_INTERVAL = 30000;
+
+    const handlers = {};
+    const pollUrls = {};
+    let source = null;
+    let pollTimer = null;
+    let reconnectTimer = null;
+
+    function dispatch(name, data) {
+        (handlers[name] || []).forEach(handler => {
+            try {
+                handler(data);
+            } catch (error) {
+                console.error(`Error handling live update '${name}':`, error);
+            }
+        });
+    }
+
+    function poll() {
+        Object.keys(pollUrls).forEach(name => {
+            fetch(pollUrls[name])
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error(`HTTP error! status: ${response.status}`);
+                    }
+                    return response.json();
+                })
+                .then(data => dispatch(name, data))
+                .catch(error => console.error(`Error polling ${pollUrls[name]}:`, error));
+        });
+    }
+
+    function startPolling() {
+        if (pollTimer) return;
+        poll();
+        pollTimer = setInterval(poll, POLL_INTERVAL);
+    }
+
+    function stopPolling() {
+        if (!pollTimer) return;
+        clearInterval(pollTimer);
+        pollTimer = null;
+    }
+
+    function connect() {
+        if (!window.EventSource) {
+            startPolling();
+            return;
+        }
+
+        source = new EventSource(STREAM_URL);
+        source.onopen = stopPolling;
+        source.onerror = function() {
+            // Keep the panels fresh while the browser retries the stream
+            startPolling();
+            if (source.readyState === EventSource.CLOSED && !reconnectTimer) {
+                // The browser gave up (e.g. server restart or auth error); try again later
+                reconnectTimer = setTimeout(() => {
+                    reconnectTimer = null;
+                    connect();
+                }, RECONNECT_INTERVAL);
+            }
+        };
+        EVENT_NAMES.forEach(name => {
+            source.addEventListener(name, event => dispatch(name, JSON.parse(event.data)));
+        });
+    }
+
+    function subscribe(name, handler, pollUrl) {
+        (handlers[name] = handlers[name] || []).push(handler);
+        if (pollUrl) {
+            pollUrls[name] = pollUrl;
+        }
+        if (!source && !pollTimer) {
+            connect();
+        }
+    }
+
+    return { subscribe: subscribe };
+})();
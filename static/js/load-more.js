@@ -0,0 +1,58 @@
+// "Load more" for the ticket dashboards. The button carries the JSON page
+// endpoint and the cursor of the next page; each click (or the button
+// scrolling into view) fetches that page with the current filters, appends
+// its rendered rows and moves the cursor on, until the last page.
+const LoadMoreTickets = (function() {
+    function attach(button, container, shownCounter) {
+        if (!button || !container) return;
+        let loading = false;
+
+        function loadPage() {
+            if (loading || !button.dataset.cursor) return;
+            loading = true;
+            button.disabled = true;
+
+            const url = new URL(button.dataset.url, window.location.origin);
+            new URLSearchParams(window.location.search).forEach((value, key) => {
+                if (!url.searchParams.has(key)) url.searchParams.set(key, value);
+            });
+            url.searchParams.set('cursor', button.dataset.cursor);
+
+            fetch(url, { headers: { 'Accept': 'application/json' } })
+                .then(response => {
+                    if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+                    return response.json();
+                })
+                .then(page => {
+                    container.insertAdjacentHTML('beforeend', page.html);
+                    if (shownCounter) {
+                        shownCounter.textContent = parseInt(shownCounter.textContent, 10) + page.tickets.length;
+                    }
+                    if (window.feather) feather.replace();
+                    if (page.next_cursor) {
+                        button.dataset.cursor = page.next_cursor;
+                    } else {
+                        button.remove();
+                        observer && observer.disconnect();
+                    }
+                })
+                .catch(error => console.error('Error loading tickets:', error))
+                .finally(() => {
+                    loading = false;
+                    button.disabled = false;
+                });
+        }
+
+        button.addEventListener('click', loadPage);
+
+        // Infinite scroll: load the next page as the button comes into view
+        const observer = 'IntersectionObserver' in window
+            ? new IntersectionObserver(entries => {
+                if (entries.some(entry => entry.isIntersecting)) loadPage();
+            }, { rootMargin: '200px' })
+            : null;
+        if (observer) observer.observe(button);
+    }
+
+    return { attach: attach };
+})();
@@ -0,0 +1,42 @@
+// "Load older" for a ticket's timeline. The page shows only the latest
+// entries; the button carries the timeline endpoint and the cursor of the
+// entries before them. Each click fetches the next older batch, puts it above
+// the entries already shown and moves the cursor back, until the first entry.
+const LoadOlderEntries = (function() {
+    function attach(button, container) {
+        if (!button || !container) return;
+        let loading = false;
+
+        button.addEventListener('click', function() {
+            if (loading || !button.dataset.cursor) return;
+            loading = true;
+            button.disabled = true;
+
+            const url = new URL(button.dataset.url, window.location.origin);
+            url.searchParams.set('before', button.dataset.cursor);
+            if (button.dataset.layout) url.searchParams.set('layout', button.dataset.layout);
+
+            fetch(url, { headers: { 'Accept': 'application/json' } })
+                .then(response => {
+                    if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+                    return response.json();
+                })
+                .then(page => {
+                    container.insertAdjacentHTML('afterbegin', page.html);
+                    if (window.feather) feather.replace();
+                    if (page.older_cursor) {
+                        button.dataset.cursor = page.older_cursor;
+                    } else {
+                        button.remove();
+                    }
+                })
+                .catch(error => console.error('Error loading older entries:', error))
+                .finally(() => {
+                    loading = false;
+                    button.disabled = false;
+                });
+        });
+    }
+
+    return { attach: attach };
+})();
@@ -0,0 +1,52 @@
+// Live counts for the ticket dashboard's filter bar. Each filter option shows
+// how many tickets choosing it would list under the other filters, fetched
+// from the facets endpoint on load and again whenever a filter changes,
+// without reloading the ticket list.
+const TicketFacets = (function() {
+    function label(option) {
+        if (!option.dataset.label) option.dataset.label = option.textContent.trim();
+        return option.dataset.label;
+    }
+
+    function show(form, facets) {
+        Object.keys(facets).forEach(facet => {
+            const select = form.querySelector(`select[name="${facet}"]`);
+            if (!select) return;
+            const counts = facets[facet];
+            const total = Object.values(counts).reduce((sum, count) => sum + count, 0);
+            Array.from(select.options).forEach(option => {
+                const all = option.value === '' || option.value === 'all';
+                const count = all ? total : (counts[option.value] || 0);
+                option.textContent = `${label(option)} (${count})`;
+            });
+        });
+    }
+
+    function attach(form, url) {
+        if (!form || !url) return;
+        let pending = null;
+
+        function refresh() {
+            // The page's filters, with whatever the form has changed since
+            const params = new URLSearchParams(window.location.search);
+            params.delete('cursor');
+            new FormData(form).forEach((value, key) => params.set(key, value));
+            const request = fetch(`${url}?${params.toString()}`, { headers: { 'Accept': 'application/json' } })
+                .then(response => {
+                    if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+                    return response.json();
+                })
+                .then(data => {
+                    // Only the latest request's counts match the form
+                    if (request === pending) show(form, data.facets);
+                })
+                .catch(error => console.error('Error loading filter counts:', error));
+            pending = request;
+        }
+
+        form.querySelectorAll('select').forEach(select => select.addEventListener('change', refresh));
+        refresh();
+    }
+
+    return { attach: attach };
+})();
@@ -0,0 +1,196 @@
+"""
+Email outbox checks: notifications are queued and sent by the dispatcher,
+retried with backoff, coalesced into digests when a recipient asks for them,
+and rendered from prefetched contexts.
+Runs against a throwaway in-memory SQLite database, never the configured DATABASE_URL.
+"""
+import os
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+from datetime import datetime, timedelta
+
+import pytz
+
+from app import app, db
+from models import User, Schedule, ScheduleRule, Ticket, EmailSettings, OutboxEmail, PendingNotification
+from email_outbox import OUTBOX_MAX_ATTEMPTS, dispatch_pending, flush_digests
+from email_rendering import TicketContext, render_email
+from email_utils import email_settings
+# The shared setup: in-memory database, inline jobs and the stub email transport
+from test_query_counts import admin_client, count_queries, outbox, seed_tickets, seed_week
+
+
+def test_new_recurring_schedule_sends_a_notification():
+    """Creating a weekly rule notifies the technician and admins like any other new schedule"""
+    with app.app_context():
+        seed_week(0)
+        db.session.add(EmailSettings(admin_email_group='alerts@example.com', digest_minutes=0))
+        db.session.commit()
+        technician_id = User.query.filter_by(username='tech0').first().id
+    first_day = (datetime.now(pytz.UTC) + timedelta(days=7)).date()
+    first_day -= timedelta(days=first_day.weekday())  # A Monday
+    outbox.sent.clear()
+
+    response = admin_client().post('/schedule/new', data={
+        'technician': technician_id,
+        'start_time': f'{first_day} 09:00',
+        'end_time': f'{first_day} 17:00',
+        'location_id': 1,
+        'repeat_weekly': 'y',
+        'repeat_days': (first_day + timedelta(days=2)).isoformat(),
+    })
+    assert response.status_code == 302
+    with app.app_context():
+        assert ScheduleRule.query.count() == 1 and Schedule.query.count() == 0
+    assert [(sent['subject'], sent['to']) for sent in outbox.sent] == \
+        [('Schedule created for tech0', ['alerts@example.com', 'tech0@example.com'])]
+    assert f'from {first_day} 09:00 to {first_day} 17:00' in outbox.sent[0]['text']
+    assert 'Recurring schedule (Mon, Wed) created by admin' in outbox.sent[0]['text']
+
+
+def test_notifications_go_through_the_outbox():
+    """Routes only queue emails; the dispatcher sends them and retries failures with backoff"""
+    with app.app_context():
+        seed_week(2)
+        db.session.add(EmailSettings(admin_email_group='alerts@example.com', digest_minutes=0))
+        db.session.commit()
+    client = admin_client()
+    outbox.sent.clear()
+    outbox.fail_next = 1
+    assert client.get('/schedule/delete/1').status_code == 302
+
+    with app.app_context():
+        email = OutboxEmail.query.one()
+        assert (email.status, email.attempts, email.last_error) == ('pending', 1, 'Stub transport failure')
+        assert email.recipient_list == ['alerts@example.com', 'tech0@example.com']
+        assert outbox.sent == []
+        assert dispatch_pending() == 0  # Backing off
+        assert dispatch_pending(now=datetime.now(pytz.UTC) + timedelta(hours=1)) == 1
+        assert db.session.get(OutboxEmail, email.id).status == 'sent'
+    assert [sent['subject'] for sent in outbox.sent] == ['Schedule deleted for tech0']
+
+    outbox.fail_next = OUTBOX_MAX_ATTEMPTS
+    assert client.get('/schedule/delete/2').status_code == 302
+    with app.app_context():
+        for attempt in range(2, OUTBOX_MAX_ATTEMPTS + 2):
+            dispatch_pending(now=datetime.now(pytz.UTC) + timedelta(days=attempt))
+        email = OutboxEmail.query.order_by(OutboxEmail.id.desc()).first()
+        assert (email.status, email.attempts) == ('failed', OUTBOX_MAX_ATTEMPTS)
+    assert len(outbox.sent) == 1
+
+
+def test_outbox_sends_after_leasing_its_batch():
+    """Claimed emails are leased and committed before sending, so no transaction is open during a send"""
+    class InspectingTransport:
+        def __init__(self):
+            self.seen = []
+
+        def send(self, email):
+            with db.engine.connect() as connection:
+                leased_until = connection.scalar(db.select(OutboxEmail.next_attempt_at)
+                                                 .where(OutboxEmail.id == email.id))
+            self.seen.append((db.session().in_transaction(), leased_until))
+
+    with app.app_context():
+        seed_week(0)
+        later = datetime.now(pytz.UTC) + timedelta(hours=1)
+        db.session.add_all([OutboxEmail(recipients='["tech0@example.com"]', from_email='alerts@example.com',
+                                        subject=f'Email {i}', html_content='<p>Hi</p>', next_attempt_at=later)
+                            for i in range(3)])
+        db.session.commit()
+
+        transport = app.config['EMAIL_TRANSPORT'] = InspectingTransport()
+        try:
+            now = later + timedelta(minutes=1)
+            assert dispatch_pending(now=now) == 3
+        finally:
+            app.config['EMAIL_TRANSPORT'] = outbox
+        assert [in_transaction for in_transaction, _ in transport.seen] == [False] * 3
+        assert all(leased_until.replace(tzinfo=pytz.UTC) > now for _, leased_until in transport.seen)
+        assert [(email.status, email.attempts) for email in OutboxEmail.query.order_by(OutboxEmail.id)] == \
+            [('sent', 1)] * 3
+
+
+def test_notifications_are_coalesced_into_digests():
+    """A burst of notifications becomes one digest per recipient, except for users who opt out"""
+    with app.app_context():
+        seed_week(20)
+        db.session.add(EmailSettings(admin_email_group='alerts@example.com', digest_minutes=10))
+        User.query.filter_by(username='tech1').one().digest_minutes = 0
+        db.session.commit()
+    client = admin_client()
+    outbox.sent.clear()
+    for schedule_id in (1, 11, 2, 12):  # Two shifts each for tech0 and tech1
+        assert client.get(f'/schedule/delete/{schedule_id}').status_code == 302
+    assert [sent['to'] for sent in outbox.sent] == [['tech1@example.com'], ['tech1@example.com']]
+
+    with app.app_context():
+        assert flush_digests() == 0  # Not due yet
+        assert flush_digests(now=datetime.now(pytz.UTC) + timedelta(minutes=11)) == 2
+        dispatch_pending()
+        assert PendingNotification.query.count() == 0
+    digests = {sent['to'][0]: sent for sent in outbox.sent[2:]}
+    assert digests['alerts@example.com']['subject'] == 'Digest of 4 notifications'
+    assert digests['tech0@example.com']['subject'] == 'Digest of 2 notifications'
+    assert digests['tech0@example.com']['html'].count('Schedule deleted for tech0') == 2
+    assert digests['tech0@example.com']['text'].count('---- Schedule deleted for tech0 ----') == 2
+
+
+def test_email_settings_are_cached_until_saved():
+    """Notifications read the settings once per process; saving them on the admin page reloads them"""
+    with app.app_context():
+        seed_week(20)
+    client = admin_client()
+    client.get('/schedule/delete/1')  # Creates and caches the default settings
+    with app.app_context(), count_queries() as statements:
+        assert client.get('/schedule/delete/2').status_code == 302
+    assert not any('email_settings' in statement for statement in statements)
+
+    client.post('/admin/email-settings', data={'admin_email_group': 'ops@example.com',
+                                               'notify_on_delete': 'y', 'digest_minutes': 0})
+    outbox.sent.clear()
+    client.get('/schedule/delete/3')
+    assert outbox.sent[0]['to'][0] == 'ops@example.com'
+
+
+def test_digests_are_opt_in():
+    """With the default settings and no user preference, notifications are sent straight away"""
+    with app.app_context():
+        seed_week(1)
+    outbox.sent.clear()
+    assert admin_client().get('/schedule/delete/1').status_code == 302
+    with app.app_context():
+        assert email_settings.get().digest_minutes == 0
+        assert PendingNotification.query.count() == 0
+    assert [sent['subject'] for sent in outbox.sent] == ['Schedule deleted for tech0']
+
+
+def test_notification_emails_render_without_queries():
+    """Emails render from precompiled templates and a prefetched context, with a plain-text alternate"""
+    with app.app_context():
+        seed_week(1)
+        seed_tickets(1)
+        ticket = Ticket.query.first()
+        ticket.title = 'Printer <on fire>'
+        db.session.commit()
+        context = TicketContext.from_ticket(ticket, 'https://sched.example.com')
+        with count_queries() as statements:
+            email = render_email('ticket_status', ticket=context, old_status='open', new_status='in_progress',
+                                 updated_by='admin', comment=None)
+        assert statements == []
+    assert email.subject == f'Status changed on Ticket #{context.id}'
+    assert 'Printer &lt;on fire&gt;' in email.html_content
+    assert 'Title: Printer <on fire>' in email.text_content
+    assert 'New Status: In Progress' in email.text_content
+    assert f'View Ticket: https://sched.example.com/tickets/{context.id}' in email.text_content
+
+
+if __name__ == '__main__':
+    test_new_recurring_schedule_sends_a_notification()
+    test_notifications_go_through_the_outbox()
+    test_outbox_sends_after_leasing_its_batch()
+    test_notifications_are_coalesced_into_digests()
+    test_email_settings_are_cached_until_saved()
+    test_digests_are_opt_in()
+    test_notification_emails_render_without_queries()
+    print("SUCCESS: email outbox checks passed")
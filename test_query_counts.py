@@ -0,0 +1,1031 @@
+"""
+Query-count checks for the hot pages.
+Runs against a throwaway in-memory SQLite database, never the configured DATABASE_URL.
+"""
+import csv
+import gzip
+import json
+import os
+import re
+import tempfile
+import threading
+import zipfile
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from io import BytesIO
+
+import pytz
+from openpyxl import load_workbook
+from sqlalchemy import event
+
+from app import app, db
+from models import (User, Location, Schedule, ScheduleRule, TicketCategory, Ticket, TicketComment, TicketHistory,
+                    BackgroundJob, OutboxEmail, MAX_SHIFT_LENGTH)
+import email_outbox
+from email_outbox import StubTransport
+from jobs import _owner as job_owner
+from email_utils import email_settings
+from ticket_utils import (TICKET_PAGE_SIZE, TIMELINE_PAGE_SIZE, TicketFilters, filtered_tickets, ticket_page,
+                          ticket_timeline)
+from schedule_utils import load_week_schedules, active_shifts, upcoming_time_off, time_off_cache, rule_occurrences
+
+app.config['WTF_CSRF_ENABLED'] = False
+# Background jobs run inside the request that starts them, writing results to a scratch directory
+app.config['JOBS_RUN_INLINE'] = True
+app.config['JOB_RESULTS_DIR'] = tempfile.mkdtemp(prefix='techsched-jobs-')
+# Emails are kept in memory and dispatched as soon as they are queued
+outbox = StubTransport()
+app.config['EMAIL_TRANSPORT'] = outbox
+app.config['EMAIL_SEND_INLINE'] = True
+
+
+@contextmanager
+def count_queries():
+    """Count the SQL statements executed inside the block"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+@contextmanager
+def emails_left_queued():
+    """Queue emails without sending them, as in production where the dispatcher thread sends them after the request"""
+    dispatcher, send_inline = email_outbox._dispatcher, app.config['EMAIL_SEND_INLINE']
+    email_outbox._dispatcher = threading.Thread()  # Never started, but counts as running so no real one starts
+    app.config['EMAIL_SEND_INLINE'] = False
+    try:
+        yield
+    finally:
+        email_outbox._dispatcher, app.config['EMAIL_SEND_INLINE'] = dispatcher, send_inline
+
+
+def week_bounds():
+    week_start = datetime.now(pytz.UTC).replace(hour=0, minute=0, second=0, microsecond=0)
+    week_start -= timedelta(days=week_start.weekday())
+    return week_start, week_start + timedelta(days=7)
+
+
+def seed_week(shift_count):
+    """Reset the database and create shift_count shifts spread across technicians and locations"""
+    db.drop_all()
+    db.create_all()
+    # drop_all() bypasses the commit hooks, so reset the in-process caches like a restart would
+    for cache in (active_shifts, time_off_cache, rule_occurrences, email_settings):
+        cache.invalidate()
+
+    admin = User(username='admin', email='admin@example.com', is_admin=True, timezone='UTC')
+    admin.set_password('password')
+    technicians = [User(username=f'tech{i}', email=f'tech{i}@example.com') for i in range(10)]
+    locations = [Location(name=f'Location {i}') for i in range(3)]
+    db.session.add_all([admin] + technicians + locations)
+    db.session.flush()
+
+    week_start, _ = week_bounds()
+    for i in range(shift_count):
+        start = week_start + timedelta(hours=i % 160)
+        db.session.add(Schedule(
+            technician_id=technicians[i % len(technicians)].id,
+            location_id=locations[i % len(locations)].id,
+            start_time=start,
+            end_time=start + timedelta(hours=1)
+        ))
+    db.session.commit()
+
+
+def seed_tickets(ticket_count):
+    """Add ticket_count tickets, each with two comments and a history entry, to the seeded database"""
+    users = User.query.order_by(User.id).all()
+    category = TicketCategory(name='Hardware')
+    db.session.add(category)
+    db.session.flush()
+    for i in range(ticket_count):
+        ticket = Ticket(title=f'Ticket {i}', description=f'Problem {i}', category_id=category.id,
+                        created_by=users[0].id, assigned_to=users[1 + i % (len(users) - 1)].id)
+        db.session.add(ticket)
+        db.session.flush()
+        db.session.add_all([
+            TicketComment(ticket_id=ticket.id, user_id=users[0].id, content='First look'),
+            TicketComment(ticket_id=ticket.id, user_id=ticket.assigned_to, content='Fixed'),
+            TicketHistory(ticket_id=ticket.id, user_id=users[0].id, action='created'),
+        ])
+    db.session.commit()
+
+
+def calendar_query_count(shift_count):
+    with app.app_context():
+        seed_week(shift_count)
+    client = app.test_client()
+    client.post('/login', data={'email': 'admin@example.com', 'password': 'password'})
+    with app.app_context():
+        with count_queries() as statements:
+            response = client.get('/calendar')
+    assert response.status_code == 200
+    return len(statements)
+
+
+def test_week_loader_is_single_query():
+    """Loading a busy week and touching technician/location must not lazy load"""
+    with app.app_context():
+        seed_week(300)
+        week_start, week_end = week_bounds()
+        with count_queries() as statements:
+            schedules = load_week_schedules(week_start, week_end, pytz.timezone('America/Chicago'))
+            for schedule in schedules:
+                schedule.technician.username, schedule.technician.color
+                schedule.location.name if schedule.location else None
+        assert len(schedules) == 300
+        # The week's schedules, plus the recurring rules expanded once per window
+        assert len(statements) == 2, statements
+
+
+def test_overnight_shift_shows_in_the_week_it_starts():
+    """A Sunday night shift running into Monday is listed in its own week, but still found as an overlap"""
+    with app.app_context():
+        seed_week(0)
+        technician = User.query.filter_by(username='tech0').first()
+        week_start, week_end = week_bounds()
+        db.session.add(Schedule(technician_id=technician.id, start_time=week_end - timedelta(hours=2),
+                                end_time=week_end + timedelta(hours=6)))
+        db.session.commit()
+
+        assert len(load_week_schedules(week_start, week_end, pytz.UTC)) == 1
+        assert load_week_schedules(week_end, week_end + timedelta(days=7), pytz.UTC) == []
+        assert Schedule.overlapping(week_end, week_end + timedelta(days=7), technician=technician).count() == 1
+
+
+def test_overlong_shifts_are_rejected():
+    """Shifts longer than MAX_SHIFT_LENGTH are refused, so overlap queries can bound start_time from below"""
+    with app.app_context():
+        seed_week(0)
+        technician_id = User.query.filter_by(username='tech0').first().id
+    client = app.test_client()
+    client.post('/login', data={'email': 'admin@example.com', 'password': 'password'})
+    start = datetime.now(pytz.UTC).date() + timedelta(days=7)
+    response = client.post('/schedule/new', data={
+        'technician': technician_id,
+        'start_time': f'{start} 09:00',
+        'end_time': f'{start + MAX_SHIFT_LENGTH} 17:00',
+        'location_id': 1,
+    })
+    assert response.status_code == 302
+    with app.app_context():
+        assert Schedule.query.count() == 0
+
+
+def test_calendar_query_count_independent_of_shifts():
+    """The calendar page costs the same number of queries for 1 shift or 300"""
+    assert calendar_query_count(1) == calendar_query_count(300)
+
+
+def test_active_users_snapshot_is_cached():
+    """Active users are served from memory until a Schedule row changes"""
+    with app.app_context():
+        seed_week(0)
+        technician = User.query.filter_by(username='tech0').first()
+        now = datetime.now(pytz.UTC)
+        db.session.add(Schedule(technician_id=technician.id, start_time=now - timedelta(hours=1),
+                                end_time=now + timedelta(hours=1)))
+        db.session.commit()
+
+        assert [shift.username for shift in active_shifts.get()] == ['tech0']
+        with count_queries() as statements:
+            active_shifts.get()
+        assert statements == []
+
+        Schedule.query.delete()
+        db.session.commit()
+        assert active_shifts.get() == []
+
+
+def test_upcoming_time_off_is_one_cached_query():
+    """Time off loads with its technicians in one query and stays cached until time off changes"""
+    with app.app_context():
+        seed_week(0)
+        technicians = User.query.filter(User.username.like('tech%')).all()
+        now = datetime.now(pytz.UTC)
+        day = now.replace(hour=12, minute=0, second=0, microsecond=0) + timedelta(days=2)
+        for technician in technicians:
+            for offset in (0, 1, 5):  # Two consecutive days, then a separate one
+                start = day + timedelta(days=offset)
+                db.session.add(Schedule(technician_id=technician.id, start_time=start,
+                                        end_time=start + timedelta(hours=8), time_off=True))
+        db.session.commit()
+
+        with count_queries() as statements:
+            entries = upcoming_time_off(now)
+        assert len(statements) == 2, statements  # Time off schedules and recurring rules
+        assert len(entries) == 2 * len(technicians)
+        assert [entry['duration'] for entry in entries[:2]] == ['2 days', '1 day']
+
+        with count_queries() as statements:
+            upcoming_time_off(now)
+        assert statements == []
+
+        # Regular shifts don't touch the cache, time off does
+        db.session.add(Schedule(technician_id=technicians[0].id, start_time=day, end_time=day + timedelta(hours=1)))
+        db.session.commit()
+        with count_queries() as statements:
+            upcoming_time_off(now)
+        assert statements == []
+
+        Schedule.query.filter_by(time_off=True).delete()
+        db.session.commit()
+        assert upcoming_time_off(now) == []
+
+
+def test_repeat_days_are_checked_and_inserted_in_bulk():
+    """A month of repeat days costs a handful of queries and reports each conflicting date"""
+    with app.app_context():
+        seed_week(0)
+        technician = User.query.filter_by(username='tech0').first()
+        technician_id = technician.id
+        first_day = (datetime.now(pytz.UTC) + timedelta(days=7)).date()
+        days = [first_day + timedelta(days=i) for i in range(31)]
+        for conflict_day in (days[3], days[10]):
+            start = datetime.combine(conflict_day, datetime.min.time()).replace(hour=10, tzinfo=pytz.UTC)
+            db.session.add(Schedule(technician_id=technician_id, start_time=start, end_time=start + timedelta(hours=2)))
+        db.session.commit()
+        email_settings.get()  # Loaded once per process, not per request
+
+    client = app.test_client()
+    client.post('/login', data={'email': 'admin@example.com', 'password': 'password'})
+    with app.app_context():
+        with emails_left_queued(), count_queries() as statements:
+            response = client.post('/schedule/new', data={
+                'technician': technician_id,
+                'start_time': f'{days[0]} 09:00',
+                'end_time': f'{days[0]} 17:00',
+                'location_id': 1,
+                'repeat_days': ','.join(day.isoformat() for day in days[1:]),
+            })
+        assert response.status_code == 302
+        inserts = [statement for statement in statements if statement.lstrip().upper().startswith('INSERT INTO SCHEDULE')]
+        assert len(inserts) == 2, inserts  # The primary shift and one multi-row INSERT
+        assert len(statements) < 15, statements
+        assert OutboxEmail.query.filter_by(status='pending').count() == 1  # Queued for the dispatcher
+        assert Schedule.query.filter_by(technician_id=technician_id).count() == 2 + 29
+
+    with client.session_transaction() as session:
+        messages = [message for _, message in session['_flashes']]
+    assert any('Skipped 2 dates' in message and days[3].strftime('%b %d') in message for message in messages), messages
+
+
+def test_schedule_rules_expand_lazily_and_cache():
+    """Recurring rules show up in week views without rows per day, and expansion is cached"""
+    with app.app_context():
+        seed_week(0)
+        technician = User.query.filter_by(username='tech0').first()
+        week_start, week_end = week_bounds()
+        rule = ScheduleRule(technician_id=technician.id, start_time=datetime.min.time().replace(hour=9),
+                            end_time=datetime.min.time().replace(hour=17), timezone='America/Chicago',
+                            start_date=week_start.date())
+        rule.set_weekdays(range(7))
+        rule.add_exception(week_start.date() + timedelta(days=2))
+        db.session.add(rule)
+        db.session.commit()
+
+        views = load_week_schedules(week_start, week_end, pytz.UTC)
+        assert [view.occurrence_date.weekday() for view in views] == [0, 1, 3, 4, 5, 6]
+        assert all(view.rule_id == rule.id and view.id is None for view in views)
+        assert all(view.start_time.astimezone(pytz.timezone('America/Chicago')).hour == 9 for view in views)
+
+        # Only the concrete schedules are queried once the week has been expanded
+        with count_queries() as statements:
+            load_week_schedules(week_start, week_end, pytz.UTC)
+        assert len(statements) == 1, statements
+
+        rule.add_exception(week_start.date())
+        db.session.commit()
+        assert len(load_week_schedules(week_start, week_end, pytz.UTC)) == 5
+        assert Schedule.query.count() == 0
+
+    client = app.test_client()
+    client.post('/login', data={'email': 'admin@example.com', 'password': 'password'})
+    response = client.get('/calendar')
+    assert response.status_code == 200
+    assert b'data-rule-id="1"' in response.data
+
+
+def test_recurring_schedule_changes_need_a_csrf_post():
+    """Skipping an occurrence or deleting a series only happens on a POST carrying a CSRF token"""
+    with app.app_context():
+        seed_week(0)
+        week_start, _ = week_bounds()
+        rule = ScheduleRule(technician_id=User.query.filter_by(username='tech0').first().id,
+                            start_time=datetime.min.time().replace(hour=9),
+                            end_time=datetime.min.time().replace(hour=17), start_date=week_start.date())
+        rule.set_weekdays(range(7))
+        db.session.add(rule)
+        db.session.commit()
+    client = admin_client()
+    skip = {'date': week_start.date().isoformat(), 'week_start': week_start.strftime('%Y-%m-%d')}
+
+    assert client.get(f'/schedule/rule/1/skip?date={skip["date"]}').status_code == 405
+    assert client.get('/schedule/rule/delete/1').status_code == 405
+    app.config['WTF_CSRF_ENABLED'] = True
+    try:
+        assert client.post('/schedule/rule/1/skip', data=skip).status_code == 400
+        assert client.post('/schedule/rule/delete/1').status_code == 400
+    finally:
+        app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        assert db.session.get(ScheduleRule, 1).exceptions == ''
+
+    response = client.post('/schedule/rule/1/skip', data=skip)
+    assert response.status_code == 302 and f'week_start={skip["week_start"]}' in response.location
+    with app.app_context():
+        assert db.session.get(ScheduleRule, 1).get_exceptions() == {week_start.date()}
+    response = client.post('/schedule/rule/delete/1', data={'personal_view': 'true'})
+    assert response.status_code == 302 and '/personal_schedule' in response.location
+    with app.app_context():
+        assert ScheduleRule.query.count() == 0
+
+
+def copy_week(client, weeks, dry_run=False):
+    """Copy the seeded week into the following weeks, returning (response, statements)"""
+    week_start, _ = week_bounds()
+    with app.app_context():
+        with count_queries() as statements:
+            response = client.post('/schedule/copy_previous_week', data={
+                'csrf_token': 'unused',
+                'target_week_start': (week_start + timedelta(days=7)).strftime('%Y-%m-%d'),
+                'weeks': weeks,
+                'dry_run': 'true' if dry_run else ''
+            })
+    return response, statements
+
+
+def admin_client():
+    client = app.test_client()
+    client.post('/login', data={'email': 'admin@example.com', 'password': 'password'})
+    return client
+
+
+def test_copy_previous_week_is_set_based():
+    """Copying a week costs the same statements for 1 shift or 300, and for 1 target week or 4"""
+    with app.app_context():
+        seed_week(1)
+    _, one_shift = copy_week(admin_client(), 1)
+
+    with app.app_context():
+        seed_week(300)
+    client = admin_client()
+    response, _ = copy_week(client, 4, dry_run=True)
+    assert response.json == {'source': 300, 'weeks': 4, 'added': 1200, 'removed': 0, 'unchanged': 0}
+    _, many_shifts = copy_week(client, 4)
+    assert len(one_shift) == len(many_shifts), many_shifts
+
+    with app.app_context():
+        _, week_end = week_bounds()
+        assert Schedule.query.count() == 300 * 5
+        copied = Schedule.overlapping(week_end, week_end + timedelta(days=7)).first()
+        assert copied.end_time - copied.start_time == timedelta(hours=1)
+
+    # Copying again over the same weeks would leave everything as it is
+    response, _ = copy_week(client, 4, dry_run=True)
+    assert response.json == {'source': 300, 'weeks': 4, 'added': 0, 'removed': 0, 'unchanged': 1200}
+
+
+def export_week(client, **extra):
+    week_start, week_end = week_bounds()
+    # The export defaults to Central time, so pad the range to cover the whole UTC week
+    params = {'start_date': (week_start - timedelta(days=1)).strftime('%Y-%m-%d'),
+              'end_date': week_end.strftime('%Y-%m-%d'), **extra}
+    with app.app_context(), count_queries() as statements:
+        response = client.get('/admin/export_schedules', query_string=params)
+    assert response.status_code == 200, response.status_code
+    return response, statements
+
+
+def test_export_is_one_query_per_period():
+    """Exporting timesheets costs the same statements for 1 shift or 300"""
+    with app.app_context():
+        seed_week(1)
+    response, one_shift = export_week(admin_client())
+    assert load_workbook(BytesIO(response.data)).sheetnames == ['tech0']
+
+    with app.app_context():
+        seed_week(300)
+    response, many_shifts = export_week(admin_client())
+    assert len(one_shift) == len(many_shifts), many_shifts
+
+    workbook = load_workbook(BytesIO(response.data))
+    assert workbook.sheetnames == [f'tech{i}' for i in range(10)]
+    rows = list(workbook['tech0'].iter_rows(min_row=7, values_only=True))
+    assert sum(1 for row in rows if row[5] == 'Work') == 30
+    assert rows == sorted(rows, key=lambda row: datetime.strptime(f'{row[1]} {row[2]}', '%m/%d/%Y %I:%M %p')
+                          if row[2] != '0' else datetime.strptime(row[1], '%m/%d/%Y'))
+
+
+def test_flat_exports_stream_from_the_same_query():
+    """CSV and NDJSON exports are streamed in the requested timezone from the same single query"""
+    with app.app_context():
+        seed_week(300)
+    client = admin_client()
+    response, xlsx_statements = export_week(client)
+
+    response, statements = export_week(client, format='ndjson', timezone='UTC')
+    assert response.mimetype == 'application/x-ndjson'
+    assert response.is_streamed
+    records = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert len(statements) == len(xlsx_statements), statements
+    assert len(records) == 300
+    assert records[0] == {'technician': 'tech0', 'date': week_bounds()[0].date().isoformat(),
+                          'day': week_bounds()[0].strftime('%A'), 'clock_in': '00:00', 'clock_out': '01:00',
+                          'hours': 1.0, 'type': 'Work', 'location': 'Location 0', 'notes': 'Location: Location 0'}
+
+    response, _ = export_week(client, format='csv', timezone='America/New_York')
+    assert response.mimetype == 'text/csv'
+    rows = list(csv.DictReader(response.get_data(as_text=True).splitlines()))
+    assert len(rows) == 300
+    assert rows[0]['clock_in'] in ('19:00', '20:00')  # midnight UTC, with or without DST
+
+    response = client.get('/admin/export_schedules', query_string={
+        'start_date': '2024-01-01', 'end_date': '2024-01-07', 'timezone': 'Mars/Olympus'})
+    assert response.status_code == 302
+
+
+def download_backup(client, **params):
+    with app.app_context(), count_queries() as statements:
+        response = client.get('/admin/backup/download', query_string=params)
+        assert response.is_streamed
+        data = response.get_data()  # The body is generated while it is read
+    assert response.status_code == 200, response.status_code
+    return data, statements
+
+
+def test_backup_download_is_batched():
+    """A backup costs the same statements for 1 ticket or 60, and the gzip option holds the same document"""
+    with app.app_context():
+        seed_week(1)
+        seed_tickets(1)
+    _, one_ticket = download_backup(admin_client())
+
+    with app.app_context():
+        seed_week(300)
+        seed_tickets(60)
+    client = admin_client()
+    data, many_tickets = download_backup(client)
+    assert len(one_ticket) == len(many_tickets), many_tickets
+
+    backup = json.loads(data)
+    assert len(backup['schedules']) == 300
+    assert sum(len(user['created_schedules']) for user in backup['users']) == 300
+    assert backup['schedules'][0]['technician_username'] == 'tech0'
+    assert len(backup['tickets']) == 60
+    ticket = backup['tickets'][1]
+    assert (ticket['category_name'], ticket['creator_username'], ticket['assigned_username']) == ('Hardware', 'admin', 'tech1')
+    assert [comment['content'] for comment in ticket['comments']] == ['First look', 'Fixed']
+    assert ticket['comments'][1]['username'] == 'tech1'
+    assert [entry['action'] for entry in ticket['history']] == ['created']
+
+    compressed, _ = download_backup(client, compress='gzip')
+    compressed = json.loads(gzip.decompress(compressed))
+    # Each backup has its own watermark
+    assert (compressed.pop('backup')['type'], backup.pop('backup')['type']) == ('full', 'full')
+    assert compressed == backup
+
+
+def restore(client, data):
+    with app.app_context(), count_queries() as statements:
+        response = client.post('/admin/restore', data={'csrf_token': 'test', 'backup_file': (BytesIO(data), 'backup.json')},
+                               content_type='multipart/form-data', follow_redirects=True)
+    assert response.status_code == 200, response.status_code
+    return response.get_data(as_text=True), statements
+
+
+def test_restore_is_set_based():
+    """Restoring costs the same statements for 1 ticket or 60, and skips rows that already exist"""
+    with app.app_context():
+        seed_week(1)
+        seed_tickets(1)
+    data, _ = download_backup(admin_client())
+    with app.app_context():
+        Ticket.query.delete()
+        db.session.commit()
+    _, one_ticket = restore(admin_client(), data)
+
+    with app.app_context():
+        seed_week(300)
+        seed_tickets(60)
+    client = admin_client()
+    data, _ = download_backup(client, compress='gzip')
+    with app.app_context():
+        TicketComment.query.delete()
+        TicketHistory.query.delete()
+        Ticket.query.delete()
+        Schedule.query.filter(Schedule.id > 100).delete()
+        db.session.commit()
+
+    page, many_tickets = restore(client, data)
+    assert len(one_ticket) == len(many_tickets), many_tickets
+    assert '200 schedules restored, 100 skipped. 60 tickets restored, 0 skipped.' in page
+
+    with app.app_context():
+        assert Schedule.query.count() == 300
+        assert TicketComment.query.count() == 120
+        ticket = db.session.get(Ticket, 2)
+        assert ticket.assigned_technician.username == 'tech1'
+        assert [comment.content for comment in ticket.comments.order_by(TicketComment.id)] == ['First look', 'Fixed']
+
+    # Everything is already there the second time round
+    page, _ = restore(client, data)
+    assert '0 schedules restored, 300 skipped. 0 tickets restored, 60 skipped.' in page
+
+    page, _ = restore(client, b'{"schedules": [{"technician_username": ')
+    assert 'Invalid backup file format' in page
+
+
+def start_job(client, url, **data):
+    response = client.post(url, data={'csrf_token': 'test', **data}, headers={'Accept': 'application/json'})
+    assert response.status_code == 202, response.get_data(as_text=True)
+    return response.json
+
+
+def test_heavy_operations_run_as_background_jobs():
+    """Backups, exports, restores and batch archiving are started as jobs that report their outcome"""
+    with app.app_context():
+        seed_week(30)
+        seed_tickets(5)
+    client = admin_client()
+
+    job = start_job(client, '/admin/backup/start', compress='gzip')
+    assert (job['kind'], job['status'], job['progress']) == ('backup', 'succeeded', 100)
+    backup = json.loads(gzip.decompress(client.get(job['download_url']).data))
+    assert len(backup['schedules']) == 30 and len(backup['tickets']) == 5
+
+    week_start, week_end = week_bounds()
+    job = start_job(client, '/admin/export_schedules/start', format='csv', timezone='UTC',
+                    start_date=week_start.strftime('%Y-%m-%d'), end_date=week_end.strftime('%Y-%m-%d'))
+    response = client.get(job['download_url'])
+    assert response.mimetype == 'text/csv'
+    assert len(list(csv.DictReader(response.get_data(as_text=True).splitlines()))) == 30
+
+    job = start_job(client, '/tickets/batch-archive', status='all')
+    assert job['message'] == 'Successfully archived 5 tickets'
+    with app.app_context():
+        assert Ticket.query.filter_by(archived=True).count() == 5
+        assert TicketHistory.query.filter_by(action='archived').count() == 5
+
+    job = start_job(client, '/admin/restore', backup_file=(BytesIO(b'not json'), 'backup.json'))
+    assert (job['status'], job['error']) == ('failed', 'Invalid backup file format')
+    assert client.get(job['status_url']).json['status'] == 'failed'
+
+    jobs = client.get('/admin/jobs').json
+    assert [job['kind'] for job in jobs] == ['restore', 'archive_tickets', 'export_schedules', 'backup']
+    assert 'Recent Jobs' in client.get('/admin/backup').get_data(as_text=True)
+
+
+def test_deleting_a_user_keeps_their_jobs():
+    """Jobs started by a deleted admin move to the System user rather than blocking the delete"""
+    with app.app_context():
+        seed_week(1)
+        other = User(username='other', email='other@example.com', is_admin=True)
+        other.set_password('password')
+        db.session.add(other)
+        db.session.commit()
+        other_id = other.id
+
+    client = app.test_client()
+    client.post('/login', data={'email': 'other@example.com', 'password': 'password'})
+    job = start_job(client, '/admin/backup/start')
+
+    response = admin_client().get(f'/admin/delete_user/{other_id}', follow_redirects=True)
+    assert 'User and associated data deleted successfully!' in response.get_data(as_text=True)
+    with app.app_context():
+        assert db.session.get(User, other_id) is None
+        assert db.session.get(BackgroundJob, job['id']).creator.username == 'System'
+
+
+def test_jobs_from_before_a_restart_are_failed():
+    """Jobs whose process has gone show as interrupted; jobs still live in another process are left alone"""
+    with app.app_context():
+        seed_week(0)
+        admin = User.query.filter_by(username='admin').first()
+        earlier = datetime.now(pytz.UTC) - timedelta(days=1)
+        db.session.add_all([
+            # Stale heartbeats
+            BackgroundJob(kind='backup', status='running', created_by=admin.id, created_at=earlier,
+                          owner='other:1', updated_at=earlier),
+            BackgroundJob(kind='restore', status='queued', created_by=admin.id, created_at=earlier,
+                          owner='other:1', updated_at=earlier),
+            # Still running elsewhere
+            BackgroundJob(kind='backup', status='running', created_by=admin.id, created_at=earlier, owner='other:2'),
+            # Left by an earlier run of this process
+            BackgroundJob(kind='backup', status='running', created_by=admin.id, created_at=earlier, owner=job_owner),
+            BackgroundJob(kind='backup', status='running', created_by=admin.id, owner=job_owner),
+        ])
+        db.session.commit()
+    client = admin_client()
+
+    assert client.get('/admin/jobs/1').json['error'] == 'Interrupted by a restart before it finished'
+    statuses = {job['id']: job['status'] for job in client.get('/admin/jobs').json}
+    assert statuses == {1: 'failed', 2: 'failed', 3: 'running', 4: 'failed', 5: 'running'}
+
+
+def backdate(days):
+    """Make everything in the database look like it was written days ago"""
+    then = datetime.now(pytz.UTC) - timedelta(days=days)
+    for model in (User, Location, Schedule, ScheduleRule, TicketCategory, Ticket, TicketComment, TicketHistory):
+        model.query.update({column: then for column in ('created_at', 'updated_at') if hasattr(model, column)})
+    db.session.commit()
+
+
+def test_incremental_backups_restore_as_a_chain():
+    """An incremental backup holds only changes and deletions, and a full backup plus incrementals restore together"""
+    with app.app_context():
+        seed_week(20)
+        seed_tickets(3)
+        backdate(1)
+    client = admin_client()
+    response = client.get('/admin/backup/download', query_string={'mode': 'incremental'})
+    assert response.status_code == 302  # Nothing to continue from yet
+    full, _ = download_backup(client)
+
+    with app.app_context():
+        db.session.get(Schedule, 1).description = 'Moved'
+        db.session.delete(db.session.get(Schedule, 2))
+        Schedule.query.filter(Schedule.id == 3).delete()
+        db.session.add(TicketComment(ticket_id=1, user_id=1, content='Still broken'))
+        db.session.delete(db.session.get(Ticket, 3))
+        db.session.commit()
+    first, _ = download_backup(client, mode='incremental')
+
+    incremental = json.loads(first)
+    assert incremental['backup']['type'] == 'incremental'
+    assert incremental['users'] == [] and incremental['locations'] == []
+    assert [schedule['id'] for schedule in incremental['schedules']] == [1]
+    assert [ticket['id'] for ticket in incremental['tickets']] == [1]
+    assert [comment['content'] for comment in incremental['tickets'][0]['comments']] == ['First look', 'Fixed', 'Still broken']
+    deleted = {(record['table'], record['id']) for record in incremental['deleted']}
+    assert {('schedule', 2), ('schedule', 3), ('ticket', 3), ('ticket_comment', 5), ('ticket_history', 3)} <= deleted
+
+    with app.app_context():
+        db.session.get(Schedule, 1).description = 'Moved again'
+        db.session.commit()
+    second, _ = download_backup(client, mode='incremental')
+
+    def restore_files(*files):
+        response = client.post('/admin/restore', content_type='multipart/form-data', follow_redirects=True, data={
+            'csrf_token': 'test', 'backup_file': [(BytesIO(data), f'backup{i}.json') for i, data in enumerate(files)]})
+        return response.get_data(as_text=True)
+
+    with app.app_context():
+        seed_week(0)
+    client = admin_client()
+    assert 'does not continue from the backups before it' in restore_files(full, second)
+    page = restore_files(second, full, first)  # Put in order by their watermarks
+    assert '18 schedules restored, 0 skipped. 2 tickets restored, 0 skipped.' in page, page
+
+    with app.app_context():
+        assert Schedule.query.count() == 18
+        assert Schedule.query.filter(Schedule.description.like('Moved%')).one().description == 'Moved again'
+        assert db.session.get(Ticket, 3) is None
+        comments = db.session.get(Ticket, 1).comments.order_by(TicketComment.id)
+        assert [comment.content for comment in comments] == ['First look', 'Fixed', 'Still broken']
+
+
+def test_incremental_backups_carry_schedule_rule_changes():
+    """New rules, added skip dates and deleted rules travel in incrementals and collapse on restore"""
+    week_start, _ = week_bounds()
+
+    def add_rule(username, hour):
+        rule = ScheduleRule(technician_id=User.query.filter_by(username=username).one().id,
+                            start_time=datetime.min.time().replace(hour=hour),
+                            end_time=datetime.min.time().replace(hour=hour + 4), start_date=week_start.date())
+        rule.set_weekdays([1, 3])
+        db.session.add(rule)
+        return rule
+
+    def rules():
+        return sorted((rule.technician.username, rule.start_time.hour, rule.exceptions)
+                      for rule in ScheduleRule.query.all())
+
+    with app.app_context():
+        seed_week(0)
+        add_rule('tech1', 8)
+        add_rule('tech2', 12)
+        db.session.commit()
+        backdate(1)
+    client = admin_client()
+    full, _ = download_backup(client)
+
+    with app.app_context():
+        ScheduleRule.query.filter_by(start_time=datetime.min.time().replace(hour=8)).one() \
+            .add_exception(week_start.date() + timedelta(days=1))
+        add_rule('tech3', 14)
+        db.session.flush()  # Before the delete, so SQLite does not reuse the deleted id
+        db.session.delete(ScheduleRule.query.filter_by(start_time=datetime.min.time().replace(hour=12)).one())
+        db.session.commit()
+        expected = rules()
+    incremental, _ = download_backup(client, mode='incremental')
+    changes = json.loads(incremental)
+    assert sorted(rule['technician_username'] for rule in changes['schedule_rules']) == ['tech1', 'tech3']
+    assert ('schedule_rule', 2) in {(record['table'], record['id']) for record in changes['deleted']}
+
+    with app.app_context():
+        seed_week(0)
+    client = admin_client()
+    client.post('/admin/restore', content_type='multipart/form-data', follow_redirects=True, data={
+        'csrf_token': 'test', 'backup_file': [(BytesIO(full), 'full.json'), (BytesIO(incremental), 'incr.json')]})
+    with app.app_context():
+        assert rules() == expected
+
+
+def test_columnar_backup_is_smaller_and_restores():
+    """The columnar archive restores like the JSON backup, is smaller than gzipped JSON and is checksummed"""
+    with app.app_context():
+        seed_week(300)
+        seed_tickets(60)
+    client = admin_client()
+    compressed, _ = download_backup(client, compress='gzip')
+    response = client.get('/admin/backup/download', query_string={'format': 'columnar'})
+    assert response.mimetype == 'application/zip'
+    archive = response.get_data()
+    assert len(archive) < len(compressed), (len(archive), len(compressed))
+
+    with zipfile.ZipFile(BytesIO(archive)) as backup:
+        manifest = json.loads(backup.read('manifest.json'))
+        assert manifest['backup']['type'] == 'full'
+        sections = {section['name']: section['rows'] for section in manifest['sections']}
+        assert (sections['schedules'], sections['tickets'], sections['ticket_comments']) == (300, 60, 120)
+        members = {name: backup.read(name) for name in backup.namelist()}
+
+    def shifts():
+        return sorted((schedule.technician.username, schedule.location.name, schedule.start_time)
+                      for schedule in Schedule.query.all())
+
+    with app.app_context():
+        before = shifts()
+        TicketComment.query.delete()
+        TicketHistory.query.delete()
+        Ticket.query.delete()
+        Schedule.query.filter(Schedule.id > 100).delete()
+        db.session.commit()
+    page, _ = restore(client, archive)
+    assert '200 schedules restored, 100 skipped. 60 tickets restored, 0 skipped.' in page
+    with app.app_context():
+        assert shifts() == before
+        ticket = db.session.get(Ticket, 2)
+        assert [comment.content for comment in ticket.comments.order_by(TicketComment.id)] == ['First look', 'Fixed']
+        assert ticket.created_at is not None
+
+    # A damaged section fails the restore instead of loading bad rows
+    members['schedules.jsonl'] = members['schedules.jsonl'].replace(b'tech1', b'tech2', 1)
+    damaged = BytesIO()
+    with zipfile.ZipFile(damaged, 'w') as backup:
+        for name, data in members.items():
+            backup.writestr(name, data)
+    job = start_job(client, '/admin/restore', backup_file=(BytesIO(damaged.getvalue()), 'backup.zip'))
+    assert job['status'] == 'failed' and 'checksum' in job['error'], job
+
+
+def test_schedule_rules_round_trip_through_backups():
+    """Recurring rules and their skipped dates survive a backup and restore in either format"""
+    with app.app_context():
+        seed_week(0)
+        week_start, _ = week_bounds()
+        rule = ScheduleRule(technician_id=User.query.filter_by(username='tech3').one().id,
+                            location_id=Location.query.filter_by(name='Location 1').one().id,
+                            description='Night desk', start_time=datetime.min.time().replace(hour=22),
+                            end_time=datetime.min.time().replace(hour=6), timezone='America/Chicago',
+                            start_date=week_start.date(), until_date=week_start.date() + timedelta(days=60))
+        rule.set_weekdays([0, 2, 4])
+        rule.add_exception(week_start.date() + timedelta(days=2))
+        rule.add_exception(week_start.date() + timedelta(days=9))
+        db.session.add(rule)
+        db.session.commit()
+        before = rule.to_dict()
+    client = admin_client()
+    backup, _ = download_backup(client)
+    assert [rule['exceptions'] for rule in json.loads(backup)['schedule_rules']] == [before['exceptions']]
+    archive = client.get('/admin/backup/download', query_string={'format': 'columnar'}).get_data()
+
+    for data in (backup, archive):
+        with app.app_context():
+            ScheduleRule.query.delete()
+            db.session.commit()
+        restore(client, data)
+        with app.app_context():
+            restored = ScheduleRule.query.one().to_dict()
+            assert {key: value for key, value in restored.items() if key not in ('id', 'created_at', 'updated_at')} == \
+                {key: value for key, value in before.items() if key not in ('id', 'created_at', 'updated_at')}
+        restore(client, data)  # Already there, so skipped
+        with app.app_context():
+            assert ScheduleRule.query.count() == 1
+
+
+def dashboard_query_count(ticket_count, **headers):
+    with app.app_context():
+        seed_week(1)
+        seed_tickets(ticket_count)
+    client = admin_client()
+    with app.app_context(), count_queries() as statements:
+        response = client.get('/tickets/dashboard?status=all', headers=headers)
+    assert response.status_code == 200
+    assert f'Ticket {ticket_count - 1}'.encode() in response.data  # The newest ticket
+    return len(statements)
+
+
+def test_ticket_dashboard_query_budget():
+    """The dashboard costs a fixed handful of queries however many tickets match"""
+    mobile = {'User-Agent': 'Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) Mobile'}
+    for headers in ({}, mobile):
+        few = dashboard_query_count(3, **headers)
+        many = dashboard_query_count(TICKET_PAGE_SIZE * 3, **headers)
+        assert few == many, (few, many)
+        assert many <= 7, many  # Including the COUNT for the total
+
+
+def test_ticket_dashboard_pages_by_keyset():
+    """The dashboard renders one page; the JSON endpoint walks the rest without repeats, ties broken by id"""
+    with app.app_context():
+        seed_week(1)
+        seed_tickets(120)
+        # A run of tickets created at the same moment, so pages must break ties by id
+        Ticket.query.filter(Ticket.id <= 60).update({'created_at': datetime(2025, 1, 1, tzinfo=pytz.UTC)})
+        db.session.commit()
+    client = admin_client()
+    response = client.get('/tickets/dashboard?status=all')
+    assert b'Showing <span id="tickets-shown">50</span> of 120 tickets' in response.data
+
+    page = client.get('/tickets/api/page?status=all').get_json()
+    assert page['total'] == 120
+    seen = [ticket['id'] for ticket in page['tickets']]
+    while page['next_cursor']:
+        with app.app_context(), count_queries() as statements:
+            page = client.get(f"/tickets/api/page?status=all&cursor={page['next_cursor']}").get_json()
+        assert len(statements) <= 2, statements  # The user and the page
+        assert 'total' not in page
+        seen += [ticket['id'] for ticket in page['tickets']]
+    assert len(seen) == len(set(seen)) == 120
+    assert seen[-60:] == list(range(60, 0, -1))
+    assert page['html'].count('<tr>') == 120 - 2 * TICKET_PAGE_SIZE
+    assert client.get('/tickets/api/page?cursor=bogus').status_code == 400
+
+
+def test_ticket_search_covers_comments_and_pages_by_rank():
+    """Searches match title, description and comment text; ranked results page by (rank, id)"""
+    with app.app_context():
+        seed_week(1)
+        seed_tickets(30)
+        db.session.get(Ticket, 3).description = 'Projector flickers in studio B'
+        db.session.add(TicketComment(ticket_id=7, user_id=1, content='Replaced the HDMI cable'))
+        db.session.commit()
+    client = admin_client()
+    for search, ticket_id in (('hdmi', 7), ('FLICKER', 3), ('Ticket 12', 13)):  # Titles count from 0
+        page = client.get(f'/tickets/api/page?status=all&search={search}').get_json()
+        assert [ticket['id'] for ticket in page['tickets']] == [ticket_id], search
+        assert page['total'] == 1
+
+    with app.app_context():
+        # Any SQL expression can rank; ties (three tickets per rank) are broken by id
+        rank = db.cast(Ticket.id % 10, db.REAL)
+        query = filtered_tickets(TicketFilters(status='all'))
+        tickets, cursor = ticket_page(query, limit=4, rank=rank)
+        seen = [ticket.id for ticket in tickets]
+        while cursor:
+            tickets, cursor = ticket_page(query, cursor, limit=4, rank=rank)
+            seen += [ticket.id for ticket in tickets]
+        assert seen == sorted(range(1, 31), key=lambda ticket_id: (ticket_id % 10, ticket_id), reverse=True)
+
+
+def test_ticket_facets_are_one_grouped_query():
+    """Each facet is counted under every filter but its own, all in one statement"""
+    with app.app_context():
+        seed_week(1)
+        seed_tickets(40)
+        Ticket.query.filter(Ticket.id % 2 == 0).update({'priority': 2})
+        Ticket.query.filter(Ticket.id % 3 == 0).update({'status': 'closed'})
+        Ticket.query.filter(Ticket.id % 5 == 0).update({'assigned_to': None})
+        db.session.commit()
+        tickets = Ticket.query.all()
+    client = admin_client()
+    with app.app_context(), count_queries() as statements:
+        facets = client.get('/tickets/api/facets?status=open&priority=2').get_json()['facets']
+    assert len(statements) <= 2, statements  # The user and the facets
+
+    def expected(matches, key):
+        counts = {}
+        for ticket in filter(matches, tickets):
+            counts[key(ticket)] = counts.get(key(ticket), 0) + 1
+        return counts
+
+    assert facets['status'] == expected(lambda t: t.priority == 2, lambda t: t.status)
+    assert facets['priority'] == expected(lambda t: t.status == 'open', lambda t: str(t.priority))
+    both = lambda t: t.status == 'open' and t.priority == 2
+    assert facets['category'] == expected(both, lambda t: str(t.category_id))
+    assert facets['technician'] == expected(both, lambda t: str(t.assigned_to) if t.assigned_to else 'none')
+    assert 'none' in facets['technician']
+
+
+def ticket_view_query_count(ticket_id, **headers):
+    client = admin_client()
+    with app.app_context(), count_queries() as statements:
+        response = client.get(f'/tickets/{ticket_id}', headers=headers)
+    assert response.status_code == 200
+    return len(statements), response.data.decode()
+
+
+def seed_long_timeline():
+    """Ticket 2 gets 200 history entries, two minutes apart, and 20 comments, one every 20 minutes"""
+    seed_week(1)
+    seed_tickets(2)
+    start = datetime(2025, 3, 1, tzinfo=pytz.UTC)
+    TicketComment.query.filter_by(ticket_id=2).delete()
+    TicketHistory.query.filter_by(ticket_id=2).delete()
+    for i in range(200):
+        db.session.add(TicketHistory(ticket_id=2, user_id=1 + i % 3, action='status_changed',
+                                     details=f'Change {i}', created_at=start + timedelta(minutes=2 * i)))
+    for i in range(20):
+        db.session.add(TicketComment(ticket_id=2, user_id=1 + i % 3, content=f'Note {i}',
+                                     created_at=start + timedelta(minutes=20 * i + 1)))
+    db.session.commit()
+
+
+def test_ticket_view_loads_a_merged_timeline_in_fixed_queries():
+    """Opening a ticket costs the same however long its timeline; comments and history interleave by time"""
+    with app.app_context():
+        seed_long_timeline()
+    mobile = {'User-Agent': 'Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) Mobile'}
+    for headers in ({}, mobile):
+        short, _ = ticket_view_query_count(1, **headers)
+        long, html = ticket_view_query_count(2, **headers)
+        assert short == long, (short, long)
+        assert long <= 9, long  # Ticket, comments and history, plus the page's own lists
+        # Note 18 (minute 361) comes between Change 180 (minute 360) and Change 181 (minute 362)
+        note = re.search(r'Note 18\s*<', html).start()
+        assert html.index('Change 180<') < note < html.index('Change 181<')
+        # Only the latest entries: Changes 172 to 199 and Notes 18 and 19
+        assert len(re.findall(r'Change \d+<', html)) + len(re.findall(r'Note \d+', html)) == TIMELINE_PAGE_SIZE
+        assert 'Change 171<' not in html and 'Load older' in html
+
+
+def test_ticket_timeline_loads_older_entries_by_keyset():
+    """The timeline endpoint walks back through every entry once, ties between kinds broken by kind then id"""
+    with app.app_context():
+        seed_long_timeline()
+        # Comments at the same moment as history entries, and as each other
+        for comment in TicketComment.query.filter(TicketComment.content.in_(['Note 5', 'Note 6'])):
+            comment.created_at = datetime(2025, 3, 1, 4, tzinfo=pytz.UTC)  # Change 120's moment
+        db.session.commit()
+        expected = ticket_timeline(2, limit=1000)[0]
+    client = admin_client()
+    html = client.get('/tickets/2').data.decode()
+    cursor = re.search(r'data-cursor="([^"]+)"', html[html.index('load-older-entries'):]).group(1)
+    seen = []
+    while cursor:
+        with app.app_context(), count_queries() as statements:
+            page = client.get(f'/tickets/2/timeline?before={cursor}&layout=mobile').get_json()
+        assert len(statements) <= 4, statements  # The user, the ticket, comments and history
+        assert len(page['entries']) == TIMELINE_PAGE_SIZE or not page['older_cursor']
+        assert page['html'].count('class="comment ') + page['html'].count('class="history-entry ') == \
+            len(page['entries'])
+        seen = [(entry['kind'], entry['id']) for entry in page['entries']] + seen
+        cursor = page['older_cursor']
+    assert len(seen) == len(set(seen)) == 220 - TIMELINE_PAGE_SIZE
+    assert seen == [(entry.kind, entry.id) for entry in expected[:len(seen)]]
+    labels = [entry.details or entry.content for entry in expected]
+    at = labels.index('Change 120')
+    assert labels[at:at + 3] == ['Change 120', 'Note 5', 'Note 6']
+    assert client.get('/tickets/2/timeline?before=bogus').status_code == 400
+    assert client.get('/tickets/999/timeline').status_code == 404
+
+if __name__ == '__main__':
+    test_week_loader_is_single_query()
+    test_overnight_shift_shows_in_the_week_it_starts()
+    test_overlong_shifts_are_rejected()
+    test_calendar_query_count_independent_of_shifts()
+    test_active_users_snapshot_is_cached()
+    test_upcoming_time_off_is_one_cached_query()
+    test_repeat_days_are_checked_and_inserted_in_bulk()
+    test_schedule_rules_expand_lazily_and_cache()
+    test_recurring_schedule_changes_need_a_csrf_post()
+    test_copy_previous_week_is_set_based()
+    print("SUCCESS: query count checks passed")
+    test_export_is_one_query_per_period()
+    test_flat_exports_stream_from_the_same_query()
+    test_backup_download_is_batched()
+    test_restore_is_set_based()
+    test_heavy_operations_run_as_background_jobs()
+    test_deleting_a_user_keeps_their_jobs()
+    test_jobs_from_before_a_restart_are_failed()
+    test_incremental_backups_restore_as_a_chain()
+    test_incremental_backups_carry_schedule_rule_changes()
+    test_columnar_backup_is_smaller_and_restores()
+    test_schedule_rules_round_trip_through_backups()
+    test_ticket_dashboard_query_budget()
+    test_ticket_dashboard_pages_by_keyset()
+    test_ticket_search_covers_comments_and_pages_by_rank()
+    test_ticket_facets_are_one_grouped_query()
+    test_ticket_view_loads_a_merged_timeline_in_fixed_queries()
+    test_ticket_timeline_loads_older_entries_by_keyset()
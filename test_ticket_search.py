@@ -0,0 +1,125 @@
+"""
+Ticket search checks: the ranked-result cursor, and the full-text path.
+The cursor checks run anywhere. The full-text checks need PostgreSQL (tsvector,
+triggers, ts_rank) and are skipped unless TEST_POSTGRES_URL names a scratch
+database, whose tables they drop and recreate.
+"""
+import os
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import pytest
+from flask import Flask
+from sqlalchemy import REAL
+from sqlalchemy.dialects import postgresql
+
+from app import app, db
+from models import User, Ticket, TicketCategory, TicketComment
+from ticket_utils import (SEARCH_CONFIG, TicketFilters, after_rank_cursor, decode_rank_cursor, encode_rank_cursor,
+                          filtered_tickets, search_rank, ticket_page)
+
+POSTGRES_URL = os.environ.get('TEST_POSTGRES_URL')
+requires_postgres = pytest.mark.skipif(not POSTGRES_URL, reason='TEST_POSTGRES_URL is not set')
+
+
+def test_rank_cursor_round_trips():
+    """A ranked page's cursor gives back exactly the last ticket's rank and id"""
+    ticket = Ticket(id=12)
+    for rank in (0.0607927, 0.1, 1 / 3, 1e-20, 0.0):
+        assert decode_rank_cursor(encode_rank_cursor(rank, ticket)) == (rank, 12)
+
+    for cursor in ('', '12', '0.5', 'abc:12', '0.5:x', '0.5:1:2', '1700000000-12'):
+        with pytest.raises(ValueError):
+            decode_rank_cursor(cursor)
+
+
+def test_rank_cursor_keyset_condition():
+    """After a cursor means a lower rank, or the same rank and a lower id, with the rank compared as REAL"""
+    with app.app_context():
+        rank = db.func.ts_rank(Ticket.search_vector, db.func.websearch_to_tsquery(SEARCH_CONFIG, 'hdmi'), type_=REAL)
+        compiled = after_rank_cursor(rank, '0.0607927:12').compile(dialect=postgresql.dialect())
+    assert compiled.string == ('(ts_rank(ticket.search_vector, websearch_to_tsquery('
+                               '%(websearch_to_tsquery_1)s::REGCONFIG, %(websearch_to_tsquery_2)s::VARCHAR)), ticket.id)'
+                               ' < (CAST(%(param_1)s AS REAL), %(param_2)s::INTEGER)')
+    assert (compiled.params['param_1'], compiled.params['param_2']) == (0.0607927, 12)
+
+
+def postgres_app():
+    """An app on the scratch PostgreSQL database, with empty tables and the search triggers installed"""
+    postgres = Flask(__name__)
+    postgres.config['SQLALCHEMY_DATABASE_URI'] = POSTGRES_URL
+    db.init_app(postgres)
+    with postgres.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(username='admin', email='admin@example.com', is_admin=True)
+        user.set_password('password')
+        db.session.add_all([user, TicketCategory(name='Hardware')])
+        db.session.commit()
+    return postgres
+
+
+def add_ticket(title, description=''):
+    ticket = Ticket(title=title, description=description, category_id=1, created_by=1)
+    db.session.add(ticket)
+    db.session.commit()
+    return ticket.id
+
+
+def search(text):
+    return sorted(ticket.id for ticket in filtered_tickets(TicketFilters(search=text)))
+
+
+@requires_postgres
+def test_postgres_search_vector_follows_tickets_and_comments():
+    """The triggers keep each ticket's search vector current as its text and comments change"""
+    with postgres_app().app_context():
+        ticket_id = add_ticket('Projector flickers', 'In studio B')
+        assert search('flickering projector') == [ticket_id]  # Stemmed, every word must match
+        assert search('studio') == [ticket_id]
+
+        comment = TicketComment(ticket_id=ticket_id, user_id=1, content='Replaced the HDMI cable')
+        db.session.add(comment)
+        db.session.commit()
+        assert search('hdmi') == [ticket_id]
+
+        comment.content = 'Swapped the power supply'
+        db.session.commit()
+        assert search('hdmi') == [] and search('power supply') == [ticket_id]
+
+        db.session.delete(comment)
+        db.session.get(Ticket, ticket_id).title = 'Monitor flickers'
+        db.session.commit()
+        assert search('power') == [] and search('projector') == []
+        assert search('monitor') == [ticket_id]
+
+
+@requires_postgres
+def test_postgres_search_ranks_and_pages_by_rank_cursor():
+    """Title matches outrank description matches, which outrank comments; pages follow the (rank, id) cursor"""
+    with postgres_app().app_context():
+        in_comment = [add_ticket(f'Ticket {i}') for i in range(3)]
+        for ticket_id in in_comment:
+            db.session.add(TicketComment(ticket_id=ticket_id, user_id=1, content='Check the router'))
+        db.session.commit()
+        in_description = [add_ticket(f'Ticket {i}', 'The router is down') for i in range(3, 6)]
+        in_title = [add_ticket('Router down') for _ in range(3)]
+        add_ticket('Unrelated')
+
+        filters = TicketFilters(search='router')
+        query, rank = filtered_tickets(filters), search_rank(filters)
+        tickets, cursor = ticket_page(query, limit=2, rank=rank)
+        seen = [ticket.id for ticket in tickets]
+        while cursor:
+            tickets, cursor = ticket_page(query, cursor, limit=2, rank=rank)
+            seen += [ticket.id for ticket in tickets]
+        # Equal ranks are ordered by id, newest first
+        assert seen == in_title[::-1] + in_description[::-1] + in_comment[::-1]
+
+
+if __name__ == '__main__':
+    test_rank_cursor_round_trips()
+    test_rank_cursor_keyset_condition()
+    if POSTGRES_URL:
+        test_postgres_search_vector_follows_tickets_and_comments()
+        test_postgres_search_ranks_and_pages_by_rank_cursor()
+    print("SUCCESS: ticket search checks passed")
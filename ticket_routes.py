@@ -7,10 +7,16 @@ import pytz
 from sqlalchemy import text, or_
 from app import app, is_mobile_device  # Import app for logging and mobile detection
 from email_utils import send_ticket_assigned_notification, send_ticket_comment_notification, send_ticket_status_notification
+from jobs import job_error, job_handler, job_response, start_job
+from ticket_utils import (TicketFilters, count_tickets, facet_counts, filter_id, filtered_tickets, load_ticket,
+                          search_rank, ticket_json, ticket_page, ticket_row, ticket_timeline, timeline_json)
 
 # Update Blueprint to use the correct template directory
 tickets = Blueprint('tickets', __name__)
 
+# Tickets archived per UPDATE (and history INSERT) in a batch archive
+ARCHIVE_CHUNK_SIZE = 500
+
 # Create function that will be registered with the main app context
 def get_active_sidebar_tickets():
     """
@@ -37,68 +43,22 @@ def get_active_sidebar_tickets():
 @login_required
 def standalone_dashboard():
     """A clean standalone version of the dashboard for testing filtering"""
-    app.logger.debug(f"STANDALONE DASHBOARD - Raw request URL: {request.url}")
     app.logger.debug(f"STANDALONE DASHBOARD - Raw query args: {request.args}")
     
-    # Get filter params from the request
-    status_filter = request.args.get('status', 'all')
-    priority_filter = request.args.get('priority', 'all')
-    category_filter = request.args.get('category', 'all')
-    
-    app.logger.debug(f"STANDALONE DASHBOARD - Filters: status={status_filter}, priority={priority_filter}, category={category_filter}")
-    
-    # Start with all tickets
-    query = Ticket.query
-    
-    # Apply filters based on request parameters
-    if status_filter != 'all':
-        query = query.filter(Ticket.status == status_filter)
-    
-    if priority_filter != 'all':
-        try:
-            priority_value = int(priority_filter)
-            query = query.filter(Ticket.priority == priority_value)
-        except (ValueError, TypeError):
-            app.logger.error(f"Invalid priority value: {priority_filter}")
-    
-    if category_filter != 'all':
-        try:
-            category_id = int(category_filter)
-            query = query.filter(Ticket.category_id == category_id)
-        except (ValueError, TypeError):
-            app.logger.error(f"Invalid category value: {category_filter}")
-            
-    # Get tickets based on filters
-    tickets = query.order_by(Ticket.created_at.desc()).all()
-    app.logger.debug(f"STANDALONE DASHBOARD - Found {len(tickets)} tickets")
-    
-    # Convert to dictionaries for the template
-    ticket_dicts = []
-    for ticket in tickets:
-        t = {
-            'id': ticket.id,
-            'title': ticket.title,
-            'status': ticket.status,
-            'priority': ticket.priority,
-            'assigned_to': ticket.assigned_to,
-            'created_by': ticket.created_by,
-            'created_at': ticket.created_at,
-            'updated_at': ticket.updated_at,
-            'category': {
-                'id': ticket.category.id,
-                'name': ticket.category.name
-            }
-        }
-        
-        # Add assigned technician info if available
-        if ticket.assigned_technician:
-            t['assigned_technician'] = {
-                'username': ticket.assigned_technician.username
-            }
-        else:
-            t['assigned_technician'] = None
-            
-        ticket_dicts.append(t)
+    # Get filter params from the request; archived tickets are included
+    filters = TicketFilters(status=request.args.get('status', 'all'),
+                            priority=request.args.get('priority', 'all'),
+                            category=request.args.get('category', 'all'),
+                            archived=True)
+    query = filtered_tickets(filters)
+
+    try:
+        tickets, next_cursor = ticket_page(query, request.args.get('cursor'))
+    except ValueError:
+        flash('Invalid page requested.')
+        return redirect(url_for('tickets.standalone_dashboard', status=filters.status,
+                                priority=filters.priority, category=filters.category))
+    ticket_dicts = [ticket_row(ticket) for ticket in tickets]
     
     # Get data for dropdowns
     categories = [
@@ -119,9 +79,9 @@ def standalone_dashboard():
     
     # Create filter_info for the template
     filter_info = {
-        'status': status_filter,
-        'priority': priority_filter,
-        'category': category_filter,
+        'status': filters.status,
+        'priority': filters.priority,
+        'category': filters.category,
         'timestamp': int(datetime.now().timestamp() * 1000)
     }
     
@@ -138,81 +98,17 @@ def standalone_dashboard():
                            tickets=ticket_dicts,
                            categories=categories,
                            ticket_statuses=ticket_statuses,
-                           ticket_count=len(ticket_dicts),
+                           ticket_count=count_tickets(query),
+                           next_cursor=next_cursor,
                            filter_info=filter_info,
                            timestamp=filter_info['timestamp'])
 
-@tickets.route('/tickets/dashboard')
-@login_required
-def tickets_dashboard():
-    """Display all tickets with filtering options"""
-    # Import the TicketStatus class from models (even though it's imported at the top)
-    from models import TicketStatus, Ticket
-    
-    app.logger.debug(f"Raw request URL: {request.url}")
-    app.logger.debug(f"Raw query args: {request.args}")
-    
-    # Get filters from request args with appropriate defaults
-    # Check if no URL parameters or only cache-busting parameters
-    cache_params = ['timestamp', 'rand']
-    has_only_cache_params = all(k in cache_params for k in request.args.keys()) if request.args else True
-    
-    # Extract raw filter values from the request (for debugging)
-    raw_status_filter = request.args.get('status')
-    raw_category_filter = request.args.get('category')
-    raw_priority_filter = request.args.get('priority')
-    raw_technician_filter = request.args.get('technician')
-    raw_assigned_to = request.args.get('assigned_to')
-    raw_created_by = request.args.get('created_by')
-    raw_search_query = request.args.get('search')
-    
-    app.logger.debug(f"Raw filter values from request - status: {raw_status_filter}, category: {raw_category_filter}, priority: {raw_priority_filter}, technician: {raw_technician_filter}, assigned_to: {raw_assigned_to}, created_by: {raw_created_by}, search: {raw_search_query}")
-    
-    # Determine final filter values
-    if not request.args or has_only_cache_params:
-        app.logger.debug("No filters specified or only cache parameters, defaulting to open tickets")
-        status_filter = 'open'
-        category_filter = 'all'
-        priority_filter = 'all'
-        technician_filter = 'all'
-        assigned_to_filter = 'all'
-        created_by_filter = 'all'
-        search_query = ''
-    else:
-        # Use 'all' as default if not provided
-        status_filter = raw_status_filter if raw_status_filter not in (None, '') else 'all'
-        category_filter = raw_category_filter if raw_category_filter not in (None, '') else 'all'
-        priority_filter = raw_priority_filter if raw_priority_filter not in (None, '') else 'all'
-        technician_filter = raw_technician_filter if raw_technician_filter not in (None, '') else 'all'
-        assigned_to_filter = raw_assigned_to if raw_assigned_to not in (None, '') else 'all'
-        created_by_filter = raw_created_by if raw_created_by not in (None, '') else 'all'
-        search_query = raw_search_query if raw_search_query not in (None, '') else ''
-        
-        # Log explicit parameter requests for debugging
-        app.logger.debug(f"Explicit filter request - status:{status_filter}, category:{category_filter}, priority:{priority_filter}, technician:{technician_filter}")
-        
-        # Force-convert these to appropriate types for comparison
-        status_filter = status_filter.strip().lower()
-        app.logger.debug(f"Status filter from request (normalized): {status_filter}")
-        app.logger.debug(f"Category filter from request: {category_filter}")
-        app.logger.debug(f"Priority filter from request: {priority_filter}")
-        app.logger.debug(f"Technician filter from request: {technician_filter}")
-    
-    # Verify that status filter is valid
-    valid_statuses = vars(TicketStatus).values()
-    if status_filter != 'all' and status_filter not in valid_statuses:
-        app.logger.warning(f"Invalid status filter '{status_filter}', defaulting to 'open'")
-        status_filter = 'open'
-    
-    # If status is explicitly set to 'all', make sure it's respected
-    if status_filter == 'all':
-        app.logger.debug("Status filter is 'all', showing all tickets")
-    
-    # Add debug logging to see what filters are being applied
-    app.logger.debug(f"Ticket dashboard filters - status: {status_filter}, category: {category_filter}, priority: {priority_filter}, technician: {technician_filter}")
-
-    # Add some diagnostic queries to check database status values
-    # Count status distribution in database
+def _log_dashboard_profile(query, tickets):
+    """
+    Debug output for the ticket dashboard, only produced with TICKET_DASHBOARD_PROFILING
+    set: it compiles the SQL and scans the whole ticket table
+    """
+    app.logger.info(f"Ticket dashboard query: {str(query.statement.compile(compile_kwargs={'literal_binds': True}))}")
     status_counts = db.session.execute(
         text("""
         SELECT status, COUNT(*) as count
@@ -221,102 +117,30 @@ def tickets_dashboard():
         ORDER BY status
         """)
     ).fetchall()
-    app.logger.debug("Status counts in database:")
+    app.logger.info("Status counts in database:")
     for status, count in status_counts:
-        app.logger.debug(f"  {status}: {count} tickets")
+        app.logger.info(f"  {status}: {count} tickets")
+    for ticket in tickets:
+        app.logger.info(f"Found ticket #{ticket.id}: {ticket.title} - Status: {ticket.status}, Category: {ticket.category_id}, Priority: {ticket.priority}")
+    for ticket in Ticket.query.all():
+        app.logger.info(f"DB Ticket #{ticket.id}: {ticket.title} - Status: '{ticket.status}' - Priority: {ticket.priority}")
 
-    # Get archived filter from the request
-    show_archived = request.args.get('archived', 'false').lower() == 'true'
-    
-    # Base query
-    query = Ticket.query
-    
-    # Apply filters
-    app.logger.debug(f"Before filtering, query: {str(query.statement.compile(compile_kwargs={'literal_binds': True}))}")
-    
-    # By default, don't show archived tickets unless explicitly requested
-    if not show_archived:
-        query = query.filter(Ticket.archived == False)
-        app.logger.debug(f"Filtered to non-archived tickets only")
-    
-    # For explicit status checking, keep track of raw query string
-    raw_status_filter = status_filter
-    
-    if status_filter != 'all':
-        query = query.filter(Ticket.status == status_filter)
-        app.logger.debug(f"After status filter ({status_filter}): {str(query.statement.compile(compile_kwargs={'literal_binds': True}))}")
-    if category_filter != 'all':
-        try:
-            category_id = int(category_filter)
-            query = query.filter(Ticket.category_id == category_id)
-            app.logger.debug(f"After category filter ({category_filter}): {str(query.statement.compile(compile_kwargs={'literal_binds': True}))}")
-        except (ValueError, TypeError):
-            app.logger.error(f"Invalid category filter value: {category_filter}")
+@tickets.route('/tickets/dashboard')
+@login_required
+def tickets_dashboard():
+    """Display the first page of tickets with filtering options; later pages come from ticket_page_api"""
+    filters = TicketFilters.from_args(request.args)
+    app.logger.debug(f"Ticket dashboard filters: {filters}")
 
-    if priority_filter != 'all':
-        try:
-            priority_value = int(priority_filter)
-            query = query.filter(Ticket.priority == priority_value)
-            app.logger.debug(f"After priority filter ({priority_filter}): {str(query.statement.compile(compile_kwargs={'literal_binds': True}))}")
-        except (ValueError, TypeError):
-            app.logger.error(f"Invalid priority filter value: {priority_filter}")
-            
-    if technician_filter != 'all':
-        try:
-            technician_id = int(technician_filter)
-            query = query.filter(Ticket.assigned_to == technician_id)
-            app.logger.debug(f"After technician filter ({technician_filter}): {str(query.statement.compile(compile_kwargs={'literal_binds': True}))}")
-        except (ValueError, TypeError):
-            app.logger.error(f"Invalid technician filter value: {technician_filter}")
-            
-    # Handle assigned_to filter separately from technician_filter
-    if assigned_to_filter != 'all':
-        try:
-            assigned_id = int(assigned_to_filter)
-            query = query.filter(Ticket.assigned_to == assigned_id)
-            app.logger.debug(f"After assigned_to filter ({assigned_to_filter}): {str(query.statement.compile(compile_kwargs={'literal_binds': True}))}")
-        except (ValueError, TypeError):
-            app.logger.error(f"Invalid assigned_to filter value: {assigned_to_filter}")
-            
-    # Handle created_by filter
-    if created_by_filter != 'all':
-        try:
-            creator_id = int(created_by_filter)
-            query = query.filter(Ticket.created_by == creator_id)
-            app.logger.debug(f"After created_by filter ({created_by_filter}): {str(query.statement.compile(compile_kwargs={'literal_binds': True}))}")
-        except (ValueError, TypeError):
-            app.logger.error(f"Invalid created_by filter value: {created_by_filter}")
-            
-    # Handle search query for keywords in title and description
-    if search_query:
-        app.logger.debug(f"Applying search query: {search_query}")
-        search_term = f"%{search_query}%"
-        query = query.filter(
-            db.or_(
-                Ticket.title.ilike(search_term),
-                Ticket.description.ilike(search_term)
-            )
-        )
-        app.logger.debug(f"After search query filter: {str(query.statement.compile(compile_kwargs={'literal_binds': True}))}")
+    query = filtered_tickets(filters)
+    # Searches come back most relevant first
+    tickets, next_cursor = ticket_page(query, rank=search_rank(filters))
+    # Counted in the database rather than by loading every match
+    ticket_count = count_tickets(query)
+    app.logger.debug(f"Found {ticket_count} tickets matching filters, showing {len(tickets)}")
 
-    # Show all tickets for all users, ordered by creation date (newest first)
-    tickets = query.order_by(Ticket.created_at.desc()).all()
-    
-    # Add special debug logs for status filter
-    app.logger.debug(f"Status filter applied: '{raw_status_filter}'")
-    app.logger.debug(f"Found {len(tickets)} tickets matching filters: status={status_filter}, category={category_filter}, priority={priority_filter}, technician={technician_filter}")
-    
-    # Add debug information about each ticket found
-    for ticket in tickets:
-        app.logger.debug(f"Ticket #{ticket.id}: {ticket.title} - Status: {ticket.status}, Category: {ticket.category_id}, Priority: {ticket.priority}")
-        
-    # FORCE FILTER - Apply filter directly to the data
-    # No need for the force filtering here as the SQL query should handle it correctly
-    # We'll keep a debug log of found tickets
-    app.logger.debug(f"Found tickets after SQL filtering: {len(tickets)}")
-    
-    for ticket in tickets:
-        app.logger.debug(f"Found ticket: ID={ticket.id}, Title={ticket.title}, Status={ticket.status}, Priority={ticket.priority}")
+    if app.config.get('TICKET_DASHBOARD_PROFILING'):
+        _log_dashboard_profile(query, tickets)
     
     # Disable caching for this request to make sure we're getting fresh data
     @after_this_request
@@ -325,17 +149,6 @@ def tickets_dashboard():
         response.headers['Pragma'] = 'no-cache'
         response.headers['Expires'] = '0'
         return response
-        
-    # Add a temporary filter to show exactly what's going to the template
-    app.logger.debug(f"FINAL TICKETS TO TEMPLATE:")
-    for ticket in tickets:
-        app.logger.debug(f"FINAL Ticket #{ticket.id}: {ticket.title} - Status: {ticket.status} - Priority: {ticket.priority}")
-        
-    # Double-check all tickets have data in correct format (debug step)
-    app.logger.debug(f"Double-checking all tickets in the database:")
-    all_tickets = Ticket.query.all()
-    for ticket in all_tickets:
-        app.logger.debug(f"DB Ticket #{ticket.id}: {ticket.title} - Status: '{ticket.status}' - Priority: {ticket.priority}")
     
     # Get categories and convert to dictionaries
     categories_objects = TicketCategory.query.all()
@@ -356,52 +169,19 @@ def tickets_dashboard():
         TicketStatus.CLOSED
     ]
 
-    # For robust filtering, convert SQLAlchemy objects to simple dictionaries
-    # This will eliminate any potential SQLAlchemy caching issues
-    filtered_tickets = []
-    for ticket in tickets:
-        # Create a simple dict with only the data we need
-        ticket_dict = {
-            'id': ticket.id,
-            'title': ticket.title,
-            'status': ticket.status,
-            'priority': ticket.priority,
-            'assigned_to': ticket.assigned_to,
-            'created_by': ticket.created_by,
-            'created_at': ticket.created_at,
-            'updated_at': ticket.updated_at,
-            'due_date': ticket.due_date,
-            'category': {
-                'id': ticket.category.id,
-                'name': ticket.category.name
-            }
-        }
-        
-        # Add assigned technician info if available
-        if ticket.assigned_technician:
-            ticket_dict['assigned_technician'] = {
-                'username': ticket.assigned_technician.username
-            }
-        else:
-            ticket_dict['assigned_technician'] = None
-            
-        filtered_tickets.append(ticket_dict)
-    
-    # Final logging to verify what's being sent
-    app.logger.debug(f"RENDERING TEMPLATE WITH {len(filtered_tickets)} TICKETS:")
-    for idx, ticket in enumerate(filtered_tickets):
-        app.logger.debug(f"RENDER TICKET #{idx+1}: ID={ticket['id']}, Title={ticket['title']}, Status={ticket['status']}, Priority={ticket['priority']}")
+    # Plain dictionaries, the same rows ticket_page_api renders for later pages
+    filtered_tickets_page = [ticket_row(ticket) for ticket in tickets]
     
     # Add timestamp to prevent any caching
     timestamp = int(datetime.now().timestamp() * 1000)
     
     # Pass very explicit filtering info to the template
     filter_info = {
-        'status': status_filter,
-        'category': category_filter,
-        'priority': priority_filter,
-        'technician': technician_filter,
-        'search': search_query,
+        'status': filters.status,
+        'category': filters.category,
+        'priority': filters.priority,
+        'technician': filters.technician,
+        'search': filters.search,
         'timestamp': timestamp
     }
     
@@ -417,46 +197,72 @@ def tickets_dashboard():
     technicians = User.query.all()
     
     # Check if user is on a mobile device
-    from app import is_mobile_device
     if is_mobile_device():
-        # Convert string filters to integers for the template
-        assigned_to_int = None
-        if assigned_to_filter != 'all':
-            try:
-                assigned_to_int = int(assigned_to_filter)
-            except (ValueError, TypeError):
-                pass
-                
-        created_by_int = None
-        if created_by_filter != 'all':
-            try:
-                created_by_int = int(created_by_filter)
-            except (ValueError, TypeError):
-                pass
-        
         return render_template('tickets/mobile_dashboard.html', 
-                             tickets=filtered_tickets,
+                             tickets=filtered_tickets_page,
                              categories=categories,
                              ticket_statuses=ticket_statuses,
                              technicians=technicians,
-                             ticket_count=len(filtered_tickets),
+                             ticket_count=ticket_count,
+                             next_cursor=next_cursor,
                              filter_info=filter_info,
                              timestamp=timestamp,
                              active_sidebar_tickets=active_sidebar_tickets,
-                             filter_status=status_filter,
-                             filter_assigned_to=assigned_to_int,
-                             filter_created_by=created_by_int)
+                             filter_status=filters.status,
+                             filter_assigned_to=filter_id('assigned_to', filters.assigned_to),
+                             filter_created_by=filter_id('created_by', filters.created_by))
     else:
         return render_template('tickets/dashboard.html', 
-                             tickets=filtered_tickets,
+                             tickets=filtered_tickets_page,
                              categories=categories,
                              ticket_statuses=ticket_statuses,
                              technicians=technicians,
-                             ticket_count=len(filtered_tickets),
+                             ticket_count=ticket_count,
+                             next_cursor=next_cursor,
                              filter_info=filter_info,
                              timestamp=timestamp,
                              active_sidebar_tickets=active_sidebar_tickets)
 
+@tickets.route('/tickets/api/page')
+@login_required
+def ticket_page_api():
+    """
+    A page of dashboard tickets as JSON, for "load more": takes the dashboard's
+    filter arguments plus the cursor from the previous page, and returns the
+    tickets, their rendered rows (layout=mobile for cards) and the next cursor.
+    The first page (no cursor) also carries the total count.
+    """
+    filters = TicketFilters.from_args(request.args)
+    query = filtered_tickets(filters)
+    cursor = request.args.get('cursor')
+    try:
+        tickets, next_cursor = ticket_page(query, cursor, rank=search_rank(filters))
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+
+    rows = [ticket_row(ticket) for ticket in tickets]
+    template = ('tickets/_mobile_ticket_cards.html' if request.args.get('layout') == 'mobile'
+                else 'tickets/_dashboard_rows.html')
+    data = {
+        'tickets': [ticket_json(row) for row in rows],
+        'html': render_template(template, tickets=rows),
+        'next_cursor': next_cursor
+    }
+    if not cursor:
+        data['total'] = count_tickets(query)
+    return jsonify(data)
+
+@tickets.route('/tickets/api/facets')
+@login_required
+def ticket_facets_api():
+    """
+    Counts for the dashboard's filter bar: takes the dashboard's filter
+    arguments and returns, for each of status, category, priority and
+    technician, the number of tickets each value would show
+    """
+    filters = TicketFilters.from_args(request.args)
+    return jsonify({'facets': facet_counts(filters)})
+
 @tickets.route('/tickets/create', methods=['GET', 'POST'])
 @login_required
 def create_ticket():
@@ -598,7 +404,8 @@ def create_ticket():
 @login_required
 def view_ticket(ticket_id):
     """View a specific ticket"""
-    ticket_obj = Ticket.query.get_or_404(ticket_id)
+    # A fixed handful of queries however long the ticket's timeline
+    ticket_obj = load_ticket(ticket_id)
 
     # All users can view all tickets
 
@@ -636,27 +443,9 @@ def view_ticket(ticket_id):
             'id': ticket_obj.category.id,
             'name': ticket_obj.category.name
         },
-        'comments': [{
-            'id': comment.id,
-            'content': comment.content,
-            'created_at': comment.created_at,
-            'user': {
-                'id': comment.user.id,
-                'username': comment.user.username,
-                'color': comment.user.color
-            }
-        } for comment in ticket_obj.comments],
-        'history': [{
-            'id': history.id,
-            'action': history.action,
-            'details': history.details,
-            'created_at': history.created_at,
-            'user': {
-                'id': history.user.id,
-                'username': history.user.username
-            }
-        } for history in ticket_obj.history]
     }
+    # The latest comments and history entries, merged oldest first; older ones load on demand
+    ticket['timeline'], ticket['older_timeline_cursor'] = ticket_timeline(ticket_obj.id)
     
     # Add creator and assigned technician info
     ticket['creator'] = {
@@ -721,6 +510,29 @@ def view_ticket(ticket_id):
                              active_sidebar_tickets=active_sidebar_tickets,
                              TicketStatus=TicketStatus)
 
+@tickets.route('/tickets/<int:ticket_id>/timeline')
+@login_required
+def ticket_timeline_api(ticket_id):
+    """
+    Older timeline entries of a ticket as JSON, for "load older": takes the
+    cursor from the page or the previous fetch, and returns the entries (oldest
+    first), their rendered HTML (layout=mobile for cards) and the next cursor
+    """
+    if not db.session.query(Ticket.query.filter(Ticket.id == ticket_id).exists()).scalar():
+        return jsonify({'error': 'Ticket not found'}), 404
+    try:
+        entries, older_cursor = ticket_timeline(ticket_id, request.args.get('before'))
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+
+    template = ('tickets/_mobile_timeline_entries.html' if request.args.get('layout') == 'mobile'
+                else 'tickets/_timeline_entries.html')
+    return jsonify({
+        'entries': [timeline_json(entry) for entry in entries],
+        'html': render_template(template, timeline=entries),
+        'older_cursor': older_cursor
+    })
+
 @tickets.route('/tickets/<int:ticket_id>/comment', methods=['POST'])
 @login_required
 def add_comment(ticket_id):
@@ -1594,55 +1406,51 @@ def batch_archive_tickets():
     status = request.form.get('status', 'all')
     date_before_str = request.form.get('date_before')
     
-    # Build the query
-    query = Ticket.query.filter(Ticket.archived == False)  # Only consider non-archived tickets
-    
-    # Apply status filter
-    if status != 'all':
-        query = query.filter(Ticket.status == status)
+    try:
+        query = _tickets_to_archive(status, date_before_str)
+    except ValueError:
+        return job_error('Invalid date format', url_for('tickets.tickets_dashboard'))
     
-    # Apply date filter if provided
-    if date_before_str:
-        try:
-            # Parse the date string into a datetime object
-            date_before = datetime.strptime(date_before_str, '%Y-%m-%d')
-            # Set to the end of the day
-            date_before = date_before.replace(hour=23, minute=59, second=59, tzinfo=pytz.UTC)
-            # Filter tickets updated before this date
-            query = query.filter(Ticket.updated_at < date_before)
-        except ValueError:
-            flash('Invalid date format', 'error')
-            return redirect(url_for('tickets.tickets_dashboard'))
-    
-    # Execute the query to get the tickets to archive
-    tickets_to_archive = query.all()
-    count = len(tickets_to_archive)
+    # Only count here; the archiving itself runs as a background job
+    count = query.count()
     
     if count == 0:
-        flash('No tickets matched the criteria for archiving', 'info')
-        return redirect(url_for('tickets.tickets_dashboard'))
+        return job_error('No tickets matched the criteria for archiving', url_for('tickets.tickets_dashboard'))
     
-    try:
-        # Archive each ticket and create history entries
-        for ticket in tickets_to_archive:
-            ticket.archived = True
-            
-            # Add a history entry
-            history = TicketHistory(
-                ticket_id=ticket.id,
-                user_id=current_user.id,
-                action="archived",
-                details="Ticket was archived in batch operation",
-                created_at=datetime.now(pytz.UTC)
-            )
-            db.session.add(history)
-        
-        # Commit all changes at once
-        db.session.commit()
-        flash(f'Successfully archived {count} tickets', 'success')
-    except Exception as e:
-        db.session.rollback()
-        app.logger.error(f"Error in batch archiving tickets: {str(e)}")
-        flash(f'Error archiving tickets: {str(e)}', 'error')
-    
-    return redirect(url_for('tickets.tickets_dashboard'))
\ No newline at end of file
+    job = start_job('archive_tickets', status=status, date_before=date_before_str or None, user_id=current_user.id)
+    return job_response(job, url_for('tickets.tickets_dashboard'),
+                        f'Archiving {count} tickets in the background')
+
+
+def _tickets_to_archive(status, date_before_str):
+    """Query of non-archived tickets matching the batch archive criteria"""
+    query = Ticket.query.filter(Ticket.archived == False)
+    if status != 'all':
+        query = query.filter(Ticket.status == status)
+    if date_before_str:
+        date_before = datetime.strptime(date_before_str, '%Y-%m-%d')
+        # Tickets not updated since the end of that day
+        date_before = date_before.replace(hour=23, minute=59, second=59, tzinfo=pytz.UTC)
+        query = query.filter(Ticket.updated_at < date_before)
+    return query
+
+
+@job_handler('archive_tickets')
+def archive_tickets_job(job, status, user_id, date_before=None):
+    """Archive matching tickets in chunks, with one history entry per ticket"""
+    ticket_ids = [ticket_id for ticket_id, in _tickets_to_archive(status, date_before).with_entities(Ticket.id)]
+    now = datetime.now(pytz.UTC)
+
+    for start in range(0, len(ticket_ids), ARCHIVE_CHUNK_SIZE):
+        chunk = ticket_ids[start:start + ARCHIVE_CHUNK_SIZE]
+        Ticket.query.filter(Ticket.id.in_(chunk)).update({Ticket.archived: True}, synchronize_session=False)
+        db.session.execute(db.insert(TicketHistory), [{
+            'ticket_id': ticket_id,
+            'user_id': user_id,
+            'action': "archived",
+            'details': "Ticket was archived in batch operation",
+            'created_at': now
+        } for ticket_id in chunk])
+        job.progress(start + len(chunk), len(ticket_ids), f'Archived {start + len(chunk)} of {len(ticket_ids)} tickets')
+
+    return f'Successfully archived {len(ticket_ids)} tickets'
@@ -0,0 +1,351 @@
+"""
+Ticket dashboard and detail queries.
+
+TicketFilters parses the dashboard's filter arguments once, so the page and
+its JSON "load more" endpoint select exactly the same tickets. Lists are paged
+by keyset on (created_at, id), newest first: each page is an index range scan
+starting after the previous page's last ticket, so a page deep in the history
+costs the same as the first, where OFFSET would re-read every skipped row.
+
+Searches use the full-text index on PostgreSQL: ticket.search_vector (title,
+description and comment text, kept current by triggers) is matched against
+the search as a web-style query, and results are ranked by relevance, paged by
+keyset on (rank, id). SQLite, used in tests, has no tsvector; there searches
+fall back to LIKE over the same text and keep the newest-first order.
+
+The filter bar's counts come from facet_counts(): one UNION ALL of GROUP BY
+queries, a branch per facet, each under every filter but its own, so an
+option's count is the number of tickets choosing it would show.
+
+A ticket's page loads the ticket with its category, creator and assignee in
+one query, and its comments and history (each with its user) in one more
+apiece, merged into a chronological timeline of plain TimelineEntry objects.
+Only the latest TIMELINE_PAGE_SIZE entries are loaded; older ones are fetched
+on demand by keyset on (created_at, kind, id), so opening a ticket costs the
+same however long its timeline.
+"""
+import logging
+from dataclasses import asdict, dataclass, replace
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import pytz
+from sqlalchemy import REAL, tuple_
+from sqlalchemy.orm import joinedload
+
+from app import db
+from models import Ticket, TicketComment, TicketHistory, TicketStatus
+from schedule_utils import as_utc
+
+logger = logging.getLogger(__name__)
+
+# Tickets per dashboard page
+TICKET_PAGE_SIZE = 50
+# Arguments that do not count as filters when deciding to default to open tickets
+NON_FILTER_ARGS = ('timestamp', 'rand', 'cursor', 'layout')
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.UTC)
+# Filter bar facets: the column each counts, and the filters it ignores while counting
+FACETS = {
+    'status': (Ticket.status, ('status',)),
+    'category': (Ticket.category_id, ('category',)),
+    'priority': (Ticket.priority, ('priority',)),
+    'technician': (Ticket.assigned_to, ('technician', 'assigned_to')),
+}
+# Timeline entries per ticket page and per "load older" fetch
+TIMELINE_PAGE_SIZE = 30
+# Order of entries created at the same moment: history (the status change) before the comment
+TIMELINE_KINDS = ('history', 'comment')
+# Text search configuration of ticket.search_vector (see TICKET_SEARCH_DDL in models)
+SEARCH_CONFIG = 'english'
+
+
+@dataclass(frozen=True)
+class TicketFilters:
+    status: str = 'all'
+    category: str = 'all'
+    priority: str = 'all'
+    technician: str = 'all'
+    assigned_to: str = 'all'
+    created_by: str = 'all'
+    search: str = ''
+    archived: bool = False  # Include archived tickets
+
+    @classmethod
+    def from_args(cls, args) -> 'TicketFilters':
+        """
+        The dashboard's filters from request arguments: open tickets when no
+        filter is given, otherwise 'all' for each filter left out
+        """
+        archived = args.get('archived', 'false').lower() == 'true'
+        if all(key in NON_FILTER_ARGS for key in args.keys()):
+            return cls(status='open', archived=archived)
+
+        def value(name):
+            raw = args.get(name)
+            return raw if raw not in (None, '') else 'all'
+
+        status = value('status').strip().lower()
+        if status != 'all' and status not in vars(TicketStatus).values():
+            logger.warning(f"Invalid status filter '{status}', defaulting to 'open'")
+            status = 'open'
+        return cls(status=status, category=value('category'), priority=value('priority'),
+                   technician=value('technician'), assigned_to=value('assigned_to'),
+                   created_by=value('created_by'), search=args.get('search') or '', archived=archived)
+
+
+def filter_id(name: str, value: str) -> Optional[int]:
+    """An id filter's value, or None for 'all' (and for values that are not ids)"""
+    if value == 'all':
+        return None
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        logger.error(f"Invalid {name} filter value: {value}")
+        return None
+
+
+def filtered_tickets(filters: TicketFilters):
+    """Ticket query for the filters, without ordering or eager loading"""
+    query = Ticket.query
+
+    # By default, don't show archived tickets unless explicitly requested
+    if not filters.archived:
+        query = query.filter(Ticket.archived == False)
+    if filters.status != 'all':
+        query = query.filter(Ticket.status == filters.status)
+
+    for name, column in (('category', Ticket.category_id), ('priority', Ticket.priority),
+                         ('technician', Ticket.assigned_to), ('assigned_to', Ticket.assigned_to),
+                         ('created_by', Ticket.created_by)):
+        value = filter_id(name, getattr(filters, name))
+        if value is not None:
+            query = query.filter(column == value)
+
+    # Keywords in title, description and comments
+    if filters.search:
+        query = query.filter(search_condition(filters.search))
+    return query
+
+
+def _full_text_search() -> bool:
+    return db.engine.dialect.name == 'postgresql'
+
+
+def search_condition(search: str):
+    """SQL condition for tickets matching a search"""
+    if _full_text_search():
+        return Ticket.search_vector.op('@@')(db.func.websearch_to_tsquery(SEARCH_CONFIG, search))
+    search_term = f"%{search}%"
+    return db.or_(Ticket.title.ilike(search_term), Ticket.description.ilike(search_term),
+                  Ticket.comments.any(TicketComment.content.ilike(search_term)))
+
+
+def search_rank(filters: TicketFilters):
+    """Relevance of each ticket to the filters' search, or None when results keep the newest-first order"""
+    if not filters.search or not _full_text_search():
+        return None
+    return db.func.ts_rank(Ticket.search_vector, db.func.websearch_to_tsquery(SEARCH_CONFIG, filters.search),
+                           type_=REAL)
+
+
+def count_tickets(query) -> int:
+    """Number of tickets a filtered query matches, counted in the database"""
+    return query.order_by(None).with_entities(db.func.count(Ticket.id)).scalar()
+
+
+def facet_counts(filters: TicketFilters) -> Dict[str, Dict[str, int]]:
+    """
+    Ticket counts for each value of each facet, keyed by the value as the
+    filter bar submits it ('none' for unassigned tickets), in one query
+    """
+    branches = []
+    for facet, (column, ignored) in FACETS.items():
+        others = replace(filters, **{name: 'all' for name in ignored})
+        branches.append(filtered_tickets(others)
+                        .with_entities(db.literal(facet).label('facet'), db.cast(column, db.String).label('value'),
+                                       db.func.count(Ticket.id).label('count'))
+                        .group_by(column)
+                        .statement)
+    counts = {facet: {} for facet in FACETS}
+    for facet, value, count in db.session.execute(db.union_all(*branches)):
+        counts[facet][value if value is not None else 'none'] = count
+    return counts
+
+
+def encode_cursor(ticket: Ticket) -> str:
+    """Opaque position after ticket: microseconds since the epoch and the id"""
+    micros = (as_utc(ticket.created_at) - EPOCH) // timedelta(microseconds=1)
+    return f"{micros}-{ticket.id}"
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Raises ValueError for a malformed cursor"""
+    micros, ticket_id = cursor.split('-')
+    return EPOCH + timedelta(microseconds=int(micros)), int(ticket_id)
+
+
+def encode_rank_cursor(rank: float, ticket: Ticket) -> str:
+    """Opaque position after ticket in ranked search results"""
+    return f"{rank!r}:{ticket.id}"
+
+
+def decode_rank_cursor(cursor: str) -> Tuple[float, int]:
+    """Raises ValueError for a malformed cursor"""
+    rank, ticket_id = cursor.split(':')
+    return float(rank), int(ticket_id)
+
+
+def ticket_page(query, cursor: Optional[str] = None, limit: int = TICKET_PAGE_SIZE,
+                rank=None) -> Tuple[List[Ticket], Optional[str]]:
+    """
+    One page of the query's tickets, newest first (or by descending rank, an
+    SQL expression such as search_rank()), starting after cursor. Returns the
+    tickets (with category and assignee loaded) and the cursor of the next
+    page, or None on the last page.
+    """
+    query = query.options(joinedload(Ticket.category), joinedload(Ticket.assigned_technician))
+    if rank is not None:
+        return _ranked_page(query, cursor, limit, rank)
+
+    if cursor:
+        created_at, ticket_id = decode_cursor(cursor)
+        query = query.filter(tuple_(Ticket.created_at, Ticket.id) < tuple_(created_at, ticket_id))
+    # One extra row tells whether there is another page
+    tickets = query.order_by(Ticket.created_at.desc(), Ticket.id.desc()).limit(limit + 1).all()
+    if len(tickets) > limit:
+        return tickets[:limit], encode_cursor(tickets[limit - 1])
+    return tickets, None
+
+
+def after_rank_cursor(rank, cursor: str):
+    """Keyset condition for the ranked results after cursor: a lower rank, or the same rank and a lower id"""
+    after_rank, ticket_id = decode_rank_cursor(cursor)
+    # Compared as REAL, ts_rank's own type, so the last ticket's rank round-trips exactly
+    return tuple_(rank, Ticket.id) < tuple_(db.cast(after_rank, REAL), ticket_id)
+
+
+def _ranked_page(query, cursor: Optional[str], limit: int, rank) -> Tuple[List[Ticket], Optional[str]]:
+    if cursor:
+        query = query.filter(after_rank_cursor(rank, cursor))
+    rows = query.add_columns(rank).order_by(rank.desc(), Ticket.id.desc()).limit(limit + 1).all()
+    tickets = [ticket for ticket, _ in rows]
+    if len(rows) > limit:
+        last_ticket, last_rank = rows[limit - 1]
+        return tickets[:limit], encode_rank_cursor(last_rank, last_ticket)
+    return tickets, None
+
+
+def ticket_row(ticket: Ticket) -> dict:
+    """The plain dict the dashboard templates render"""
+    return {
+        'id': ticket.id,
+        'title': ticket.title,
+        'status': ticket.status,
+        'priority': ticket.priority,
+        'assigned_to': ticket.assigned_to,
+        'created_by': ticket.created_by,
+        'created_at': ticket.created_at,
+        'updated_at': ticket.updated_at,
+        'due_date': ticket.due_date,
+        'category': {
+            'id': ticket.category.id,
+            'name': ticket.category.name
+        },
+        'assigned_technician': {
+            'username': ticket.assigned_technician.username
+        } if ticket.assigned_technician else None
+    }
+
+
+def ticket_json(row: dict) -> dict:
+    """A ticket_row() with its timestamps in ISO format"""
+    return {**row, **{field: row[field].isoformat() if row[field] else None
+                      for field in ('created_at', 'updated_at', 'due_date')}}
+
+
+def load_ticket(ticket_id: int) -> Ticket:
+    """The ticket with its category, creator and assignee, or a 404"""
+    return (Ticket.query
+            .options(joinedload(Ticket.category), joinedload(Ticket.creator), joinedload(Ticket.assigned_technician))
+            .filter(Ticket.id == ticket_id)
+            .first_or_404())
+
+
+@dataclass(frozen=True)
+class TimelineEntry:
+    kind: str  # 'comment' or 'history'
+    id: int
+    created_at: datetime
+    user: dict  # id, username and color
+    content: Optional[str] = None  # Comments
+    action: Optional[str] = None  # History entries
+    details: Optional[str] = None
+
+    @property
+    def is_comment(self) -> bool:
+        return self.kind == 'comment'
+
+    @property
+    def sort_key(self) -> Tuple[datetime, int, int]:
+        return as_utc(self.created_at), TIMELINE_KINDS.index(self.kind), self.id
+
+
+def encode_timeline_cursor(entry: TimelineEntry) -> str:
+    """Opaque position before entry: microseconds since the epoch, the kind and the id"""
+    micros = (as_utc(entry.created_at) - EPOCH) // timedelta(microseconds=1)
+    return f"{micros}-{entry.kind}-{entry.id}"
+
+
+def decode_timeline_cursor(cursor: str) -> Tuple[datetime, str, int]:
+    """Raises ValueError for a malformed cursor"""
+    micros, kind, entry_id = cursor.split('-')
+    if kind not in TIMELINE_KINDS:
+        raise ValueError(f"Unknown timeline entry kind: {kind}")
+    return EPOCH + timedelta(microseconds=int(micros)), kind, int(entry_id)
+
+
+def _timeline_user(user) -> dict:
+    return {'id': user.id, 'username': user.username, 'color': user.color}
+
+
+def _latest(model, kind: str, ticket_id: int, before: Optional[Tuple[datetime, str, int]], limit: int):
+    """The latest limit rows of one kind of timeline entry, newest first, from before the cursor position"""
+    query = model.query.options(joinedload(model.user)).filter(model.ticket_id == ticket_id)
+    if before:
+        created_at, before_kind, entry_id = before
+        order = TIMELINE_KINDS.index(kind) - TIMELINE_KINDS.index(before_kind)
+        if order == 0:
+            query = query.filter(tuple_(model.created_at, model.id) < tuple_(created_at, entry_id))
+        elif order < 0:
+            query = query.filter(model.created_at <= created_at)  # Sorts before the cursor's kind at the same moment
+        else:
+            query = query.filter(model.created_at < created_at)
+    return query.order_by(model.created_at.desc(), model.id.desc()).limit(limit).all()
+
+
+def ticket_timeline(ticket_id: int, before: Optional[str] = None,
+                    limit: int = TIMELINE_PAGE_SIZE) -> Tuple[List[TimelineEntry], Optional[str]]:
+    """
+    The latest limit comments and history entries of a ticket from before the
+    cursor, oldest first, and the cursor for the entries older than these, or
+    None when there are none
+    """
+    position = decode_timeline_cursor(before) if before else None
+    # One extra row of each kind tells whether there is anything older
+    comments = _latest(TicketComment, 'comment', ticket_id, position, limit + 1)
+    history = _latest(TicketHistory, 'history', ticket_id, position, limit + 1)
+    entries = [TimelineEntry(kind='comment', id=comment.id, created_at=comment.created_at,
+                             user=_timeline_user(comment.user), content=comment.content)
+               for comment in comments]
+    entries += [TimelineEntry(kind='history', id=entry.id, created_at=entry.created_at,
+                              user=_timeline_user(entry.user), action=entry.action, details=entry.details)
+                for entry in history]
+    entries = sorted(entries, key=lambda entry: entry.sort_key, reverse=True)
+    if len(entries) > limit:
+        return entries[limit - 1::-1], encode_timeline_cursor(entries[limit - 1])
+    return entries[::-1], None
+
+
+def timeline_json(entry: TimelineEntry) -> dict:
+    """A TimelineEntry as plain JSON"""
+    return {**asdict(entry), 'created_at': entry.created_at.isoformat()}
@@ -13,6 +13,171 @@ ALTER TABLE schedule ADD COLUMN IF NOT EXISTS location_id INTEGER REFERENCES loc
 -- Add created_at column to schedule table if it doesn't exist
 ALTER TABLE schedule ADD COLUMN IF NOT EXISTS created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP;
 
+-- Add indexes used by schedule time-range queries (calendar, overlap checks, active users, time off)
+CREATE INDEX IF NOT EXISTS idx_schedule_technician_start ON schedule(technician_id, start_time);
+CREATE INDEX IF NOT EXISTS idx_schedule_time ON schedule(start_time, end_time);
+CREATE INDEX IF NOT EXISTS idx_schedule_time_off ON schedule(start_time) WHERE time_off = true;
+
+-- Add schedule_rule table for weekly recurring shifts if it doesn't exist
+CREATE TABLE IF NOT EXISTS schedule_rule (
+    id SERIAL PRIMARY KEY,
+    technician_id INTEGER REFERENCES "user"(id) NOT NULL,
+    location_id INTEGER REFERENCES location(id),
+    description VARCHAR(200),
+    time_off BOOLEAN DEFAULT FALSE,
+    weekdays VARCHAR(20) NOT NULL,
+    start_time TIME NOT NULL,
+    end_time TIME NOT NULL,
+    timezone VARCHAR(50) NOT NULL DEFAULT 'UTC',
+    start_date DATE NOT NULL,
+    until_date DATE,
+    exceptions TEXT DEFAULT '',
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Add background_job table for the background job runner if it doesn't exist
+CREATE TABLE IF NOT EXISTS background_job (
+    id SERIAL PRIMARY KEY,
+    kind VARCHAR(50) NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+    params TEXT,
+    progress INTEGER,
+    message VARCHAR(500),
+    error TEXT,
+    result_path VARCHAR(500),
+    result_name VARCHAR(200),
+    result_mimetype VARCHAR(100),
+    created_by INTEGER REFERENCES "user"(id) NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP WITH TIME ZONE,
+    finished_at TIMESTAMP WITH TIME ZONE,
+    owner VARCHAR(200),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_background_job_created ON background_job(created_at);
+
+-- Add updated_at columns used by incremental backups if they don't exist
+ALTER TABLE "user" ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE schedule ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE ticket_category ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP;
+
+-- Add deleted_record table (tombstones for incremental backups) if it doesn't exist
+CREATE TABLE IF NOT EXISTS deleted_record (
+    id SERIAL PRIMARY KEY,
+    table_name VARCHAR(50) NOT NULL,
+    record_id INTEGER NOT NULL,
+    deleted_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_deleted_record_deleted_at ON deleted_record(deleted_at);
+
+-- Add backup_record table (watermarks for incremental backups) if it doesn't exist
+CREATE TABLE IF NOT EXISTS backup_record (
+    id SERIAL PRIMARY KEY,
+    kind VARCHAR(20) NOT NULL,
+    since TIMESTAMP WITH TIME ZONE,
+    watermark TIMESTAMP WITH TIME ZONE NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Add outbox_email table (emails queued for the background dispatcher) if it doesn't exist
+CREATE TABLE IF NOT EXISTS outbox_email (
+    id SERIAL PRIMARY KEY,
+    recipients TEXT NOT NULL,
+    from_email VARCHAR(120) NOT NULL,
+    subject VARCHAR(300) NOT NULL,
+    html_content TEXT NOT NULL,
+    text_content TEXT,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_error TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    sent_at TIMESTAMP WITH TIME ZONE
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_email_due ON outbox_email(status, next_attempt_at);
+
+-- Add notification digest settings and the pending_notification table if they don't exist
+ALTER TABLE "user" ADD COLUMN IF NOT EXISTS digest_minutes INTEGER;
+-- Digests are opt-in: existing settings rows get 0 and keep sending immediately
+ALTER TABLE email_settings ADD COLUMN IF NOT EXISTS digest_minutes INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE email_settings ALTER COLUMN digest_minutes SET DEFAULT 0;
+CREATE TABLE IF NOT EXISTS pending_notification (
+    id SERIAL PRIMARY KEY,
+    recipient VARCHAR(120) NOT NULL,
+    subject VARCHAR(300) NOT NULL,
+    html_content TEXT NOT NULL,
+    text_content TEXT,
+    send_after TIMESTAMP WITH TIME ZONE NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_pending_notification_due ON pending_notification(send_after);
+CREATE INDEX IF NOT EXISTS idx_pending_notification_recipient ON pending_notification(recipient);
+
+-- Add plain-text alternates for queued emails if they don't exist
+ALTER TABLE outbox_email ADD COLUMN IF NOT EXISTS text_content TEXT;
+ALTER TABLE pending_notification ADD COLUMN IF NOT EXISTS text_content TEXT;
+
+-- Index for keyset pagination of the ticket dashboard; pages skip tickets without a creation time
+UPDATE ticket SET created_at = COALESCE(updated_at, CURRENT_TIMESTAMP) WHERE created_at IS NULL;
+CREATE INDEX IF NOT EXISTS idx_ticket_created_id ON ticket(created_at, id);
+
+-- Full-text ticket search
+ALTER TABLE ticket ADD COLUMN IF NOT EXISTS search_vector TSVECTOR;
+
+CREATE OR REPLACE FUNCTION ticket_search_document(ticket_id INTEGER, title TEXT, description TEXT)
+RETURNS tsvector AS $$
+    SELECT setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+           setweight(to_tsvector('english', coalesce(description, '')), 'B') ||
+           setweight(to_tsvector('english', coalesce(
+               (SELECT string_agg(content, ' ') FROM ticket_comment WHERE ticket_comment.ticket_id = $1), '')), 'C')
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION ticket_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := ticket_search_document(NEW.id, NEW.title, NEW.description);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION ticket_comment_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE ticket SET search_vector = ticket_search_document(id, title, description) WHERE id = OLD.ticket_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE ticket SET search_vector = ticket_search_document(id, title, description) WHERE id = NEW.ticket_id;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS ticket_search_vector_update ON ticket;
+CREATE TRIGGER ticket_search_vector_update BEFORE INSERT OR UPDATE OF title, description ON ticket
+FOR EACH ROW EXECUTE FUNCTION ticket_search_vector_update();
+
+DROP TRIGGER IF EXISTS ticket_comment_search_vector_update ON ticket_comment;
+CREATE TRIGGER ticket_comment_search_vector_update AFTER INSERT OR UPDATE OF content, ticket_id OR DELETE
+ON ticket_comment FOR EACH ROW EXECUTE FUNCTION ticket_comment_search_vector_update();
+
+-- Build the documents of existing tickets, then index them
+UPDATE ticket SET search_vector = ticket_search_document(id, title, description);
+CREATE INDEX IF NOT EXISTS idx_ticket_search ON ticket USING GIN (search_vector);
+
+-- Indexes for keyset pages of ticket timelines; pages skip entries without a creation time
+UPDATE ticket_comment SET created_at = COALESCE(updated_at, CURRENT_TIMESTAMP) WHERE created_at IS NULL;
+UPDATE ticket_history SET created_at = ticket.created_at
+FROM ticket WHERE ticket_history.ticket_id = ticket.id AND ticket_history.created_at IS NULL;
+CREATE INDEX IF NOT EXISTS idx_ticket_comment_timeline ON ticket_comment(ticket_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_ticket_history_timeline ON ticket_history(ticket_id, created_at, id);
+
+-- Rule edits (new skipped dates) are picked up by incremental backups
+ALTER TABLE schedule_rule ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP;
+
+-- Background jobs record the process running them and its heartbeat
+ALTER TABLE background_job ADD COLUMN IF NOT EXISTS owner VARCHAR(200);
+ALTER TABLE background_job ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP;
+
 -- Check if columns were added
 DO $$
 BEGIN